@@ -0,0 +1,166 @@
+import sys, time, json, argparse
+import numpy as np
+import toy_2D_fits as t2d
+import ensemble_stats as es
+import instrument
+import scan
+
+# Adaptive ensemble size: instead of fixing the number of fake experiments in
+# advance, run them in batches, keep running statistics of every fit (see
+# ensemble_stats.py) and stop as soon as the biases and pull widths are known
+# to the requested precision, or a budget of experiments or seconds runs out.
+# The targets are the largest acceptable standard errors:
+#     'bias'       on the mean of n - true of every fit and isotope (events),
+#     'pullwidth'  on the pull widths of the chi-square fits.
+# A target set to None is not checked. Since experiment i always gets the
+# stream experimentrng(seed, i), a run that stops after n experiments has
+# exactly the first n experiments of any longer run with the same seed. E.g.
+#     summary, status = runadaptive(1000, 100, {'bias': 0.5})
+#     print status['stopreason'], summary.summary()['bias_n1_2D']
+
+DEFAULT_TARGETS = {'bias': 1.0, 'pullwidth': 0.01}
+# Why a run stopped (status['stopreason']).
+STOP_TARGETS = 'targets reached'
+STOP_NEXPERS = 'experiment budget exhausted'
+STOP_SECONDS = 'time budget exhausted'
+
+#########################################################################
+# The worst standard error of each targeted quantity in a summary dict of
+# EnsembleSummary.summary(), e.g. {'bias': 0.8, 'pullwidth': 0.012}. A
+# quantity that can't be estimated yet counts as infinitely uncertain.
+def precision(summary, fits, targets):
+    names = {'bias': ['biaserr_n%s_%s' % (niso, fit) for fit in fits
+                      for niso in xrange(2)],
+             'pullwidth': ['pullwidtherr_n%s_%s' % (niso, fit) for fit in fits
+                           if fit in es.CHI2FITS for niso in xrange(2)]}
+    achieved = {}
+    for target in targets:
+        if target not in names:
+            print 'Unknown precision target %s (expected some of %s). ' \
+                'Exiting!' % (target, sorted(names))
+            sys.exit(1)
+        errors = [summary.get(name, np.inf) for name in names[target]]
+        achieved[target] = max(errors) if errors else 0.
+    return achieved
+
+#########################################################################
+# Run fake experiments of one configuration (endpoints, lifetimes and
+# binnings in 'shape' default to scan.DEFAULTS) in batches until every
+# target in 'targets' is met, 'maxexpers' experiments have been run or
+# 'maxseconds' have passed, whichever comes first. The first batch has
+# 'batchsize' experiments; after that the number of experiments needed is
+# extrapolated from the current errors (which fall like 1/sqrt(n)), with
+# each batch between 'batchsize' experiments and the number already done, and
+# cut short to fit in what's left of the time budget.
+#
+# Returns (summary, status): the EnsembleSummary of all experiments run, and
+# a dict with the number of experiments ('nexpers'), the reason for stopping
+# ('stopreason', one of the STOP_* strings), the elapsed time, the targets
+# and the precision achieved. If 'outfilename' is given, the status and
+# summary.summary() are also written there as JSON.
+def runadaptive(nevents0, nevents1, targets=None, maxexpers=10**6,
+                maxseconds=None, batchsize=500, nworkers=1, seed=19,
+                genmode='binned', unbinned=False, PearsonErrs=True,
+                membudget=2**26, outfilename='', progress=10., **shape):
+    starttime = time.time()
+    if targets is None: targets = DEFAULT_TARGETS
+    targets = dict((name, value) for name, value in targets.items()
+                   if value is not None)
+    config = dict(scan.DEFAULTS, nevents0=nevents0, nevents1=nevents1,
+                  **shape)
+    runconfig = dict(config, PearsonErrs=PearsonErrs, membudget=membudget,
+                     genmode=genmode, batched=True, unbinned=unbinned,
+                     seed=seed, debug=False)
+    fits = list(es.FITS)
+    if not (unbinned and genmode == 'events'): fits.remove('UML')
+    summary = es.EnsembleSummary((nevents0, nevents1), fits)
+    reporter = None
+    if progress is not None:
+        reporter = instrument.ProgressReporter(maxexpers, interval=progress)
+
+    done, stopreason = 0, None
+    achieved = precision({}, fits, targets)
+    while stopreason is None:
+        nbatch = batchsize
+        if done:
+            # A precision that isn't finite yet (e.g. the spread of a single
+            # experiment) can't be extrapolated; run another 'batchsize'.
+            if all(np.isfinite(achieved[name]) for name in targets):
+                needed = max(int(np.ceil(done*(achieved[name]/
+                                               targets[name])**2))
+                             for name in targets) if targets else done
+                nbatch = min(max(needed - done, batchsize), done)
+            if maxseconds is not None:
+                rate = done/(time.time() - starttime)
+                left = maxseconds - (time.time() - starttime)
+                nbatch = min(nbatch, max(1, int(rate*left)))
+        stop = min(done + nbatch, maxexpers)
+        if nworkers > 1:
+            block = t2d.runparallel(done, stop, runconfig, nworkers,
+                                    reporter=reporter)
+        else:
+            block = t2d.runexperiments(done, stop, runconfig,
+                                       reporter=reporter)
+        summary.update(block)
+        done = stop
+        achieved = precision(summary.summary(), fits, targets)
+        if all(achieved[name] <= targets[name] for name in targets):
+            stopreason = STOP_TARGETS
+        elif done >= maxexpers:
+            stopreason = STOP_NEXPERS
+        elif maxseconds is not None and \
+                time.time() - starttime >= maxseconds:
+            stopreason = STOP_SECONDS
+
+    status = {'nexpers': done, 'stopreason': stopreason,
+              'elapsed': time.time() - starttime, 'targets': targets,
+              'achieved': achieved}
+    if outfilename:
+        with open(outfilename, 'w') as outfile:
+            json.dump({'config': runconfig, 'status': status,
+                       'summary': summary.summary()}, outfile, indent=1,
+                      sort_keys=True)
+    print 'Stopped after %s experiments (%s). Elapsed time: %s' % \
+        (done, stopreason, status['elapsed'])
+    return summary, status
+
+#########################################################################
+#########################################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run fake experiments until '
+                                     'the biases and pull widths are known '
+                                     'to a given precision.')
+    parser.add_argument('nevents0', type=int)
+    parser.add_argument('nevents1', type=int)
+    parser.add_argument('outfilename', nargs='?', default='')
+    parser.add_argument('--bias', type=float,
+                        default=DEFAULT_TARGETS['bias'],
+                        help='target standard error on the biases (events)')
+    parser.add_argument('--pullwidth', type=float,
+                        default=DEFAULT_TARGETS['pullwidth'],
+                        help='target standard error on the pull widths')
+    parser.add_argument('--maxexpers', type=int, default=10**6,
+                        help='stop after this many experiments')
+    parser.add_argument('--maxseconds', type=float, default=None,
+                        help='stop after this many seconds')
+    parser.add_argument('--batch', type=int, default=500,
+                        help='experiments in the first batch')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=19)
+    parser.add_argument('--events', action='store_true',
+                        help='generate every event (and run the unbinned '
+                        'fit) instead of drawing bin counts')
+    args = parser.parse_args()
+
+    summary, status = runadaptive(args.nevents0, args.nevents1,
+                                  {'bias': args.bias,
+                                   'pullwidth': args.pullwidth},
+                                  maxexpers=args.maxexpers,
+                                  maxseconds=args.maxseconds,
+                                  batchsize=args.batch, nworkers=args.workers,
+                                  seed=args.seed,
+                                  genmode='events' if args.events else
+                                  'binned', unbinned=args.events,
+                                  outfilename=args.outfilename)
+    for name, value in sorted(summary.summary().items()):
+        print '%-22s %10.4g' % (name, value)
@@ -0,0 +1,181 @@
+import sys, time, argparse, json
+import numpy as np
+from scipy.special import chdtri
+import toy_2D_fits as t2d
+import scan
+
+# Expected fit performance without toys. For the linear two-isotope model the
+# fits of toy_2D_fits.py are, for large enough bin contents, linear in the
+# data, so everything about their spread follows from the templates:
+#
+# - On Asimov data (every bin at its expected content mu) all the fits return
+#   the true normalizations, and the covariance they report is the inverse of
+#   the Fisher matrix I = F^T diag(1/mu) F, with F the (nbins x 2) matrix of
+#   template fractions.
+# - The experiments are generated with a fixed number of events per isotope
+#   (multinomial, not Poisson) and the 1-D fit uses both projections of the
+#   same events, so the actual covariance of the best fits is the sandwich
+#   I^-1 F^T W S W F I^-1, where W = diag(1/mu) and S is the true covariance
+#   of the bin contents.
+# - chi^2_min is then a quadratic form in Gaussian bin contents, distributed
+#   as sum_i lambda_i z_i^2 with lambda_i the eigenvalues of
+#   M = (1 - P) W^1/2 S W^1/2 (1 - P), P being the projection onto the
+#   fitted templates. Its median comes from matching the first two moments
+#   of that sum to a scaled chi^2 (a*chi^2 with nu = tr(M)^2/tr(M^2) dof).
+#   This is how the 1-D fit ends up with about 5 rather than 6 dof.
+#
+# E.g. predict(1000, 100)['1D']['sigma'] is the expected spread of the
+# 1-D fit's (n0, n1). Each prediction takes well under a millisecond.
+
+#########################################################################
+# Covariance of the flattened 2-D bin contents when each isotope contributes
+# a multinomial draw of nevents[k] events over fracs2D[k] (as in mainloop).
+def datacov2D(fracs2D, nevents):
+    fracs = [np.ravel(frac) for frac in fracs2D]
+    mu = sum(nevts*frac for nevts, frac in zip(nevents, fracs))
+    return np.diag(mu) - sum(nevts*np.outer(frac, frac)
+                             for nevts, frac in zip(nevents, fracs))
+
+# (nEbins + nTbins) x (nEbins*nTbins) matrix that projects flattened 2-D bin
+# contents onto the energy and time histograms of the 1-D fit.
+def projection1D(nEbins, nTbins):
+    return np.vstack((np.kron(np.eye(nEbins), np.ones(nTbins)),
+                      np.kron(np.ones(nEbins), np.eye(nTbins))))
+
+#########################################################################
+# Asimov/Fisher prediction for a fit of the templates F (nbins x 2) to data
+# with true covariance 'datacov', at true normalizations 'nevents'. Returns a
+# dict with the covariance the fit reports on Asimov data ('fishercov'), the
+# actual covariance of the best fits ('cov'), their standard deviations
+# ('sigma') and correlation ('corr'), and the mean, median and effective dof
+# of chi^2_min ('chi2mean', 'chi2median', 'dof').
+def predictfit(F, nevents, datacov):
+    mu = np.dot(F, nevents)
+    weights = 1./mu
+    fisher = np.dot(F.T*weights, F)
+    fishercov = np.linalg.inv(fisher)
+    WF = F*weights[:,np.newaxis]
+    cov = np.dot(fishercov, np.dot(np.dot(WF.T, datacov), WF)).dot(fishercov)
+    sqrtw = np.sqrt(weights)
+    C = datacov*np.outer(sqrtw, sqrtw)
+    SF = F*sqrtw[:,np.newaxis]
+    Q = np.eye(len(mu)) - np.dot(np.dot(SF, fishercov), SF.T)
+    M = np.dot(np.dot(Q, C), Q)
+    trace, trace2 = np.trace(M), np.sum(M*M)
+    dof = trace**2/trace2
+    sigma = np.sqrt(np.diag(cov))
+    return {'fishercov': fishercov, 'cov': cov, 'sigma': sigma,
+            'corr': cov[0,1]/(sigma[0]*sigma[1]), 'chi2mean': trace,
+            'chi2median': trace/dof*chdtri(dof, 0.5), 'dof': dof}
+
+#########################################################################
+# Predictions for the 1-D pair and 2-D fits of one mainloop configuration.
+# The templates come from the cache behind toy_2D_fits.maketemplates.
+# Returns {'1D': predictfit(...), '2D': predictfit(...)}.
+def predict(nevents0, nevents1, endpoint0=12.0, endpoint1=8.0, lifetime0=260,
+            lifetime1=170, nEbins=4, nTbins=4):
+    nevents = np.array([nevents0, nevents1], dtype=float)
+    fracsE, fracsT, fracs2D = t2d.maketemplates(endpoint0, endpoint1,
+                                                lifetime0, lifetime1, nEbins,
+                                                nTbins)[2:]
+    cov2D = datacov2D(fracs2D, nevents)
+    F2D = np.column_stack([np.ravel(frac) for frac in fracs2D])
+    A = projection1D(nEbins, nTbins)
+    F1D = np.column_stack([np.append(fracsE[k], fracsT[k])
+                           for k in xrange(2)])
+    return {'1D': predictfit(F1D, nevents, np.dot(np.dot(A, cov2D), A.T)),
+            '2D': predictfit(F2D, nevents, cov2D)}
+
+# Flatten predict()'s output into one dict of scalars, with column names
+# like scan.summarize: sigma_n0_1D, fishersigma_n0_1D, corr_1D,
+# chi2median_1D, ...
+def flatten(prediction):
+    row = {}
+    for fit, pred in sorted(prediction.items()):
+        for niso in xrange(2):
+            row['sigma_n%s_%s' % (niso, fit)] = pred['sigma'][niso]
+            row['fishersigma_n%s_%s' % (niso, fit)] = \
+                np.sqrt(pred['fishercov'][niso,niso])
+        for name in ['corr', 'chi2mean', 'chi2median', 'dof']:
+            row['%s_%s' % (name, fit)] = pred[name]
+    return row
+
+#########################################################################
+# Predictions for every configuration of a scan grid (see scan.expandgrid),
+# as a data frame with one row per configuration.
+def predictgrid(grid):
+    import pandas as pd
+    rows = []
+    for nconfig, config in enumerate(scan.expandgrid(grid)):
+        row = flatten(predict(**config))
+        row.update(config)
+        row['config'] = nconfig
+        rows.append(row)
+    return pd.DataFrame(rows).set_index('config')
+
+#########################################################################
+# Compare the predictions for one configuration with a small toy ensemble
+# of 'nexpers' binned experiments. Returns a dict mapping each quantity of
+# flatten() to (predicted, from toys). The toy values are the standard
+# deviation of the best fits, the mean reported error, the correlation of
+# the best fits, the mean and median chi^2, and the effective dof of the
+# chi^2 values.
+def crosscheck(nevents0, nevents1, nexpers=500, seed=19, genmode='binned',
+               **shape):
+    import chi2_correction_1D as c2c
+    config = dict(scan.DEFAULTS, nevents0=nevents0, nevents1=nevents1,
+                  **shape)
+    predicted = flatten(predict(**config))
+    runconfig = dict(config, PearsonErrs=True, membudget=2**26,
+                     genmode=genmode, batched=True, unbinned=False,
+                     seed=seed, debug=False)
+    results = t2d.runexperiments(0, nexpers, runconfig)
+    toys = {}
+    for fit in ['1D', '2D']:
+        n0, n1 = results['n0_' + fit], results['n1_' + fit]
+        chi2 = results['chi_' + fit]
+        for niso, nfit in enumerate([n0, n1]):
+            toys['sigma_n%s_%s' % (niso, fit)] = np.std(nfit, ddof=1)
+            toys['fishersigma_n%s_%s' % (niso, fit)] = \
+                np.mean(np.sqrt(results['var%s%s_%s' % (niso, niso, fit)]))
+        toys['corr_' + fit] = np.corrcoef(n0, n1)[0,1]
+        toys['chi2mean_' + fit] = np.mean(chi2)
+        toys['chi2median_' + fit] = np.median(chi2)
+        toys['dof_' + fit] = c2c.effective_dof(chi2)[0]
+    return dict((name, (predicted[name], toys[name])) for name in predicted)
+
+#########################################################################
+#########################################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Predict the expected fit '
+                                     'uncertainties and chi^2 without toys.')
+    parser.add_argument('nevents0', type=int, nargs='?')
+    parser.add_argument('nevents1', type=int, nargs='?')
+    parser.add_argument('--grid', default='',
+                        help='JSON scan grid (see scan.py) to predict for')
+    parser.add_argument('--out', default='', help='write predictions as CSV')
+    parser.add_argument('--toys', type=int, default=0, metavar='N',
+                        help='cross-check against N toy experiments')
+    args = parser.parse_args()
+
+    if args.grid:
+        with open(args.grid) as gridfile: grid = json.load(gridfile)
+        starttime = time.time()
+        predictions = predictgrid(grid)
+        print '%s configurations predicted in %.3g s.' % \
+            (len(predictions), time.time() - starttime)
+        if args.out: predictions.to_csv(args.out)
+        else: print predictions.to_string()
+        sys.exit(0)
+    if args.nevents0 is None or args.nevents1 is None:
+        print 'This needs nevents0 and nevents1, or --grid. Exiting!'
+        sys.exit(1)
+    if args.toys:
+        for name, (pred, toy) in sorted(crosscheck(args.nevents0,
+                                                   args.nevents1,
+                                                   nexpers=args.toys).items()):
+            print '%-20s predicted %10.4g   toys %10.4g' % (name, pred, toy)
+    else:
+        for name, value in sorted(flatten(predict(args.nevents0,
+                                                  args.nevents1)).items()):
+            print '%-20s %10.4g' % (name, value)
@@ -0,0 +1,216 @@
+import numpy as np
+import scipy.stats as st
+from scipy.special import gammaln, xlogy
+
+# Vectorized versions of the fits in toy_2D_fits.py. Every fit here takes
+# a (nexps x nbins) matrix of bin counts, one row per fake experiment, and fits
+# all rows in a single pass of array operations instead of calling a scipy
+# optimizer once per experiment. The model is the same two-parameter linear
+# one used there: prediction = p[0]*fracs[0] + p[1]*fracs[1].
+#
+# Sums over bins are always written as sum(axis=-1) of elementwise products
+# (never dot/einsum) and iterative fits only update rows that haven't
+# converged yet. That way each experiment's result depends only on its own
+# row, no matter how many experiments are fitted together.
+
+
+#########################################################################
+# Solve the symmetric 2x2 systems [[a00, a01], [a01, a11]] x = [b0, b1] for
+# arrays of coefficients.
+def _solve2x2(a00, a01, a11, b0, b1):
+    det = a00*a11 - a01*a01
+    return (a11*b0 - a01*b1)/det, (a00*b1 - a01*b0)/det
+
+#########################################################################
+# Invert the symmetric 2x2 matrices [[a00, a01], [a01, a11]], returning an
+# array of shape (len(a00), 2, 2).
+def _inv2x2(a00, a01, a11):
+    det = a00*a11 - a01*a01
+    inv = np.empty((len(a00), 2, 2))
+    inv[:,0,0] = a11/det
+    inv[:,0,1] = inv[:,1,0] = -a01/det
+    inv[:,1,1] = a00/det
+    return inv
+
+#########################################################################
+# Weighted 'normal matrix' sum_i w_i f_i f_i^T for weights of shape
+# (nexps, nbins); returns its three independent entries.
+def _normalmatrix(w, f0, f1):
+    return (w*f0*f0).sum(axis=-1), (w*f0*f1).sum(axis=-1), \
+        (w*f1*f1).sum(axis=-1)
+
+#########################################################################
+# Minimize the chi-square of every row of 'counts' at once.
+#
+# With Neyman errors (PearsonErrs=False) the weights 1/counts don't depend on
+# the parameters, so the minimum is the closed-form weighted least-squares
+# solution. Empty bins get unit error (weight 1/max(counts, 1)) rather than
+# an infinite weight; toy_2D_fits and grid_scans use the same convention. 
+# With Pearson errors, chi^2 = sum (d - mu)^2/mu is minimized by Newton's 
+# method started from the Neyman solution, using the exact gradient
+#     dchi^2/dp_k = sum_i f_ik (1 - d_i^2/mu_i^2)
+# and Hessian sum_i f_ik f_il 2 d_i^2/mu_i^3; this converges in a few steps.
+#
+# The covariance matches what scipy.optimize.leastsq reports, i.e.
+# (J^T J)^-1 where J is the Jacobian of the residual vector
+# (d - mu)/sigma, and the p-value uses nbins - 2 degrees of freedom. This
+# returns arrays (pfit, pcov, chi2, pval) with shapes (nexps, 2),
+# (nexps, 2, 2), (nexps,) and (nexps,). With full_output=True it also returns
+# a dict of per-experiment diagnostics: 'converged' (bool) and 'nfev', the
+# number of times the residuals were evaluated.
+def chi2fit(counts, fracs, PearsonErrs=True, maxiter=50, tol=1e-10,
+            full_output=False):
+    counts = np.atleast_2d(np.asarray(counts, dtype=float))
+    f0, f1 = np.asarray(fracs[0], dtype=float), np.asarray(fracs[1],
+                                                           dtype=float)
+    # Closed-form Neyman solution.
+    w = 1./np.maximum(counts, 1.)
+    a00, a01, a11 = _normalmatrix(w, f0, f1)
+    p0, p1 = _solve2x2(a00, a01, a11, (w*counts*f0).sum(axis=-1),
+                       (w*counts*f1).sum(axis=-1))
+
+    active = np.zeros(len(counts), dtype=bool)
+    niters = np.zeros(len(counts), dtype=int)
+    if PearsonErrs:
+        active[:] = True
+        for niter in xrange(maxiter):
+            idx = np.nonzero(active)[0]
+            if not len(idx): break
+            pred = p0[idx,np.newaxis]*f0 + p1[idx,np.newaxis]*f1
+            ratio2 = (counts[idx]/pred)**2
+            grad0 = (f0*(1. - ratio2)).sum(axis=-1)
+            grad1 = (f1*(1. - ratio2)).sum(axis=-1)
+            h00, h01, h11 = _normalmatrix(2.*ratio2/pred, f0, f1)
+            step0, step1 = _solve2x2(h00, h01, h11, grad0, grad1)
+            p0[idx] -= step0
+            p1[idx] -= step1
+            niters[idx] += 1
+            done = (np.abs(step0) <= tol*(np.abs(p0[idx]) + tol)) & \
+                (np.abs(step1) <= tol*(np.abs(p1[idx]) + tol))
+            active[idx[done]] = False
+
+    pred = p0[:,np.newaxis]*f0 + p1[:,np.newaxis]*f1
+    if PearsonErrs:
+        chi2 = ((counts - pred)**2/pred).sum(axis=-1)
+        # d/dmu [(d - mu)/sqrt(mu)] = -(d + mu)/(2 mu^(3/2))
+        jacw = (counts + pred)**2/(4.*pred**3)
+    else:
+        chi2 = (w*(counts - pred)**2).sum(axis=-1)
+        jacw = w
+    pcov = _inv2x2(*_normalmatrix(jacw, f0, f1))
+    pval = st.chi2.sf(chi2, counts.shape[1] - 2)
+    if full_output:
+        return np.column_stack((p0, p1)), pcov, chi2, pval, \
+            {'converged': ~active, 'nfev': niters + 1}
+    return np.column_stack((p0, p1)), pcov, chi2, pval
+
+#########################################################################
+# Batched equivalent of toy_2D_fits.fit1D: histsE and histsT have shapes
+# (nexps, nEbins) and (nexps, nTbins).
+def batchfit1D(histsE, histsT, fracsE, fracsT, PearsonErrs=True,
+               full_output=False):
+    counts = np.hstack((histsE, histsT))
+    fracs = [np.append(fracsE[0], fracsT[0]), np.append(fracsE[1], fracsT[1])]
+    return chi2fit(counts, fracs, PearsonErrs=PearsonErrs, 
+                   full_output=full_output)
+
+#########################################################################
+# Batched equivalent of toy_2D_fits.fit2D: hists2D has shape
+# (nexps, nEbins, nTbins).
+def batchfit2D(hists2D, fracs2D, PearsonErrs=True, full_output=False):
+    counts = np.reshape(hists2D, (len(hists2D), -1))
+    return chi2fit(counts, [fracs2D[0].ravel(), fracs2D[1].ravel()],
+                   PearsonErrs=PearsonErrs, full_output=full_output)
+
+#########################################################################
+# Poisson negative log-likelihood of each row of 'counts' given predicted 
+# means 'pred', i.e. -sum(log(st.poisson.pmf(counts, pred))) as minimized by
+# toy_2D_fits.mlfit1D/mlfit2D, but computed directly from the counts: no 
+# distribution objects, no factorials (gammaln instead), and no log(0) 
+# underflow. xlogy makes empty bins contribute just their prediction.
+def poissonnll(counts, pred):
+    return (pred - xlogy(counts, pred) + gammaln(counts + 1.)).sum(axis=-1)
+
+#########################################################################
+# Maximize the binned Poisson likelihood of every row of 'counts' at once.
+# For the linear two-template model the gradient and Hessian of the negative
+# log-likelihood are
+#     dNLL/dp_k = sum_i f_ik (1 - d_i/mu_i),
+#     d^2NLL/dp_k dp_l = sum_i f_ik f_il d_i/mu_i^2,
+# so this runs Newton's method from the closed-form Neyman chi-square 
+# solution. Steps are halved where they would make a prediction non-positive 
+# or increase the NLL; rows where maxhalvings halvings don't help keep their 
+# last point and are reported as not converged. This returns (pfit, fncmin) 
+# with shapes (nexps, 2) and (nexps,), where fncmin follows the same 
+# -sum(log(pmf)) convention as mlfit1D/mlfit2D. full_output=True adds a 
+# diagnostics dict as in chi2fit, where 'nfev' counts NLL evaluations.
+def mlfit(counts, fracs, maxiter=50, tol=1e-10, maxhalvings=30,
+          full_output=False):
+    counts = np.atleast_2d(np.asarray(counts, dtype=float))
+    f0, f1 = np.asarray(fracs[0], dtype=float), np.asarray(fracs[1],
+                                                           dtype=float)
+    # Starting point: Neyman chi-square solution, with empty bins given unit
+    # error.
+    w = 1./np.maximum(counts, 1.)
+    p0, p1 = _solve2x2(*(_normalmatrix(w, f0, f1) + 
+                         ((w*counts*f0).sum(axis=-1), 
+                          (w*counts*f1).sum(axis=-1))))
+    nll = _reducednll(counts, p0[:,np.newaxis]*f0 + p1[:,np.newaxis]*f1)
+
+    active = np.ones(len(counts), dtype=bool)
+    failed = np.zeros(len(counts), dtype=bool)
+    nfev = np.ones(len(counts), dtype=int)
+    for niter in xrange(maxiter):
+        idx = np.nonzero(active)[0]
+        if not len(idx): break
+        data = counts[idx]
+        pred = p0[idx,np.newaxis]*f0 + p1[idx,np.newaxis]*f1
+        ratio = data/pred
+        step0, step1 = _solve2x2(*(_normalmatrix(ratio/pred, f0, f1) +
+                                   ((f0*(1. - ratio)).sum(axis=-1),
+                                    (f1*(1. - ratio)).sum(axis=-1))))
+        # Backtrack rows whose full step is unphysical or goes uphill. Rows 
+        # that find no acceptable step stay where they are and stop.
+        scale = np.ones(len(idx))
+        for nhalve in xrange(maxhalvings):
+            trial0, trial1 = p0[idx] - scale*step0, p1[idx] - scale*step1
+            trialpred = trial0[:,np.newaxis]*f0 + trial1[:,np.newaxis]*f1
+            with np.errstate(invalid='ignore', divide='ignore'):
+                trialnll = _reducednll(data, trialpred)
+            bad = (trialpred <= 0).any(axis=-1) | \
+                ~(trialnll <= nll[idx] + 1e-12*(1. + np.abs(nll[idx])))
+            if not bad.any(): break
+            scale[bad] *= 0.5
+        nfev[idx] += nhalve + 1
+        good = ~bad
+        moved = idx[good]
+        p0[moved], p1[moved], nll[moved] = trial0[good], trial1[good], \
+            trialnll[good]
+        failed[idx[bad]] = True
+        done = ((np.abs(scale*step0) <= tol*(np.abs(p0[idx]) + tol)) &
+                (np.abs(scale*step1) <= tol*(np.abs(p1[idx]) + tol))) | bad
+        active[idx[done]] = False
+
+    fncmin = poissonnll(counts, p0[:,np.newaxis]*f0 + p1[:,np.newaxis]*f1)
+    if full_output:
+        diagnostics = {'converged': ~(active | failed), 'nfev': nfev}
+        return np.column_stack((p0, p1)), fncmin, diagnostics
+    return np.column_stack((p0, p1)), fncmin
+
+# Data-dependent part of poissonnll (drops the constant gammaln term).
+def _reducednll(counts, pred):
+    return (pred - xlogy(counts, pred)).sum(axis=-1)
+
+#########################################################################
+# Batched equivalent of toy_2D_fits.mlfit1D.
+def batchmlfit1D(histsE, histsT, fracsE, fracsT, full_output=False):
+    counts = np.hstack((histsE, histsT))
+    fracs = [np.append(fracsE[0], fracsT[0]), np.append(fracsE[1], fracsT[1])]
+    return mlfit(counts, fracs, full_output=full_output)
+
+#########################################################################
+# Batched equivalent of toy_2D_fits.mlfit2D.
+def batchmlfit2D(hists2D, fracs2D, full_output=False):
+    counts = np.reshape(hists2D, (len(hists2D), -1))
+    return mlfit(counts, [fracs2D[0].ravel(), fracs2D[1].ravel()],
+                 full_output=full_output)
@@ -0,0 +1,266 @@
+import sys, os, time, json, argparse, tempfile, shutil, contextlib
+import subprocess
+from StringIO import StringIO
+import numpy as np
+import scipy.stats as st
+import pandas as pd
+import toy_2D_fits as t2d
+import batch_fits as bf
+import result_store as rs
+
+# Benchmark suite for the toy-MC pipeline. For each scale (number of
+# experiments and of events per isotope) this times every stage separately,
+# i.e. PDF sampling, histogramming, the four fits and result writing, in both
+# their batched form and the original per-experiment form (rvs,
+# np.histogram2d, leastsq, fmin_bfgs), where the latter only gets 'nlegacy'
+# experiments since it is slow. Timings are wall-clock and are written as
+# JSON records, which can be saved as a baseline and compared against later
+# to flag regressions. validate() checks statistically that the fits still
+# reproduce the reference ensemble in toy_fits_1000exp_1000n0_100n1.txt, so
+# that speedups aren't bought with changed physics, and checkimports() that
+# the compute modules still import quickly and without plotting libraries
+# (test_imports.py enforces the latter as a test).
+# From the terminal:
+#     python benchmarks.py --out bench.json --baseline baseline.json \
+#         --validate --imports
+
+# (nexpers, nevents0, nevents1) of each benchmark scale.
+SCALES = [(100, 1000, 100), (1000, 1000, 100), (100, 10000, 1000)]
+REFERENCE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'toy_fits_1000exp_1000n0_100n1.txt')
+# Modules of the compute path (generation, fitting, result writing), the 
+# seconds each may take to import in a fresh interpreter, and the packages 
+# they must not pull in.
+CORE_MODULES = ['physicsPDFs', 'batch_fits', 'unbinned_fits', 'result_store',
+                'result_cache', 'ensemble_stats', 'instrument', 'toy_2D_fits']
+IMPORT_BUDGET = 0.75
+HEAVY_MODULES = ['matplotlib', 'pandas']
+
+#########################################################################
+# Swallow stdout, e.g. the convergence messages fmin_bfgs prints.
+@contextlib.contextmanager
+def _quiet():
+    stdout, sys.stdout = sys.stdout, StringIO()
+    try:
+        yield
+    finally:
+        sys.stdout = stdout
+
+#########################################################################
+# Call func(*args), returning (wall-clock seconds, output).
+def timed(func, *args, **kwargs):
+    starttime = time.time()
+    output = func(*args, **kwargs)
+    return time.time() - starttime, output
+
+#########################################################################
+# Time each stage of the pipeline for one scale and return a list of records
+# (dicts with the scale, the stage name, the number of experiments the stage
+# processed, the total seconds and the seconds per experiment).
+def benchmarkscale(nexpers, nevents0, nevents1, nlegacy=50, seed=19):
+    nevents = (nevents0, nevents1)
+    pdfsE, pdfsT, fracsE, fracsT, fracs2D = t2d.maketemplates(12.0, 8.0, 260,
+                                                              170, 4, 4)
+    maxE, maxT = 12.0, 260.
+    nlegacy = min(nlegacy, nexpers)
+    rng = np.random.RandomState(seed)
+    records = []
+    def record(stage, nexps, seconds):
+        records.append({'nexpers': nexpers, 'nevents0': nevents0,
+                        'nevents1': nevents1, 'stage': stage,
+                        'nexps': nexps, 'seconds': seconds,
+                        'seconds_per_experiment': seconds/nexps})
+
+    # Sampling and histogramming
+    seconds, (dataE, dataT) = timed(t2d.throwexperiments, nexpers, nevents,
+                                    pdfsE, pdfsT, rng)
+    record('sampling', nexpers, seconds)
+    seconds, events = timed(lambda: [t2d.throwexperiment(nevents, pdfsE, pdfsT)
+                                     for i in xrange(nlegacy)])
+    record('sampling_rvs', nlegacy, seconds)
+    seconds, hists2D = timed(t2d.histogramexperiments, dataE, dataT, 4, 4,
+                             maxE, maxT)
+    record('histogramming', nexpers, seconds)
+    seconds, h = timed(lambda: [np.histogram2d(energies, times, bins=(4,4),
+                                               range=((0., maxE), (0., maxT)))
+                                for energies, times in events])
+    record('histogramming_np', nlegacy, seconds)
+    seconds, h = timed(t2d.throwbinned, nexpers, nevents, fracs2D, rng)
+    record('binned_generation', nexpers, seconds)
+
+    # Fits
+    histsE, histsT = hists2D.sum(axis=2), hists2D.sum(axis=1)
+    seconds, fits1D = timed(bf.batchfit1D, histsE, histsT, fracsE, fracsT)
+    record('fit1D', nexpers, seconds)
+    seconds, fits2D = timed(bf.batchfit2D, hists2D, fracs2D)
+    record('fit2D', nexpers, seconds)
+    seconds, mlfits1D = timed(bf.batchmlfit1D, histsE, histsT, fracsE, fracsT)
+    record('mlfit1D', nexpers, seconds)
+    seconds, mlfits2D = timed(bf.batchmlfit2D, hists2D, fracs2D)
+    record('mlfit2D', nexpers, seconds)
+    with _quiet():
+        legacy = [('fit1D_leastsq', lambda i: t2d.fit1D(histsE[i], histsT[i],
+                                                        fracsE, fracsT,
+                                                        nevents)),
+                  ('fit2D_leastsq', lambda i: t2d.fit2D(hists2D[i], fracs2D,
+                                                        nevents)),
+                  ('mlfit1D_bfgs', lambda i: t2d.mlfit1D(histsE[i], histsT[i],
+                                                         fracsE, fracsT,
+                                                         nevents)),
+                  ('mlfit2D_bfgs', lambda i: t2d.mlfit2D(hists2D[i], fracs2D,
+                                                         nevents))]
+        for stage, fit in legacy:
+            seconds, out = timed(lambda: [fit(i) for i in xrange(nlegacy)])
+            record(stage, nlegacy, seconds)
+
+    # Result writing
+    results = t2d.resultbuffer(nexpers)
+    seconds, out = timed(t2d.addblock, results, fits1D, fits2D, mlfits1D,
+                         mlfits2D)
+    record('filling', nexpers, seconds)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        seconds, out = timed(lambda: pd.DataFrame(results).to_csv(
+                os.path.join(tmpdir, 'results.csv')))
+        record('writing_csv', nexpers, seconds)
+        seconds, out = timed(rs.saveresults, os.path.join(tmpdir, 'store'),
+                             results)
+        record('writing_binary', nexpers, seconds)
+    finally:
+        shutil.rmtree(tmpdir)
+    return records
+
+#########################################################################
+# Run benchmarkscale for every scale in 'scales' and return all records. If
+# 'outfilename' is given, the records are also written there as JSON.
+def runbenchmarks(scales=SCALES, nlegacy=50, outfilename=''):
+    records = []
+    for nexpers, nevents0, nevents1 in scales:
+        records.extend(benchmarkscale(nexpers, nevents0, nevents1,
+                                      nlegacy=nlegacy))
+    if outfilename:
+        with open(outfilename, 'w') as outfile:
+            json.dump(records, outfile, indent=1, sort_keys=True)
+    return records
+
+#########################################################################
+# Compare benchmark records to baseline records (e.g. loaded from a JSON
+# file saved by an earlier runbenchmarks call). Every stage whose seconds per
+# experiment grew by more than a factor (1 + tolerance) is returned (and
+# printed) as a regression; stages missing from the baseline are ignored.
+def compare(records, baseline, tolerance=0.5):
+    key = lambda rec: (rec['nexpers'], rec['nevents0'], rec['nevents1'],
+                       rec['stage'])
+    reference = dict((key(rec), rec) for rec in baseline)
+    regressions = []
+    for rec in records:
+        if key(rec) not in reference: continue
+        ratio = rec['seconds_per_experiment'] / \
+            reference[key(rec)]['seconds_per_experiment']
+        if ratio > 1. + tolerance:
+            print 'Regression: %s at %s experiments x (%s, %s) events is ' \
+                '%.2f times slower than the baseline.' % \
+                (rec['stage'], rec['nexpers'], rec['nevents0'],
+                 rec['nevents1'], ratio)
+            regressions.append(dict(rec, ratio=ratio))
+    return regressions
+
+#########################################################################
+# Run 'nexpers' experiments with the reference ensemble's settings (1000
+# isotope-0 and 100 isotope-1 events, default shapes and binning) and test
+# every output column against the reference file with a two-sample KS test.
+# Returns a dict of KS p-values per column; columns with a p-value below
+# 'alpha' are printed as failures.
+def validate(nexpers=1000, seed=19, genmode='events', alpha=1e-3,
+             reference=REFERENCE):
+    refdata = rs.loadresults(reference)
+    with _quiet():
+        data = t2d.mainloop(nexpers, 1000, 100, seed=seed, genmode=genmode)
+    kspvals = {}
+    for name in t2d.RESULT_COLUMNS:
+        kspvals[name] = st.ks_2samp(data[name], refdata[name])[1]
+        if kspvals[name] < alpha:
+            print 'Validation failure: %s differs from the reference ' \
+                '(KS p-value %.3g).' % (name, kspvals[name])
+    return kspvals
+
+#########################################################################
+# Import each of 'modules' in a fresh interpreter 'nrepeats' times and check
+# that the fastest import takes at most 'budget' seconds and loads none of 
+# HEAVY_MODULES. Returns a dict mapping each module to (seconds, heavy 
+# modules loaded); failures are printed.
+def checkimports(modules=CORE_MODULES, budget=IMPORT_BUDGET, nrepeats=3):
+    script = 'import sys, time; starttime = time.time(); import %s; ' \
+        'print time.time() - starttime; ' \
+        'print " ".join(name for name in %r if name in sys.modules)'
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for module in modules:
+        times = []
+        for nrepeat in xrange(nrepeats):
+            output = subprocess.check_output([sys.executable, '-c', script % 
+                                              (module, HEAVY_MODULES)], 
+                                             cwd=here).splitlines()
+            times.append(float(output[-2]))
+        heavy = output[-1].split()
+        results[module] = (min(times), heavy)
+        if min(times) > budget:
+            print 'Import budget exceeded: %s takes %.3g s (budget %.3g s).' \
+                % (module, min(times), budget)
+        if heavy:
+            print 'Importing %s loads %s.' % (module, ', '.join(heavy))
+    return results
+
+#########################################################################
+#########################################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the toy-MC '
+                                     'pipeline stage by stage.')
+    parser.add_argument('--out', default='', help='write records as JSON')
+    parser.add_argument('--baseline', default='',
+                        help='JSON records to compare against')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='write the records to --baseline instead')
+    parser.add_argument('--tolerance', type=float, default=0.5)
+    parser.add_argument('--nlegacy', type=int, default=50)
+    parser.add_argument('--validate', action='store_true',
+                        help='also check against the reference ensemble')
+    parser.add_argument('--imports', action='store_true',
+                        help='also check the import time of the core modules')
+    parser.add_argument('--derivatives', action='store_true',
+                        help='also compare the per-experiment fitters with '
+                        'finite-difference and analytic derivatives')
+    args = parser.parse_args()
+
+    records = runbenchmarks(nlegacy=args.nlegacy, outfilename=args.out)
+    for rec in records:
+        print '%6s exps x (%5s, %4s) events  %-18s %.3g s/experiment' % \
+            (rec['nexpers'], rec['nevents0'], rec['nevents1'], rec['stage'],
+             rec['seconds_per_experiment'])
+    failed = False
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, 'w') as outfile:
+            json.dump(records, outfile, indent=1, sort_keys=True)
+    elif args.baseline:
+        with open(args.baseline) as infile:
+            failed = bool(compare(records, json.load(infile),
+                                  tolerance=args.tolerance))
+    if args.validate:
+        kspvals = validate()
+        failed = failed or min(kspvals.values()) < 1e-3
+        print 'Smallest KS p-value vs. reference: %.3g' % min(kspvals.values())
+    if args.imports:
+        imports = checkimports()
+        failed = failed or any(seconds > IMPORT_BUDGET or heavy 
+                               for seconds, heavy in imports.values())
+        for module in CORE_MODULES:
+            print 'import %-14s %.3g s' % (module, imports[module][0])
+    if args.derivatives:
+        with _quiet(): comparison = t2d.comparederivatives()
+        for fit in ['1D', '2D', '1DML', '2DML']:
+            cmp = comparison[fit]
+            print '%-5s nfev/experiment %6.1f -> %5.1f (+%.1f derivatives), ' \
+                '%.3g -> %.3g s/experiment' % \
+                (fit, cmp['nfev_before'], cmp['nfev_after'], cmp['njev_after'],
+                 cmp['time_before'], cmp['time_after'])
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,242 @@
+import sys, os, json
+import numpy as np
+import scipy.stats as st
+
+# Running summaries of a fake-fit ensemble, updated block by block from the
+# result buffers of toy_2D_fits.runexperiments without keeping any rows: for
+# each fit the mean and covariance of the fitted normalizations minus their
+# true values, for the chi-square fits also their pulls (residual/error) and
+# chi^2 values, and fixed-bin histograms of the pulls and p-values. Moments
+# are accumulated Welford-style: each block's mean and co-moment matrix are
+# computed with two passes over the block and combined with the running ones
+# by the pairwise update of Chan et al., which stays accurate for any number
+# of experiments.
+#
+# A summary takes the same, small amount of memory however many experiments
+# went into it, and summaries of disjoint sets of experiments (e.g. the
+# shards of a run) merge into the summary of their union: counts and
+# histograms exactly, moments up to floating-point rounding. savesummary and
+# loadsummary store them as JSON, which round-trips every float exactly.
+
+# Fits summarized by default, and the ones that report errors and p-values.
+FITS = ['1D', '2D', '1DML', '2DML', 'UML']
+CHI2FITS = ['1D', '2D']
+# Binning of the pull and p-value histograms (pulls outside PULL_RANGE go to
+# under- and overflow bins).
+PULL_BINS, PULL_RANGE = 50, (-5., 5.)
+PVAL_BINS = 20
+# EnsembleSummary attributes holding dicts of Moments and Histograms.
+GROUPS = ['residuals', 'pulls', 'chi2', 'pullhists', 'pvalhists']
+# Marks a JSON file as written by savesummary.
+SUMMARY_FORMAT = 'ensemble-summary-1'
+
+#########################################################################
+# Count, mean vector and co-moment matrix sum (x - mean)(x - mean)^T of
+# 'ndim'-dimensional values.
+class Moments(object):
+    def __init__(self, ndim):
+        self.count = 0
+        self.mean = np.zeros(ndim)
+        self.comoment = np.zeros((ndim, ndim))
+
+    # Add the rows of 'values' (shape (n, ndim)); rows with a NaN are skipped.
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[np.isfinite(values).all(axis=1)]
+        if not len(values): return
+        mean = values.mean(axis=0)
+        dev = values - mean
+        self._combine(len(values), mean, np.dot(dev.T, dev))
+
+    # Add everything accumulated by another Moments of the same dimension.
+    def merge(self, other):
+        if other.count: self._combine(other.count, other.mean, other.comoment)
+
+    def _combine(self, count, mean, comoment):
+        total = self.count + count
+        delta = mean - self.mean
+        self.comoment = self.comoment + comoment + \
+            np.outer(delta, delta)*(float(self.count)*count/total)
+        self.mean = self.mean + delta*(float(count)/total)
+        self.count = total
+
+    def cov(self, ddof=1):
+        return self.comoment/(self.count - ddof)
+
+    def std(self, ddof=1):
+        return np.sqrt(np.diag(self.cov(ddof)))
+
+    def todict(self):
+        return {'count': self.count, 'mean': self.mean.tolist(),
+                'comoment': self.comoment.tolist()}
+
+    @classmethod
+    def fromdict(cls, state):
+        moments = cls(len(state['mean']))
+        moments.count = state['count']
+        moments.mean = np.array(state['mean'], dtype=float)
+        moments.comoment = np.array(state['comoment'], dtype=float)
+        return moments
+
+#########################################################################
+# Histogram with 'nbins' equal bins on [low, high) plus an underflow
+# (counts[0]) and an overflow bin (counts[-1]). NaNs are not counted.
+class Histogram(object):
+    def __init__(self, nbins, low, high):
+        self.nbins, self.low, self.high = nbins, float(low), float(high)
+        self.counts = np.zeros(nbins + 2, dtype=np.int64)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        scaled = (values - self.low)*(self.nbins/(self.high - self.low))
+        idx = np.clip(np.floor(scaled), -1, self.nbins).astype(np.int64) + 1
+        self.counts += np.bincount(idx, minlength=self.nbins + 2)
+
+    def merge(self, other):
+        self.counts += other.counts
+
+    def edges(self):
+        return np.linspace(self.low, self.high, self.nbins + 1)
+
+    def todict(self):
+        return {'nbins': self.nbins, 'low': self.low, 'high': self.high,
+                'counts': self.counts.tolist()}
+
+    @classmethod
+    def fromdict(cls, state):
+        hist = cls(state['nbins'], state['low'], state['high'])
+        hist.counts[:] = state['counts']
+        return hist
+
+#########################################################################
+# Summary of an ensemble generated with true normalizations 'nevents'. Call
+# update() with every block of results (a buffer from
+# toy_2D_fits.resultbuffer) as it comes in; fits whose columns are NaN (e.g.
+# the unbinned fit in binned mode) are skipped.
+class EnsembleSummary(object):
+    def __init__(self, nevents, fits=FITS):
+        self.nevents = tuple(nevents)
+        self.fits = list(fits)
+        self.nexpers = 0
+        self.residuals = dict((fit, Moments(2)) for fit in self.fits)
+        chi2fits = [fit for fit in self.fits if fit in CHI2FITS]
+        self.pulls = dict((fit, Moments(2)) for fit in chi2fits)
+        self.chi2 = dict((fit, Moments(1)) for fit in chi2fits)
+        self.pullhists = dict(('n%s_%s' % (niso, fit),
+                               Histogram(PULL_BINS, *PULL_RANGE))
+                              for fit in chi2fits for niso in xrange(2))
+        self.pvalhists = dict((fit, Histogram(PVAL_BINS, 0., 1.))
+                              for fit in chi2fits)
+
+    def update(self, results):
+        self.nexpers += len(results)
+        for fit in self.fits:
+            resid = np.column_stack([results['n%s_%s' % (niso, fit)] -
+                                     self.nevents[niso] for niso in xrange(2)])
+            self.residuals[fit].update(resid)
+            if fit not in CHI2FITS: continue
+            pulls = resid/np.column_stack(
+                [np.sqrt(results['var%s%s_%s' % (niso, niso, fit)])
+                 for niso in xrange(2)])
+            self.pulls[fit].update(pulls)
+            self.chi2[fit].update(results['chi_' + fit][:,np.newaxis])
+            for niso in xrange(2):
+                self.pullhists['n%s_%s' % (niso, fit)].update(pulls[:,niso])
+            self.pvalhists[fit].update(results['pval_' + fit])
+
+    # Add another summary of the same kind (e.g. from another shard).
+    def merge(self, other):
+        if (other.nevents, other.fits) != (self.nevents, self.fits):
+            print 'Cannot merge summaries of different ensembles (nevents ' \
+                '%s, fits %s vs. %s, %s). Exiting!' % (
+                self.nevents, self.fits, other.nevents, other.fits)
+            sys.exit(1)
+        self.nexpers += other.nexpers
+        for group in GROUPS:
+            for name, stat in getattr(self, group).items():
+                stat.merge(getattr(other, group)[name])
+
+    def todict(self):
+        state = {'nevents': list(self.nevents), 'fits': self.fits,
+                 'nexpers': self.nexpers}
+        for group in GROUPS:
+            state[group] = dict((name, stat.todict())
+                                for name, stat in getattr(self, group).items())
+        return state
+
+    @classmethod
+    def fromdict(cls, state):
+        summary = cls(state['nevents'], state['fits'])
+        summary.nexpers = state['nexpers']
+        for group in GROUPS:
+            stats = getattr(summary, group)
+            for name, stat in stats.items():
+                stats[name] = type(stat).fromdict(state[group][name])
+        return summary
+
+    #####################################################################
+    # Dict of the ensemble's figures of merit, named like scan.summarize:
+    # for each fit and isotope the bias (mean residual), its standard error
+    # biaserr and the rms of the residuals about their mean, the correlation
+    # of the two fitted normalizations and, for the chi-square fits, the pull
+    # mean and width with the width's standard error pullwidtherr, the mean
+    # chi^2, and the p-value of a chi-square test of the p-value histogram
+    # against a uniform one.
+    def summary(self):
+        out = {'nexpers': self.nexpers}
+        for fit in self.fits:
+            moments = self.residuals[fit]
+            if moments.count < 2: continue
+            std = moments.std()
+            for niso in xrange(2):
+                key = 'n%s_%s' % (niso, fit)
+                out['bias_' + key] = moments.mean[niso]
+                out['biaserr_' + key] = std[niso]/np.sqrt(moments.count)
+                out['rms_' + key] = np.sqrt(moments.comoment[niso,niso]/
+                                            moments.count)
+            cov = moments.cov()
+            out['corr_' + fit] = cov[0,1]/np.sqrt(cov[0,0]*cov[1,1])
+            if fit not in CHI2FITS: continue
+            pulls = self.pulls[fit]
+            width = pulls.std()
+            for niso in xrange(2):
+                key = 'n%s_%s' % (niso, fit)
+                out['pullmean_' + key] = pulls.mean[niso]
+                out['pullwidth_' + key] = width[niso]
+                out['pullwidtherr_' + key] = width[niso]/np.sqrt(
+                    2.*(pulls.count - 1))
+            out['chi2mean_' + fit] = self.chi2[fit].mean[0]
+            out['pvaluniformity_' + fit] = st.chisquare(
+                self.pvalhists[fit].counts[1:-1])[1]
+        return out
+
+#########################################################################
+# Write 'summary' and a JSON-able dict 'meta' (e.g. the run's settings) to
+# the JSON file 'path'. The file is written next to 'path' and then moved
+# into place, so an interruption leaves any previous file intact.
+def savesummary(path, summary, meta=None):
+    tmppath = path + '.tmp'
+    with open(tmppath, 'w') as outfile:
+        json.dump({'format': SUMMARY_FORMAT, 'meta': meta or {},
+                   'summary': summary.todict()}, outfile)
+    os.rename(tmppath, path)
+
+# Read a file written by savesummary. Returns (summary, meta).
+def loadsummary(path):
+    with open(path) as infile: state = json.load(infile)
+    if state.get('format') != SUMMARY_FORMAT:
+        print '%s is not an ensemble summary. Exiting!' % path
+        sys.exit(1)
+    return EnsembleSummary.fromdict(state['summary']), state['meta']
+
+# Whether 'path' is a file written by savesummary.
+def issummary(path):
+    if not os.path.isfile(path): return False
+    with open(path) as infile:
+        if infile.read(1) != '{': return False
+        infile.seek(0)
+        try:
+            return json.load(infile).get('format') == SUMMARY_FORMAT
+        except ValueError:
+            return False
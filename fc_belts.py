@@ -0,0 +1,325 @@
+import sys, time, json, argparse, multiprocessing
+import numpy as np
+import batch_fits as bf
+
+# Feldman-Cousins confidence belts for the isotope-1 normalization n1, with
+# n0 as a nuisance parameter. For a true n1 the ordering statistic of an
+# experiment is the profile-likelihood ratio
+#     t(n1) = 2 [NLL(n1, n0hathat(n1)) - NLL(n1hat, n0hat)],
+# where n0hathat(n1) minimizes the binned Poisson NLL at fixed n1 and
+# (n1hat, n0hat) is the best fit with n1 kept physical (n1hat >= 0). At each
+# true n1 on a grid, toys are thrown and fitted as one batch, and experiments
+# are accepted in order of increasing t until a fraction 'cl' of them is in:
+# the critical value tcrit(n1) is that quantile of t, and the acceptance
+# region in the measured n1hat is the range [lo(n1), hi(n1)] covered by the
+# accepted toys. The belt is the table of (n1, tcrit, lo, hi); the
+# confidence interval for a measured n1hat is every true n1 whose acceptance
+# range contains it (see interval).
+#
+# Every grid point only needs the templates (shared through the cache behind
+# toy_2D_fits.maketemplates) and its own random streams (see pointrng), so
+# grid points are spread over a process pool. After the initial grid, the
+# belt is refined adaptively: an interval of the grid is bisected only where
+# a belt edge bends away from a straight line by more than 'tol' times the
+# toys' own uncertainty on it (near the physical boundary, say), since
+# elsewhere linear interpolation between grid points is already as good as
+# the toys allow.
+#
+# E.g.
+#     belt = buildbelt(np.arange(0., 201., 10.), ntoys=2000, cl=0.9)
+#     savebelt('belt_n1.json', belt)
+#     lower, upper = interval(loadbelt('belt_n1.json'), [3.2, 87.5, 130.])
+
+FITS = ['1D', '2D']
+COLUMNS = ['n1true', 'tcrit', 'lo', 'hi', 'loerr', 'hierr']
+
+#########################################################################
+# Random stream of toy 'i' at true value 'n1true'. Streams depend on the true
+# value rather than the grid index, so refining the grid leaves the toys of
+# existing points unchanged.
+def pointrng(seed, n1true, i):
+    return np.random.RandomState([seed, int(round(1000.*n1true)), i])
+
+# Bin counts (ntoys x nbins) of 'ntoys' toys with true normalizations
+# 'nevents' and (flattened) templates 'fracs'. With poisson=True every bin is
+# a Poisson draw around its expected content; otherwise each isotope
+# contributes a multinomial draw of exactly nevents[k] events, as in
+# toy_2D_fits.throwbinned.
+def throwtoys(ntoys, nevents, fracs, rngs, poisson=True):
+    if poisson:
+        mu = nevents[0]*fracs[0] + nevents[1]*fracs[1]
+        return np.array([rng.poisson(mu) for rng in rngs], dtype=float)
+    counts = np.zeros((ntoys, len(fracs[0])))
+    for niso in xrange(2):
+        pvals = fracs[niso]/fracs[niso].sum()
+        for j, rng in enumerate(rngs):
+            counts[j] += rng.multinomial(int(round(nevents[niso])), pvals)
+    return counts
+
+#########################################################################
+# Minimize the binned Poisson NLL of every row of 'counts' over n0 with n1
+# fixed at the row's value in 'n1' (Newton's method with step halving, as
+# in batch_fits.mlfit). Returns (n0hathat, nll) with nll in the convention
+# of batch_fits.poissonnll.
+def profilen0(counts, fracs, n1, maxiter=50, tol=1e-10, maxhalvings=30):
+    f0, f1 = fracs
+    n1 = np.broadcast_to(np.asarray(n1, dtype=float), (len(counts),))
+    fixed = n1[:,np.newaxis]*f1
+    n0 = np.maximum(counts.sum(axis=-1) - n1*f1.sum(), 1.)/f0.sum()
+    nll = bf.poissonnll(counts, n0[:,np.newaxis]*f0 + fixed)
+    active = np.ones(len(counts), dtype=bool)
+    for niter in xrange(maxiter):
+        idx = np.nonzero(active)[0]
+        if not len(idx): break
+        data, pred = counts[idx], n0[idx,np.newaxis]*f0 + fixed[idx]
+        ratio = data/pred
+        step = (f0*(1. - ratio)).sum(axis=-1)/(f0*f0*ratio/pred).sum(axis=-1)
+        scale = np.ones(len(idx))
+        for nhalve in xrange(maxhalvings):
+            trial = n0[idx] - scale*step
+            trialpred = trial[:,np.newaxis]*f0 + fixed[idx]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                trialnll = bf.poissonnll(data, trialpred)
+            bad = (trialpred <= 0).any(axis=-1) | \
+                ~(trialnll <= nll[idx] + 1e-12*(1. + np.abs(nll[idx])))
+            if not bad.any(): break
+            scale[bad] *= 0.5
+        n0[idx], nll[idx] = trial, trialnll
+        active[idx[np.abs(scale*step) <= tol*(np.abs(trial) + tol)]] = False
+    return n0, nll
+
+# Ordering statistic t(n1true) and physical best fit n1hat of every row of
+# 'counts'. Returns (t, n1hat).
+def teststat(counts, fracs, n1true):
+    pfit, nllbest = bf.mlfit(counts, fracs)
+    n1hat = pfit[:,1].copy()
+    negative = n1hat < 0
+    if negative.any():
+        nllbest[negative] = profilen0(counts[negative], fracs, 0.)[1]
+        n1hat[negative] = 0.
+    t = 2.*(profilen0(counts, fracs, n1true)[1] - nllbest)
+    return np.maximum(t, 0.), n1hat
+
+#########################################################################
+# Flattened templates of 'fit' ('2D': the 2-D histogram, '1D': the energy
+# and time projections side by side) for a configuration dict with the keys
+# of scan.DEFAULTS.
+def templates(config, fit='2D'):
+    import toy_2D_fits as t2d
+    if fit not in FITS:
+        print 'Unknown fit %s (expected one of %s). Exiting!' % (fit, FITS)
+        sys.exit(1)
+    fracsE, fracsT, fracs2D = t2d.maketemplates(
+        config['endpoint0'], config['endpoint1'], config['lifetime0'],
+        config['lifetime1'], config['nEbins'], config['nTbins'])[2:]
+    if fit == '2D': return [np.ravel(frac) for frac in fracs2D]
+    return [np.append(fracsE[k], fracsT[k]) for k in xrange(2)]
+
+# Counts of the 2-D histograms 'hists2D' in the layout of templates(fit).
+def fitcounts(hists2D, fit='2D'):
+    hists2D = np.asarray(hists2D, dtype=float)
+    if fit == '2D': return np.reshape(hists2D, (len(hists2D), -1))
+    return np.hstack((hists2D.sum(axis=2), hists2D.sum(axis=1)))
+
+#########################################################################
+# One row of the belt: throw and fit 'ntoys' toys at true n1 = n1true (the
+# 2-D histograms are generated and then projected as fitcounts does) and
+# return (n1true, tcrit, lo, hi, loerr, hierr). The edges lo and hi lie
+# halfway between the outermost accepted toy and the nearest rejected one
+# beyond it (or at the outermost accepted toy if nothing beyond it was
+# rejected, as happens at the n1hat = 0 boundary). loerr and hierr are their
+# Monte Carlo uncertainties, from the binomial spread of the number of toys
+# below each edge.
+def beltpoint(config, n1true, ntoys, cl, fit='2D', poisson=True, seed=19):
+    fracs2D = templates(config, '2D')
+    rngs = [pointrng(seed, n1true, i) for i in xrange(ntoys)]
+    hists = throwtoys(ntoys, (config['nevents0'], n1true), fracs2D, rngs,
+                      poisson)
+    counts = fitcounts(hists.reshape(ntoys, config['nEbins'],
+                                     config['nTbins']), fit)
+    t, n1hat = teststat(counts, templates(config, fit), n1true)
+    tcrit = np.percentile(t, 100.*cl, interpolation='higher')
+    accepted = t <= tcrit
+    lo, hi = n1hat[accepted].min(), n1hat[accepted].max()
+    below = n1hat[~accepted & (n1hat < lo)]
+    above = n1hat[~accepted & (n1hat > hi)]
+    if len(below): lo = 0.5*(lo + below.max())
+    if len(above): hi = 0.5*(hi + above.min())
+    ordered = np.sort(n1hat)
+    return (n1true, tcrit, lo, hi, _edgeerror(ordered, lo),
+            _edgeerror(ordered, hi))
+
+def _edgeerror(ordered, edge):
+    ntoys = len(ordered)
+    rank = np.searchsorted(ordered, edge)
+    spread = int(np.ceil(np.sqrt(rank*(1. - float(rank)/ntoys))))
+    return 0.5*(ordered[min(rank + spread, ntoys - 1)] -
+                ordered[max(rank - spread, 0)])
+
+# Pool workers can only call module-level functions with a single argument.
+def _beltpoint(args):
+    return beltpoint(*args)
+
+#########################################################################
+# Build the belt for true n1 on 'n1grid' (values >= 0) with n0 = nevents0
+# and the other settings ('shape': endpoints, lifetimes and binning) as in
+# scan.DEFAULTS, using 'ntoys' toys per grid point, on a pool of 'nworkers'
+# processes (default: all cores). Then up to 'refine' times, the grid
+# intervals next to a point where either edge deviates from the straight line
+# through its neighbours by more than 'tol' standard deviations of toy noise
+# (or where the lower edge comes off n1hat = 0), and that are wider than
+# 'minstep', are bisected and the new points are added. Returns the belt as
+# a dict of the settings plus the sorted columns in COLUMNS.
+def buildbelt(n1grid, nevents0=1000, ntoys=2000, cl=0.9, fit='2D',
+              poisson=True, seed=19, nworkers=None, refine=3, tol=3.,
+              minstep=1., **shape):
+    import scan
+    starttime = time.time()
+    config = dict(scan.DEFAULTS, nevents0=nevents0, **shape)
+    config.pop('nevents1')
+    if nworkers is None: nworkers = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(nworkers) if nworkers > 1 else None
+    evaluate = lambda n1s: (pool.map if pool else map)(
+        _beltpoint, [(config, float(n1), ntoys, cl, fit, poisson, seed)
+                     for n1 in n1s])
+    try:
+        rows = sorted(evaluate(sorted(set(n1grid))))
+        for npass in xrange(refine):
+            new = refinepoints(np.array(rows), tol, minstep)
+            if not len(new): break
+            print 'Refinement pass %s: %s new points.' % (npass + 1, len(new))
+            rows = sorted(rows + evaluate(new))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    rows = np.array(rows)
+    print 'Belt with %s points built in %.3g s.' % (len(rows),
+                                                   time.time() - starttime)
+    belt = dict(config=config, cl=cl, ntoys=ntoys, fit=fit, poisson=poisson,
+                seed=seed)
+    for ncol, name in enumerate(COLUMNS): belt[name] = rows[:,ncol]
+    return belt
+
+# Midpoints of the grid intervals of a belt table (rows in the order of
+# COLUMNS) that need refining: those next to a grid point where an edge is
+# more than 'tol' standard deviations away from the line through its
+# neighbours, or where the lower edge leaves the n1hat = 0 boundary, and wider
+# than 'minstep'.
+def refinepoints(rows, tol, minstep):
+    n1 = rows[:,0]
+    flagged = np.zeros(len(n1), dtype=bool)
+    weight = (n1[1:-1] - n1[:-2])/(n1[2:] - n1[:-2])
+    for edge, err in [(rows[:,2], rows[:,4]), (rows[:,3], rows[:,5])]:
+        line = edge[:-2] + weight*(edge[2:] - edge[:-2])
+        noise = np.sqrt(err[1:-1]**2 + ((1. - weight)*err[:-2])**2 +
+                        (weight*err[2:])**2)
+        flagged[1:-1] |= np.abs(edge[1:-1] - line) > tol*np.maximum(noise,
+                                                                   1e-9)
+    leaves = np.nonzero((rows[:-1,2] <= 0) & (rows[1:,2] > 0))[0]
+    flagged[leaves] = flagged[leaves + 1] = True
+    new = []
+    for k in np.nonzero(flagged)[0]:
+        for a, b in [(k - 1, k), (k, k + 1)]:
+            if a >= 0 and b < len(n1) and n1[b] - n1[a] > minstep:
+                new.append(0.5*(n1[a] + n1[b]))
+    return sorted(set(new))
+
+#########################################################################
+# Write a belt to / read it from a JSON file.
+def savebelt(path, belt):
+    state = dict(belt)
+    for name in COLUMNS: state[name] = np.asarray(belt[name]).tolist()
+    with open(path, 'w') as outfile:
+        json.dump(state, outfile, indent=1, sort_keys=True)
+
+def loadbelt(path):
+    with open(path) as infile: belt = json.load(infile)
+    for name in COLUMNS: belt[name] = np.array(belt[name])
+    return belt
+
+#########################################################################
+# Confidence intervals (lower, upper) for measured values 'n1hat' (clipped
+# at 0, like the fits in the belt): the range of true n1 whose acceptance
+# range [lo, hi] contains n1hat, interpolating the edges linearly between
+# grid points. The edges are made non-decreasing first, so toy noise can't
+# turn an interval into several pieces. A lower limit at the bottom of the
+# grid means the interval is an upper limit; an upper limit at the top of
+# the grid means the grid wasn't wide enough.
+def interval(belt, n1hat):
+    n1hat = np.maximum(np.atleast_1d(np.asarray(n1hat, dtype=float)), 0.)
+    n1 = belt['n1true']
+    lo = np.maximum.accumulate(belt['lo'])
+    hi = np.maximum.accumulate(belt['hi'])
+    # hi(n1) = n1hat gives the lower limit, lo(n1) = n1hat the upper one.
+    # np.interp needs increasing x, so flat stretches are dropped.
+    lower = _inverse(hi, n1, n1hat)
+    upper = _inverse(lo, n1, n1hat)
+    lower[n1hat <= hi[0]] = n1[0]
+    upper[n1hat >= lo[-1]] = n1[-1]
+    return lower, upper
+
+def _inverse(edge, n1, values):
+    keep = np.append(np.diff(edge) > 0, True)
+    return np.interp(values, edge[keep], n1[keep])
+
+#########################################################################
+# Coverage of a belt at true n1 = n1true: throw 'ntoys' fresh toys (seeded
+# apart from the belt's own), fit them, look up their intervals and return
+# the fraction that contain n1true (to compare with belt['cl']).
+def checkcoverage(belt, n1true, ntoys=1000, seed=None):
+    config, fit = belt['config'], belt['fit']
+    if seed is None: seed = belt['seed'] + 1
+    rngs = [pointrng(seed, n1true, i) for i in xrange(ntoys)]
+    hists = throwtoys(ntoys, (config['nevents0'], n1true),
+                      templates(config, '2D'), rngs, belt['poisson'])
+    counts = fitcounts(hists.reshape(ntoys, config['nEbins'],
+                                     config['nTbins']), fit)
+    n1hat = np.maximum(bf.mlfit(counts, templates(config, fit))[0][:,1], 0.)
+    lower, upper = interval(belt, n1hat)
+    return np.mean((lower <= n1true) & (n1true <= upper))
+
+#########################################################################
+#########################################################################
+if __name__ == '__main__':
+    # 'lookup' turns measured values into intervals with a saved belt;
+    # anything else builds a belt.
+    if len(sys.argv) > 1 and sys.argv[1] == 'lookup':
+        parser = argparse.ArgumentParser(prog='fc_belts.py lookup',
+                                         description='Intervals from a belt.')
+        parser.add_argument('beltfile')
+        parser.add_argument('n1hat', type=float, nargs='+')
+        args = parser.parse_args(sys.argv[2:])
+        belt = loadbelt(args.beltfile)
+        lower, upper = interval(belt, args.n1hat)
+        for value, low, up in zip(args.n1hat, lower, upper):
+            print 'n1hat = %8.3f:  %.3f <= n1 <= %.3f (%g%% CL)' % \
+                (value, low, up, 100.*belt['cl'])
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description='Build a Feldman-Cousins '
+                                     'belt for n1 over a grid of true values.')
+    parser.add_argument('outfilename')
+    parser.add_argument('--n1', default='0:200:10', metavar='START:STOP:STEP',
+                        help='initial grid of true n1 (STOP included)')
+    parser.add_argument('--nevents0', type=int, default=1000)
+    parser.add_argument('--ntoys', type=int, default=2000)
+    parser.add_argument('--cl', type=float, default=0.9)
+    parser.add_argument('--fit', default='2D', choices=FITS)
+    parser.add_argument('--fixed', action='store_true',
+                        help='throw a fixed number of events per isotope '
+                        'instead of Poisson bin counts')
+    parser.add_argument('--refine', type=int, default=3)
+    parser.add_argument('--tol', type=float, default=3.,
+                        help='refinement threshold, in standard deviations '
+                        'of toy noise')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=19)
+    args = parser.parse_args()
+
+    start, stop, step = [float(part) for part in args.n1.split(':')]
+    belt = buildbelt(np.arange(start, stop + 0.5*step, step),
+                     nevents0=args.nevents0, ntoys=args.ntoys, cl=args.cl,
+                     fit=args.fit, poisson=not args.fixed, seed=args.seed,
+                     nworkers=args.workers, refine=args.refine, tol=args.tol)
+    savebelt(args.outfilename, belt)
@@ -0,0 +1,258 @@
+import sys, argparse
+import numpy as np
+from scipy.special import gammaln, chdtri
+import batch_fits as bf
+
+# Grid scans of the fit objectives for many experiments at once, for
+# confidence intervals and regions that don't rely on the Gaussian errors the
+# fitters report (with (n0, n1) as strongly anticorrelated as they are here,
+# those can be a poor guide). For every experiment the binned Poisson NLL
+# or the chi^2 is evaluated on an npoints x npoints grid of (n0, n1) around
+# its best fit, and from that grid come profile-likelihood intervals for
+# each normalization and the 2-D confidence region.
+#
+# The model is linear, mu_b = n0 f0_b + n1 f1_b, so everything that depends
+# only on the data is computed once per experiment and the grid is handled by
+# broadcasting over (experiment x grid point x bin):
+#     NLL     = n0 S0 + n1 S1 - sum_b d_b log(mu_b) + sum_b log(d_b!)
+#     Pearson = sum_b d_b^2/mu_b - 2 sum_b d_b + n0 S0 + n1 S1
+#     Neyman  = sum_b w_b d_b^2 - 2 (n0 T0 + n1 T1) + n^T M n,
+# with S_k = sum_b f_k,b, w_b = 1/max(d_b, 1) (empty bins get unit error, as
+# in batch_fits.chi2fit), T_k = sum_b w_b d_b f_k,b and M = F^T diag(w) F. 
+# Only log(mu) or 1/mu needs a pass over the bins, and its contraction with 
+# the data is one matrix product per experiment; the Neyman chi^2 needs none.
+# Experiments are processed in chunks of at most 'chunkbytes' of scratch 
+# memory, so e.g. a 201 x 201 grid of a 16-bin fit costs ~5 MB and ~10 ms per
+# experiment.
+#
+# E.g. for the 2-D ML fit of a block of experiments:
+#     grid = scan2D(hists2D, fracs2D)
+#     lo, hi = profileinterval(grid['n0grid'], profile(grid['delta'], 0),
+#                              UP['nll'])
+#     n1lo, n1hi = contour(grid['n1grid'], grid['delta'], level('nll'))
+
+KINDS = ['nll', 'pearson', 'neyman']
+# Change of each objective that corresponds to one standard deviation.
+UP = {'nll': 0.5, 'pearson': 1., 'neyman': 1.}
+CHUNKBYTES = 2**27
+
+#########################################################################
+# Values of the objective 'kind' for every row of 'counts' (nexps x nbins)
+# on the grids n0grid (nexps x n0pts) and n1grid (nexps x n1pts): an array
+# of shape (nexps, n0pts, n1pts). Grid points with a non-positive prediction
+# in some bin get +inf.
+def gridvalues(counts, fracs, n0grid, n1grid, kind='nll',
+               chunkbytes=CHUNKBYTES):
+    if kind not in KINDS:
+        print 'Unknown objective %s (expected one of %s). Exiting!' % \
+            (kind, KINDS)
+        sys.exit(1)
+    counts = np.atleast_2d(np.asarray(counts, dtype=float))
+    f0, f1 = np.asarray(fracs[0], dtype=float), np.asarray(fracs[1],
+                                                           dtype=float)
+    nexps, nbins = counts.shape
+    n0grid, n1grid = np.atleast_2d(n0grid), np.atleast_2d(n1grid)
+    n0pts, n1pts = n0grid.shape[1], n1grid.shape[1]
+    # Data-only terms.
+    sums = n0grid[:,:,np.newaxis]*f0.sum() + n1grid[:,np.newaxis,:]*f1.sum()
+    if kind == 'neyman':
+        w = 1./np.maximum(counts, 1.)
+        m00, m01, m11 = [(w*fa*fb).sum(axis=-1)[:,np.newaxis,np.newaxis]
+                         for fa, fb in [(f0, f0), (f0, f1), (f1, f1)]]
+        t0, t1 = [(w*counts*fa).sum(axis=-1)[:,np.newaxis,np.newaxis]
+                  for fa in (f0, f1)]
+        n0, n1 = n0grid[:,:,np.newaxis], n1grid[:,np.newaxis,:]
+        return (w*counts*counts).sum(axis=-1)[:,np.newaxis,np.newaxis] - \
+            2.*(t0*n0 + t1*n1) + m00*n0*n0 + 2.*m01*n0*n1 + m11*n1*n1
+    if kind == 'nll':
+        weights = counts
+        const = gammaln(counts + 1.).sum(axis=-1)
+    else:
+        weights = counts*counts
+        const = -2.*counts.sum(axis=-1)
+
+    values = np.empty((nexps, n0pts, n1pts))
+    nchunk = max(1, int(chunkbytes // (16*n0pts*n1pts*nbins)))
+    for first in xrange(0, nexps, nchunk):
+        rows = slice(first, first + nchunk)
+        mu = (n0grid[rows,:,np.newaxis,np.newaxis]*f0 +
+              n1grid[rows,np.newaxis,:,np.newaxis]*f1)
+        bad = (mu <= 0).any(axis=-1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            perbin = np.log(mu) if kind == 'nll' else 1./mu
+        nrows = len(mu)
+        term = np.matmul(perbin.reshape(nrows, n0pts*n1pts, nbins),
+                         weights[rows,:,np.newaxis]).reshape(nrows, n0pts,
+                                                             n1pts)
+        sign = -1. if kind == 'nll' else 1.
+        values[rows] = sums[rows] + sign*term + \
+            const[rows,np.newaxis,np.newaxis]
+        values[rows][bad] = np.inf
+    return values
+
+#########################################################################
+# Scan the objective 'kind' of every row of 'counts' on an npoints x npoints
+# grid spanning nsigma Gaussian standard deviations either side of the row's
+# best fit (from batch_fits.mlfit for 'nll', batch_fits.chi2fit otherwise;
+# with odd npoints the best fit is the centre of the grid). Returns a dict
+# with the best fits 'pfit' (nexps x 2), their Gaussian errors 'sigma'
+# (nexps x 2), the grids 'n0grid' and 'n1grid' (nexps x npoints each) and
+# 'delta', the objective minus its value at the best fit
+# (nexps x npoints x npoints).
+def scan(counts, fracs, kind='nll', npoints=201, nsigma=4.,
+         chunkbytes=CHUNKBYTES):
+    counts = np.atleast_2d(np.asarray(counts, dtype=float))
+    f0, f1 = np.asarray(fracs[0], dtype=float), np.asarray(fracs[1],
+                                                           dtype=float)
+    if kind == 'nll':
+        pfit = bf.mlfit(counts, fracs)[0]
+        pred = pfit[:,0,np.newaxis]*f0 + pfit[:,1,np.newaxis]*f1
+        w = counts/pred**2
+        hess = np.empty((len(counts), 2, 2))
+        hess[:,0,0] = (w*f0*f0).sum(axis=-1)
+        hess[:,0,1] = hess[:,1,0] = (w*f0*f1).sum(axis=-1)
+        hess[:,1,1] = (w*f1*f1).sum(axis=-1)
+        cov = np.linalg.inv(hess)
+    else:
+        pfit, cov = bf.chi2fit(counts, fracs,
+                               PearsonErrs=(kind == 'pearson'))[:2]
+    sigma = np.sqrt(np.diagonal(cov, axis1=1, axis2=2))
+    unit = np.linspace(-nsigma, nsigma, npoints)
+    n0grid = pfit[:,0,np.newaxis] + sigma[:,0,np.newaxis]*unit
+    n1grid = pfit[:,1,np.newaxis] + sigma[:,1,np.newaxis]*unit
+    atfit = gridvalues(counts, fracs, pfit[:,:1], pfit[:,1:], kind)[:,0,0]
+    delta = gridvalues(counts, fracs, n0grid, n1grid, kind, chunkbytes) - \
+        atfit[:,np.newaxis,np.newaxis]
+    return {'pfit': pfit, 'sigma': sigma, 'n0grid': n0grid,
+            'n1grid': n1grid, 'delta': delta}
+
+# scan for the 1-D pair of histograms, as in batch_fits.batchfit1D.
+def scan1D(histsE, histsT, fracsE, fracsT, kind='nll', **kwargs):
+    counts = np.hstack((histsE, histsT))
+    fracs = [np.append(fracsE[0], fracsT[0]), np.append(fracsE[1], fracsT[1])]
+    return scan(counts, fracs, kind, **kwargs)
+
+# scan for the 2-D histograms, as in batch_fits.batchfit2D.
+def scan2D(hists2D, fracs2D, kind='nll', **kwargs):
+    counts = np.reshape(hists2D, (len(hists2D), -1))
+    return scan(counts, [fracs2D[0].ravel(), fracs2D[1].ravel()], kind,
+                **kwargs)
+
+#########################################################################
+# Profile of 'delta' (nexps x n0pts x n1pts) for parameter 'niso': the
+# minimum over the other parameter at every grid value of this one.
+def profile(delta, niso):
+    return delta.min(axis=2 - niso)
+
+# Interval of each experiment where its profile (nexps x npts, over the grid
+# 'grid') is at most 'level', e.g. UP[kind] for 1 sigma or 4*UP[kind] for
+# 2 sigma, found by linear interpolation between grid points. Returns
+# (lo, hi), NaN where the interval runs off the end of the grid. The
+# objectives are convex in (n0, n1), and so are their profiles, so each
+# interval is a single piece.
+def profileinterval(grid, prof, level):
+    return _crossings(grid, prof, level)
+
+# Level of 'delta' that bounds the 2-D confidence region with coverage 'cl'
+# for objective 'kind' (2 parameters; e.g. 2.30 for a chi^2 at 68.3%).
+def level(kind, cl=0.6827):
+    return UP[kind]*chdtri(2, 1. - cl)
+
+# The 2-D region where 'delta' is at most 'level', as the range of n1 it
+# covers at every n0 grid value: returns (n1lo, n1hi), each of shape
+# (nexps, n0pts), NaN for rows of the grid that miss the region (and where
+# it runs off the grid). Tracing n1lo and then n1hi backwards gives the
+# contour; since the region is convex it's the whole boundary.
+def contour(n1grid, delta, level):
+    nexps, n0pts, n1pts = delta.shape
+    grid = np.repeat(n1grid, n0pts, axis=0)
+    lo, hi = _crossings(grid, delta.reshape(nexps*n0pts, n1pts), level)
+    return lo.reshape(nexps, n0pts), hi.reshape(nexps, n0pts)
+
+# For each row of 'values' (on the matching row of 'grid'), the first and
+# last positions where it crosses 'level', interpolating linearly between
+# the last point above and the first point below it on either side.
+def _crossings(grid, values, level):
+    nrows, npts = values.shape
+    inside = values <= level
+    rows = np.arange(nrows)
+    first = np.argmax(inside, axis=1)
+    last = npts - 1 - np.argmax(inside[:,::-1], axis=1)
+    lo, hi = np.empty(nrows), np.empty(nrows)
+    lo.fill(np.nan)
+    hi.fill(np.nan)
+    ok = inside.any(axis=1) & (first > 0)
+    a, b = first[ok] - 1, first[ok]
+    lo[ok] = _interp(grid[rows[ok],a], grid[rows[ok],b],
+                     values[rows[ok],a], values[rows[ok],b], level)
+    ok = inside.any(axis=1) & (last < npts - 1)
+    a, b = last[ok], last[ok] + 1
+    hi[ok] = _interp(grid[rows[ok],a], grid[rows[ok],b],
+                     values[rows[ok],a], values[rows[ok],b], level)
+    return lo, hi
+
+def _interp(xa, xb, ya, yb, level):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = np.where(np.isfinite(ya) & np.isfinite(yb),
+                        (level - ya)/(yb - ya), 0.5)
+    return xa + frac*(xb - xa)
+
+#########################################################################
+# Coverage check: scan 'nexpers' binned experiments (2-D histograms) with
+# objective 'kind' and return, for each normalization, the fraction of
+# experiments whose 1-sigma profile interval contains the true value and the
+# fraction whose Gaussian interval pfit +- sigma does, plus the fraction
+# whose 68.3% 2-D region contains the true (n0, n1).
+def coverage(nexpers=1000, nevents0=1000, nevents1=100, kind='nll',
+             npoints=201, seed=19, **shape):
+    import scan as sc
+    import toy_2D_fits as t2d
+    config = dict(sc.DEFAULTS, nevents0=nevents0, nevents1=nevents1, **shape)
+    fracs2D = t2d.maketemplates(config['endpoint0'], config['endpoint1'],
+                                config['lifetime0'], config['lifetime1'],
+                                config['nEbins'], config['nTbins'])[4]
+    rngs = [t2d.experimentrng(seed, i) for i in xrange(nexpers)]
+    hists2D = t2d.throwbinned(nexpers, (nevents0, nevents1), fracs2D,
+                              rngs=rngs)
+    grid = scan2D(hists2D, fracs2D, kind, npoints=npoints)
+    truth = np.array([nevents0, nevents1], dtype=float)
+    out = {}
+    for niso in xrange(2):
+        gridk = grid['n%sgrid' % niso]
+        lo, hi = profileinterval(gridk, profile(grid['delta'], niso),
+                                 UP[kind])
+        out['profile_n%s' % niso] = np.mean((lo <= truth[niso]) &
+                                            (truth[niso] <= hi))
+        out['gaussian_n%s' % niso] = np.mean(
+            np.abs(grid['pfit'][:,niso] - truth[niso]) <=
+            grid['sigma'][:,niso])
+    # True point inside the region: evaluate delta there directly.
+    attruth = gridvalues(np.reshape(hists2D, (nexpers, -1)),
+                         [fracs2D[0].ravel(), fracs2D[1].ravel()],
+                         np.repeat([[truth[0]]], nexpers, axis=0),
+                         np.repeat([[truth[1]]], nexpers, axis=0), kind)
+    atfit = gridvalues(np.reshape(hists2D, (nexpers, -1)),
+                       [fracs2D[0].ravel(), fracs2D[1].ravel()],
+                       grid['pfit'][:,:1], grid['pfit'][:,1:], kind)
+    out['region'] = np.mean((attruth - atfit)[:,0,0] <= level(kind))
+    return out
+
+#########################################################################
+#########################################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Coverage of profile '
+                                     'intervals from grid scans vs. Gaussian '
+                                     'errors.')
+    parser.add_argument('nexperiments', type=int)
+    parser.add_argument('nevents0', type=int)
+    parser.add_argument('nevents1', type=int)
+    parser.add_argument('--kind', default='nll', choices=KINDS)
+    parser.add_argument('--npoints', type=int, default=201)
+    parser.add_argument('--seed', type=int, default=19)
+    args = parser.parse_args()
+
+    for name, value in sorted(coverage(args.nexperiments, args.nevents0,
+                                       args.nevents1, kind=args.kind,
+                                       npoints=args.npoints,
+                                       seed=args.seed).items()):
+        print '%-12s %.4f' % (name, value)
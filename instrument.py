@@ -0,0 +1,88 @@
+import sys, time, cProfile, pstats
+
+# Instrumentation for long fake-fit runs: a progress reporter that prints the
+# throughput and the estimated time left every so often (instead of one line
+# per experiment), a list of hooks called with the time spent in each stage of
+# toy_2D_fits.runexperiments, and a wrapper that runs a function under
+# cProfile. The per-fit convergence flags, call counts and timings themselves
+# are stored as output columns; see toy_2D_fits.DIAGNOSTIC_COLUMNS.
+
+#########################################################################
+# Reports how far a run of 'ntotal' experiments has got. Call advance(n) as
+# experiments finish; at most every 'interval' seconds (and once at the end)
+# this prints a line like
+#     Experiments 12000/100000 (12.0%), 2350.1 exp/s, ETA 0:00:37
+# 'ndone' is the number of experiments already finished before this run
+# started (e.g. when resuming from a checkpoint); they don't count towards
+# the rate.
+class ProgressReporter(object):
+    def __init__(self, ntotal, ndone=0, interval=10., stream=None):
+        self.ntotal, self.ndone, self.interval = ntotal, ndone, interval
+        self.stream = stream or sys.stdout
+        self.nstart = ndone
+        self.starttime = self.lasttime = time.time()
+
+    def advance(self, n):
+        self.ndone += n
+        now = time.time()
+        if now - self.lasttime >= self.interval or self.ndone >= self.ntotal:
+            self.lasttime = now
+            self.report(now)
+
+    # Experiments per second since this reporter was made.
+    def rate(self, now=None):
+        elapsed = (now or time.time()) - self.starttime
+        return (self.ndone - self.nstart)/elapsed if elapsed > 0 else 0.
+
+    def report(self, now=None):
+        rate = self.rate(now)
+        line = 'Experiments %s/%s (%.1f%%), %.1f exp/s' % \
+            (self.ndone, self.ntotal, 100.*self.ndone/max(self.ntotal, 1),
+             rate)
+        if rate > 0 and self.ndone < self.ntotal:
+            line += ', ETA %s' % formatseconds((self.ntotal - self.ndone)/rate)
+        self.stream.write(line + '\n')
+        self.stream.flush()
+
+#########################################################################
+# Format a number of seconds as h:mm:ss.
+def formatseconds(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+#########################################################################
+# Stage hooks. Every hook added here is called as
+#     hook(stage, start, stop, seconds)
+# after each stage of work on experiments start, ..., stop - 1, where 'stage'
+# is one of 'generate', 'fit1D', 'fit2D', 'mlfit1D', 'mlfit2D', 'umlfit' or
+# 'fill'.
+# Hooks run in the process that did the work, so with nworkers > 1 they must
+# be added before the pool is started (and then run in the workers). E.g.
+#     totals = collections.Counter()
+#     instrument.addhook(lambda stage, start, stop, sec:
+#                        totals.update({stage: sec}))
+HOOKS = []
+
+def addhook(hook):
+    HOOKS.append(hook)
+
+def removehook(hook):
+    HOOKS.remove(hook)
+
+def runhooks(stage, start, stop, seconds):
+    for hook in HOOKS: hook(stage, start, stop, seconds)
+
+#########################################################################
+# Call func(*args, **kwargs) under cProfile, save the statistics to
+# 'statspath' (readable with pstats or e.g. snakeviz), print the 'nlines'
+# most expensive calls by cumulative time, and return what func returned.
+# Only the calling process is profiled; pool workers are not.
+def profiled(statspath, func, *args, **kwargs):
+    nlines = kwargs.pop('nlines', 25)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        profiler.dump_stats(statspath)
+        pstats.Stats(statspath).sort_stats('cumulative').print_stats(nlines)
@@ -1,25 +1,58 @@
-import sys
+import sys, time, collections
 import numpy as np
-import matplotlib.pyplot as plt
 import scipy.stats as st
 
 np.random.seed(19)
 
-# Both of the PDFs below have nearly identical functionality and could 
-# therefore inherit from an intermediate parent class. If you add any more PDFs
-# that have the same forms as those here, you should consider adding a base 
-# class between the final physics PDFs and their (grand)parent class 
-# "rv_continuous."
+# Both of the PDFs below have nearly identical functionality, so what they 
+# share (everything that only needs _cdf and _ppf) lives in the intermediate
+# parent class "BinnedPDF" between them and their grandparent class 
+# "rv_continuous." If you add any more PDFs that have the same forms as those
+# here, inherit from BinnedPDF too.
+
+class BinnedPDF(st.rv_continuous):
+    """
+    Intermediate parent class for the physics PDFs below. Subclasses must
+    overload _pdf, _cdf and _ppf. This inherits from the 
+    scipy.stats.rv_continuous class.
+    """
+    # PDFs kept in the template cache (see cachedtemplate) are shared by every
+    # caller, so they are marked read-only there and their setters refuse to 
+    # change them. Make a new PDF with the shape you want instead.
+    readonly = False
+    def checkwritable(self):
+        if self.readonly:
+            print '%s is shared through the template cache and cannot be ' \
+                'changed; make a new one instead. Exiting!' % \
+                type(self).__name__
+            sys.exit(1)
+    # Draw 'size' values in one array operation by pushing uniform draws 
+    # through _ppf. 'size' can be a shape tuple, e.g. (nexpers, nevents).
+    def fastrvs(self, size=1, rng=np.random):
+        return self._ppf(rng.random_sample(size))
+    # Return the fractional bin occupancy vector for a given binning. All bin
+    # edges are evaluated in one vectorized cdf call. As always, the first 
+    # bin also collects any probability below binrange[0].
+    def binfractionvector(self, nbins, binrange):
+        if not isinstance(binrange, tuple) or len(binrange) != 2:
+            print 'binfractionvector expects binrange to be a 2-tuple. Exiting!'
+            sys.exit(1)
+        edges = np.linspace(binrange[0], binrange[1], nbins + 1)
+        binfracvec = np.diff(np.append(0., self.cdf(edges[1:])))
+        # Simple check
+        if sum(binfracvec) != 1.0: print 'Warning: sum of binfracvec = %s' % \
+                sum(binfracvec)
+        return binfracvec
 
 # You can make your own PDF by inheriting from rv_continuous in scipy.stats.
 # Since the parabolic PDF I'm defining here isn't sensible as a PDF outside of
 # [0,endpoint], I'm setting the inherited "a" to 0 and "b" to endpoint.
-class ParabolicPDF(st.rv_continuous):
+class ParabolicPDF(BinnedPDF):
     """
     Create a pdf characterized by the function:
        -(6/endpoint**3)*x*(x - endpoint)
-    on the domain 0 <= x <= endpoint. This inherits from the
-    scipy.stats.rv_continuous class.
+    on the domain 0 <= x <= endpoint. This inherits from BinnedPDF (and so
+    from the scipy.stats.rv_continuous class).
     """
     def __init__(self, endpoint):
         if endpoint <= 0:
@@ -34,29 +67,25 @@ class ParabolicPDF(st.rv_continuous):
     # trying to call sampleplot()).
     def _pdf(self,x):
         return -self.normfactor*x*(x - self.endpoint)
+    # Overload the default _cdf and _ppf, too. Without these rv_continuous 
+    # falls back on numerically integrating _pdf (for cdf) and root-finding on
+    # that integral (for ppf and therefore rvs), which is very slow. With 
+    # u = x/endpoint the cdf is the cubic 3u^2 - 2u^3, whose inverse on [0,1] 
+    # is u = 1/2 - sin(arcsin(1 - 2q)/3).
+    def _cdf(self,x):
+        u = x/self.endpoint
+        return u*u*(3. - 2.*u)
+    def _ppf(self,q):
+        return self.endpoint*(0.5 - np.sin(np.arcsin(1. - 2.*q)/3.))
     # You can change the endpoint whenever you like.
     def setendpoint(self,newendpoint):
+        self.checkwritable()
         self.endpoint = float(newendpoint)
         self.b = newendpoint
         self.normfactor = 6./(self.endpoint**3)
-    # Return the fractional bin occupancy vector for a given binning
-    def binfractionvector(self, nbins, binrange):
-        if not isinstance(binrange, tuple) or len(binrange) != 2:
-            print 'binfractionvector expects binrange to be a 2-tuple. Exiting!'
-            sys.exit(1)
-        binwidth = float(binrange[1] - binrange[0]) / nbins
-        binfracvec = np.zeros(nbins)
-        prevcdf = 0.
-        for i in xrange(1,nbins+1): # This counts inclusively over {1,nbins}
-            uppercdf = self.cdf(binrange[0] + i*binwidth)
-            binfracvec[i-1] = uppercdf - prevcdf
-            prevcdf = uppercdf
-        # Simple check
-        if sum(binfracvec) != 1.0: print 'Warning: sum of binfracvec = %s' % \
-                sum(binfracvec)
-        return binfracvec
     # This is for debugging. It plots a histogram of 100 draws from the pdf.
     def sampleplot(self,ndraws=100,nbins=10):
+        import matplotlib.pyplot as plt
         hist, bins = np.histogram(self.rvs(size=ndraws), bins=nbins,
                                   range=(0,self.endpoint))
         histarea = float(ndraws)*(float(self.endpoint)/nbins)
@@ -70,6 +99,7 @@ class ParabolicPDF(st.rv_continuous):
     # This is the same as sampleplot, except now we're using the PyPlot 
     # histogram interface instead of the numpy histogram passed to a bar graph.
     def sampleplot2(self,ndraws=100,nbins=10):
+        import matplotlib.pyplot as plt
         myhist = plt.hist(self.rvs(size=ndraws), bins=nbins, 
                         range=(0,self.endpoint), histtype='stepfilled', 
                         alpha=0.8, color='green')
@@ -84,6 +114,7 @@ class ParabolicPDF(st.rv_continuous):
         plt.show()
     # Yet another plot test.
     def sampleplot3(self,ndraws=100,nbins=10):
+        import matplotlib.pyplot as plt
         fig, ax = plt.subplots()
         ax.hist(self.rvs(size=ndraws), bins=nbins, range=(0,self.endpoint),
                  histtype='bar', alpha=0.8, color='green')
@@ -94,10 +125,11 @@ class ParabolicPDF(st.rv_continuous):
         plt.show()
 
 
-class TruncatedExponentialPDF(st.rv_continuous):
+class TruncatedExponentialPDF(BinnedPDF):
     """
     Create an exponential PDF on a shortened range (x in [0, maxT]). This
-    inherits from the scipy.stats.rv_continuous class.
+    inherits from BinnedPDF (and so from the scipy.stats.rv_continuous 
+    class).
     """
     def __init__(self, lifetime, maxT):
         if maxT <= 0: 
@@ -114,33 +146,27 @@ class TruncatedExponentialPDF(st.rv_continuous):
     # Overload default _pdf inherited from rv_continuous. 
     def _pdf(self, T):
         return self.normfactor*np.exp(-T/self.lifetime)
+    # Analytic cdf and its inverse (see ParabolicPDF for why these matter):
+    #    cdf(T) = (1 - exp(-T/lifetime))/(1 - exp(-maxT/lifetime)).
+    # expm1/log1p keep these accurate when maxT << lifetime.
+    def _cdf(self, T):
+        return np.expm1(-T/self.lifetime)/np.expm1(-self.maxT/self.lifetime)
+    def _ppf(self, q):
+        return -self.lifetime*np.log1p(q*np.expm1(-self.maxT/self.lifetime))
     # You can change maxT
     def setmaxT(self,newmaxT):
+        self.checkwritable()
         self.maxT = float(newmaxT)
         self.b = newmaxT
         self.normfactor = 1./(self.lifetime*(1-np.exp(-self.maxT/self.lifetime)))
     # You can change lifetime
     def setlifetime(self,newlifetime):
+        self.checkwritable()
         self.lifetime = float(newlifetime)
         self.normfactor = 1./(self.lifetime*(1-np.exp(-self.maxT/self.lifetime)))
-    # Return the fractional bin occupancy vector for a given binning
-    def binfractionvector(self, nbins, binrange):
-        if not isinstance(binrange, tuple) or len(binrange) != 2:
-            print 'binfractionvector expects binrange to be a 2-tuple. Exiting!'
-            sys.exit(1)
-        binwidth = float(binrange[1] - binrange[0]) / nbins
-        binfracvec = np.zeros(nbins)
-        prevcdf = 0.
-        for i in xrange(1,nbins+1): # This counts inclusively over {1,nbins}
-            uppercdf = self.cdf(binrange[0] + i*binwidth)
-            binfracvec[i-1] = uppercdf - prevcdf
-            prevcdf = uppercdf
-        # Simple check
-        if sum(binfracvec) != 1.0: print 'Warning: sum of binfracvec = %s' % \
-                sum(binfracvec)
-        return binfracvec
     # This is for debugging. It will plot a histogram of 100 draws from the pdf.
     def sampleplot(self,ndraws=100,nbins=10):        
+        import matplotlib.pyplot as plt
         hist, bins = np.histogram(self.rvs(size=ndraws), bins=nbins,
                                   range=(0,self.maxT))
         histarea = float(ndraws)*(float(self.maxT)/nbins)
@@ -154,8 +180,110 @@ class TruncatedExponentialPDF(st.rv_continuous):
         plt.show()
         
 
+#########################################################################
+# Bounded LRU cache of templates (bin fraction vectors and anything built from
+# them), shared by everything that needs them: toy_2D_fits.maketemplates and
+# through it mainloop, checkminbins, the fitters and parameter scans. The 
+# least recently used entry is dropped once there are more than 
+# TEMPLATE_CACHE_SIZE of them. Cached arrays and PDFs (also inside cached 
+# tuples and lists) are made read-only, since every caller shares them.
+TEMPLATE_CACHE_SIZE = 256
+_templatecache = collections.OrderedDict()
+_templatecachestats = {'hits': 0, 'misses': 0}
+
+# Return the cached value for 'key', calling build() to make it on a miss.
+def cachedtemplate(key, build):
+    if key in _templatecache:
+        _templatecachestats['hits'] += 1
+        value = _templatecache.pop(key)
+    else:
+        _templatecachestats['misses'] += 1
+        value = build()
+        _makereadonly(value)
+    _templatecache[key] = value
+    while len(_templatecache) > TEMPLATE_CACHE_SIZE:
+        _templatecache.popitem(last=False)
+    return value
+
+def _makereadonly(value):
+    if isinstance(value, np.ndarray): value.flags.writeable = False
+    elif isinstance(value, BinnedPDF): value.readonly = True
+    elif isinstance(value, (tuple, list)):
+        for item in value: _makereadonly(item)
+
+# Cached binfractionvector of the PDF pdftype(*shapeparams), e.g. 
+# binfractions(TruncatedExponentialPDF, (260, 260), 4, (0, 260)).
+def binfractions(pdftype, shapeparams, nbins, binrange):
+    key = (pdftype.__name__, tuple(float(par) for par in shapeparams), 
+           int(nbins), (float(binrange[0]), float(binrange[1])))
+    return cachedtemplate(key, lambda: pdftype(*shapeparams).binfractionvector(
+            nbins, tuple(binrange)))
+
+# Hit/miss counters and current size of the template cache.
+def templatecachestats():
+    return dict(_templatecachestats, size=len(_templatecache), 
+                maxsize=TEMPLATE_CACHE_SIZE)
+
+# Empty the template cache and reset its counters.
+def cleartemplatecache():
+    _templatecache.clear()
+    _templatecachestats['hits'] = _templatecachestats['misses'] = 0
+
+
+#########################################################################
+# Draw 'size' (energy, deltaT) pairs for one 'isotope' in a single array 
+# operation per variable. 'size' can be an int or a shape tuple, so e.g. 
+# size=(nexpers, nevents) fills a whole ensemble at once.
+def sampleevents(pdfE, pdfT, size, rng=np.random):
+    return pdfE.fastrvs(size, rng), pdfT.fastrvs(size, rng)
+
+
+#########################################################################
+# Compare the analytic _cdf/_ppf sampling against rv_continuous's generic 
+# (numerical integration + root-finding) implementation, which is what every
+# rvs() and cdf() call used before the PDFs above overloaded them. This prints
+# draws/sec for both, the speedup, the largest cdf discrepancy on a grid, and
+# two-sample KS p-values between generic and fast draws. The generic sampler 
+# is slow, so it only gets 'nslow' draws.
+def benchmark_sampling(ndraws=10**6, nslow=2000, endpoint=12., lifetime=260.,
+                       maxT=260.):
+    # These reinstate the generic rv_continuous machinery for comparison.
+    class GenericParabolicPDF(ParabolicPDF):
+        def _cdf(self, x): return st.rv_continuous._cdf(self, x)
+        def _ppf(self, q): return st.rv_continuous._ppf(self, q)
+    class GenericTruncatedExponentialPDF(TruncatedExponentialPDF):
+        def _cdf(self, T): return st.rv_continuous._cdf(self, T)
+        def _ppf(self, q): return st.rv_continuous._ppf(self, q)
+
+    pairs = [('Energy', ParabolicPDF(endpoint), 
+              GenericParabolicPDF(endpoint), endpoint),
+             ('DeltaT', TruncatedExponentialPDF(lifetime, maxT),
+              GenericTruncatedExponentialPDF(lifetime, maxT), maxT)]
+    results = {}
+    for name, fast, generic, maxval in pairs:
+        grid = np.linspace(0, maxval, 50)
+        cdfdiff = np.max(np.abs(fast.cdf(grid) - generic.cdf(grid)))
+
+        starttime = time.time()
+        slowdraws = generic.rvs(size=nslow)
+        slowrate = nslow/(time.time() - starttime)
+        starttime = time.time()
+        fastdraws = fast.fastrvs(ndraws)
+        fastrate = ndraws/(time.time() - starttime)
+        kspval = st.ks_2samp(slowdraws, fastdraws)[1]
+
+        print '%s: generic %.3g draws/sec, analytic %.3g draws/sec ' \
+            '(speedup %.3g)' % (name, slowrate, fastrate, fastrate/slowrate)
+        print '   max |cdf diff| = %.3g, KS p-value (generic vs. analytic) ' \
+            '= %.3g' % (cdfdiff, kspval)
+        results[name] = {'slowrate': slowrate, 'fastrate': fastrate,
+                         'cdfdiff': cdfdiff, 'kspval': kspval}
+    return results
+
+
 # This makes the deltaT plots posted on my blog.
 def nice_deltaT_plots(he_lifetime=170, li_lifetime=260):
+    import matplotlib.pyplot as plt
     # Make deltaT pdfs
     maxT = max(np.ceil(he_lifetime), np.ceil(li_lifetime))
     he_t = TruncatedExponentialPDF(he_lifetime,maxT)
@@ -179,6 +307,7 @@ def nice_deltaT_plots(he_lifetime=170, li_lifetime=260):
 
 # This makes the energy spectrum plots posted on my blog.
 def nice_energy_plots(he_endpoint=8, li_endpoint=12):
+    import matplotlib.pyplot as plt
     # Make energy spectrum pdfs
     maxE = max(np.ceil(he_endpoint), np.ceil(li_endpoint))
     he_e = ParabolicPDF(he_endpoint)
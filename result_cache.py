@@ -0,0 +1,291 @@
+import sys, os, json, time, hashlib, shutil, argparse, fcntl
+import result_store as rs
+
+# On-disk cache of fake-fit results, so that a mainloop run that was done
+# before (by anyone pointing at the same cache directory) comes back from
+# disk instead of being recomputed. Entries are content-addressed: the key is
+# a hash of everything that determines the results (the run's config minus
+# CONFIG_IGNORED, which includes the seed) and of the source of the modules
+# that compute them (CODE_FILES), so editing the code invalidates old entries
+# rather than returning stale numbers.
+#
+# Only seeded runs are cached. With a seed, experiment i comes from its own
+# stream experimentrng(seed, i), so any range of experiments can be reused on
+# its own: a run of 10000 experiments after one of 8000 with the same config
+# loads the first 8000 and computes only the last 2000, and so does a shard
+# or a resumed run. Each entry is a directory holding a JSON index and one
+# result store (see result_store.py) per range of experiments computed.
+#
+# Several processes can share a cache directory. Every fetch holds a shared
+# lock on its entry (LOCKFILE), and eviction only removes entries it can lock
+# exclusively, i.e. that nobody is using. Changes to an entry's index are
+# made under a second, exclusive lock (INDEXLOCK): the index is re-read and
+# the new segments merged into it, so concurrent runs with the same key keep
+# each other's segments. A segment is written under a name private to its
+# process and renamed into place, and an existing segment is never replaced.
+#
+# Entries are evicted least recently used first once the cache holds more
+# than 'maxbytes'. Every ResultCache counts lookups that were served
+# entirely from disk ('hits'), partly ('partial') or not at all ('misses'),
+# and the number of experiments loaded ('cached') and computed ('computed').
+#
+# mainloop uses the directory in the environment variable TOY2D_CACHE by
+# default, or whatever is passed as its 'cache' argument. The timing columns
+# (time_*) of cached rows are those of the run that computed them.
+
+DEFAULT_DIR = os.environ.get('TOY2D_CACHE', '')
+DEFAULT_MAXBYTES = 2**32
+# Config entries that don't change the results.
+CONFIG_IGNORED = ['debug', 'membudget']
+# Source files whose contents are part of every key.
+CODE_FILES = ['physicsPDFs.py', 'batch_fits.py', 'unbinned_fits.py',
+              'toy_2D_fits.py']
+ENTRYFILE = 'entry.json'
+LOCKFILE = 'inuse.lock'
+INDEXLOCK = 'entry.lock'
+
+#########################################################################
+# Hash of the source of CODE_FILES (computed once per process).
+_codeversion = []
+def codeversion():
+    if not _codeversion:
+        here = os.path.dirname(os.path.abspath(__file__))
+        digest = hashlib.sha1()
+        for name in CODE_FILES:
+            with open(os.path.join(here, name), 'rb') as source:
+                digest.update(source.read())
+        _codeversion.append(digest.hexdigest())
+    return _codeversion[0]
+
+# Cache key of a run config (a dict like the one mainloop builds).
+def configkey(config):
+    fields = dict((name, value) for name, value in config.items()
+                  if name not in CONFIG_IGNORED)
+    return hashlib.sha1(json.dumps({'config': fields, 'code': codeversion()},
+                                   sort_keys=True)).hexdigest()
+
+#########################################################################
+class ResultCache(object):
+    def __init__(self, path=DEFAULT_DIR, maxbytes=DEFAULT_MAXBYTES):
+        if not path:
+            print 'A result cache needs a directory. Exiting!'
+            sys.exit(1)
+        self.path, self.maxbytes = path, maxbytes
+        self.stats = dict.fromkeys(['hits', 'partial', 'misses', 'cached',
+                                    'computed', 'evicted'], 0)
+        if not os.path.isdir(path): os.makedirs(path)
+
+    #####################################################################
+    # Fill 'out' (a result buffer of stop - start rows, e.g. a slice of
+    # toy_2D_fits.resultbuffer) with experiments start, ..., stop - 1 of
+    # 'config'. Ranges found in the cache are loaded; the others are made by
+    # compute(a, b), which must return the rows of experiments a, ..., b - 1,
+    # and are then stored. Returns the number of experiments loaded.
+    def fetch(self, config, start, stop, out, compute):
+        if config.get('seed') is None:
+            self.stats['misses'] += 1
+            self.stats['computed'] += stop - start
+            out[:] = compute(start, stop)
+            return 0
+        entrypath = os.path.join(self.path, configkey(config))
+        inuse = _lock(entrypath, LOCKFILE, fcntl.LOCK_SH)
+        try:
+            ncached, gaps = self._fetch(entrypath, config, start, stop, out,
+                                        compute)
+        finally:
+            os.close(inuse)
+
+        self.stats['cached'] += ncached
+        self.stats['computed'] += stop - start - ncached
+        if not gaps: self.stats['hits'] += 1
+        elif ncached: self.stats['partial'] += 1
+        else: self.stats['misses'] += 1
+        if gaps: self.evict(keep=entrypath)
+        return ncached
+
+    # The body of fetch, run while holding the entry's shared lock. Returns
+    # the number of experiments loaded and the list of ranges computed.
+    def _fetch(self, entrypath, config, start, stop, out, compute):
+        entry = self._readentry(entrypath, config)
+        gaps, pos, ncached = [], start, 0
+        for segment in sorted(entry['segments']):
+            segstart, segstop = segment[:2]
+            if segstop <= pos or segstart >= stop: continue
+            if segstart > pos: gaps.append((pos, segstart))
+            lo, hi = max(segstart, pos), min(segstop, stop)
+            columns = rs.loadcolumns(self._segpath(entrypath, segstart,
+                                                   segstop))
+            for name in out.dtype.names:
+                out[name][lo - start:hi - start] = \
+                    columns[name][lo - segstart:hi - segstart]
+            ncached += hi - lo
+            pos = hi
+        if pos < stop: gaps.append((pos, stop))
+
+        newsegments = []
+        for gapstart, gapstop in gaps:
+            block = compute(gapstart, gapstop)
+            out[gapstart - start:gapstop - start] = block
+            newsegments.append(self._savesegment(entrypath, gapstart, gapstop,
+                                                 block))
+        self._updateentry(entrypath, config, newsegments)
+        return ncached, gaps
+
+    #####################################################################
+    # Remove least recently used entries (never 'keep') until the cache
+    # holds at most 'maxbytes' (default: self.maxbytes).
+    def evict(self, maxbytes=None, keep=None):
+        if maxbytes is None: maxbytes = self.maxbytes
+        entries = self.entries()
+        total = sum(entry['bytes'] for entry in entries)
+        for entry in sorted(entries, key=lambda entry: entry['lastused']):
+            if total <= maxbytes: break
+            if entry['path'] == keep or not self._remove(entry['path']):
+                continue
+            total -= entry['bytes']
+            self.stats['evicted'] += 1
+
+    # Delete an entry unless another process is using it; returns whether it
+    # was deleted.
+    def _remove(self, entrypath):
+        try:
+            inuse = _lock(entrypath, LOCKFILE, fcntl.LOCK_EX | fcntl.LOCK_NB,
+                          create=False)
+        except (IOError, OSError):
+            return False
+        try:
+            shutil.rmtree(entrypath, ignore_errors=True)
+        finally:
+            os.close(inuse)
+        return True
+
+    # A list of dicts describing every entry: 'path', 'config', 'lastused',
+    # 'segments' and 'bytes' (its size on disk, as recorded in its index).
+    def entries(self):
+        entries = []
+        for name in os.listdir(self.path):
+            entrypath = os.path.join(self.path, name)
+            if not os.path.isfile(os.path.join(entrypath, ENTRYFILE)):
+                continue
+            with open(os.path.join(entrypath, ENTRYFILE)) as entryfile:
+                entry = json.load(entryfile)
+            entry['path'] = entrypath
+            entry['bytes'] = sum(self._segbytes(entrypath, segment)
+                                 for segment in entry['segments'])
+            entries.append(entry)
+        return entries
+
+    # Delete every entry that isn't in use.
+    def clear(self):
+        for entry in self.entries(): self._remove(entry['path'])
+
+    # One line summarizing self.stats.
+    def report(self):
+        return 'Result cache %s: %s experiments loaded, %s computed ' \
+            '(%s hits, %s partial, %s misses, %s entries evicted).' % \
+            (self.path, self.stats['cached'], self.stats['computed'],
+             self.stats['hits'], self.stats['partial'], self.stats['misses'],
+             self.stats['evicted'])
+
+    #####################################################################
+    def _segpath(self, entrypath, segstart, segstop):
+        return os.path.join(entrypath, 'exps_%s_%s' % (segstart, segstop))
+
+    # Size of a segment as recorded in the index (entries written before
+    # sizes were recorded are measured on disk).
+    def _segbytes(self, entrypath, segment):
+        if len(segment) > 2: return segment[2]
+        segpath = self._segpath(entrypath, *segment)
+        if not os.path.isdir(segpath): return 0
+        return sum(os.path.getsize(os.path.join(segpath, name))
+                   for name in os.listdir(segpath))
+
+    # An entry's index; 'segments' lists [start, stop, bytes] of each
+    # segment.
+    def _readentry(self, entrypath, config):
+        if os.path.isfile(os.path.join(entrypath, ENTRYFILE)):
+            with open(os.path.join(entrypath, ENTRYFILE)) as entryfile:
+                return json.load(entryfile)
+        return {'config': config, 'code': codeversion(), 'segments': [],
+                'lastused': time.time()}
+
+    # Add 'newsegments' to the index and mark it used, under the index lock
+    # and after re-reading it, so segments other processes added meanwhile
+    # are kept. The index is written next to its final place and then
+    # renamed, so an interrupted write never leaves a partial one.
+    def _updateentry(self, entrypath, config, newsegments):
+        indexlock = _lock(entrypath, INDEXLOCK, fcntl.LOCK_EX)
+        try:
+            entry = self._readentry(entrypath, config)
+            known = set(tuple(segment[:2]) for segment in entry['segments'])
+            entry['segments'] += [segment for segment in newsegments
+                                  if tuple(segment[:2]) not in known]
+            entry['lastused'] = time.time()
+            tmppath = os.path.join(entrypath, '%s.%s.tmp' % (ENTRYFILE,
+                                                             os.getpid()))
+            with open(tmppath, 'w') as entryfile:
+                json.dump(entry, entryfile, indent=1, sort_keys=True)
+            os.rename(tmppath, os.path.join(entrypath, ENTRYFILE))
+        finally:
+            os.close(indexlock)
+
+    # Store experiments segstart, ..., segstop - 1 and return their
+    # [start, stop, bytes]. If another process already stored the same range,
+    # its copy (which holds the same rows) is kept.
+    def _savesegment(self, entrypath, segstart, segstop, block):
+        segpath = self._segpath(entrypath, segstart, segstop)
+        tmppath = '%s.%s.tmp' % (segpath, os.getpid())
+        if os.path.isdir(tmppath): shutil.rmtree(tmppath)
+        rs.saveresults(tmppath, block)
+        nbytes = sum(os.path.getsize(os.path.join(tmppath, name))
+                     for name in os.listdir(tmppath))
+        try:
+            os.rename(tmppath, segpath)
+        except OSError:
+            shutil.rmtree(tmppath, ignore_errors=True)
+        return [segstart, segstop, nbytes]
+
+#########################################################################
+# Open and flock the file 'name' in 'entrypath' (creating the directory
+# first if 'create'), returning its descriptor. If the entry was evicted
+# while we waited for the lock, the lock is on a deleted file, so start over.
+def _lock(entrypath, name, mode, create=True):
+    lockpath = os.path.join(entrypath, name)
+    while True:
+        if create and not os.path.isdir(entrypath):
+            try: os.makedirs(entrypath)
+            except OSError:
+                if not os.path.isdir(entrypath): raise
+        fd = os.open(lockpath, os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, mode)
+        except (IOError, OSError):
+            os.close(fd)
+            raise
+        try:
+            if os.fstat(fd).st_ino == os.stat(lockpath).st_ino: return fd
+        except OSError:
+            pass
+        os.close(fd)
+
+#########################################################################
+#########################################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='List, trim or clear a '
+                                     'result cache.')
+    parser.add_argument('path', nargs='?', default=DEFAULT_DIR)
+    parser.add_argument('--maxbytes', type=float, default=None,
+                        help='evict entries until the cache fits')
+    parser.add_argument('--clear', action='store_true')
+    args = parser.parse_args()
+
+    cache = ResultCache(args.path)
+    if args.clear: cache.clear()
+    elif args.maxbytes is not None: cache.evict(int(args.maxbytes))
+    for entry in sorted(cache.entries(), key=lambda entry: entry['lastused']):
+        config = entry['config']
+        nexps = sum(segment[1] - segment[0] for segment in entry['segments'])
+        print '%s  %8s exps  %10s bytes  nevents=(%s, %s) seed=%s %s' % \
+            (os.path.basename(entry['path'])[:12], nexps, entry['bytes'],
+             config['nevents0'], config['nevents1'], config['seed'],
+             config['genmode'])
@@ -0,0 +1,70 @@
+import os, json
+import numpy as np
+
+# Binary columnar storage for fake-fit results. A 'result store' is a
+# directory with one .npy file per output column plus a small JSON file
+# (meta.json) recording the column names, the number of rows and any run
+# settings passed in. Columns are loaded memory-mapped, so reading two columns
+# of a huge ensemble never touches the bytes of the other eighteen.
+# loadresults also accepts the CSV files mainloop writes by default, so
+# analysis code can take either format.
+
+METAFILE = 'meta.json'
+
+#########################################################################
+# True if 'path' is a result store directory (as opposed to e.g. a CSV file).
+def isstore(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, METAFILE))
+
+#########################################################################
+# Write 'results' (a structured array such as toy_2D_fits.resultbuffer()
+# returns, or a dict of equal-length column arrays) to the store directory
+# 'path', creating it if needed. 'meta' is an optional JSON-serializable dict
+# saved alongside, e.g. the settings of the run.
+def saveresults(path, results, meta=None):
+    if hasattr(results, 'dtype'): names = list(results.dtype.names)
+    else: names = sorted(results)
+    if not os.path.isdir(path): os.makedirs(path)
+    for name in names:
+        np.save(os.path.join(path, name + '.npy'),
+                np.ascontiguousarray(results[name]))
+    with open(os.path.join(path, METAFILE), 'w') as metafile:
+        json.dump({'columns': names, 'nrows': len(results[names[0]]),
+                   'meta': meta or {}}, metafile, indent=1, sort_keys=True)
+
+#########################################################################
+# Return the contents of a store's meta.json as a dict.
+def readmeta(path):
+    with open(os.path.join(path, METAFILE)) as metafile:
+        return json.load(metafile)
+
+#########################################################################
+# Return a dict mapping each of 'columns' (default: all of them) to its array
+# in the store at 'path'. With mmap=True the arrays are read-only memory maps,
+# so nothing is read from disk until it is used.
+def loadcolumns(path, columns=None, mmap=True):
+    if columns is None: columns = readmeta(path)['columns']
+    mode = 'r' if mmap else None
+    return dict((name, np.load(os.path.join(path, name + '.npy'),
+                               mmap_mode=mode)) for name in columns)
+
+#########################################################################
+# Load 'columns' (default: all of them) of a result store or of a CSV file
+# written by mainloop into a pandas data frame. Only the requested columns
+# are read in either case.
+def loadresults(path, columns=None):
+    import pandas as pd
+    if isstore(path):
+        if columns is None: columns = readmeta(path)['columns']
+        return pd.DataFrame(loadcolumns(path, columns), columns=columns)
+    return pd.read_csv(path, usecols=columns, float_precision='round_trip')
+
+#########################################################################
+# Convert a CSV file written by mainloop (e.g.
+# toy_fits_1000exp_1000n0_100n1.txt) into a result store at 'storepath'.
+def csvtostore(csvpath, storepath):
+    import pandas as pd
+    data = pd.read_csv(csvpath, index_col=0)
+    saveresults(storepath, dict((name, data[name].values)
+                                for name in data.columns),
+                meta={'source': os.path.basename(csvpath)})
@@ -0,0 +1,188 @@
+import sys, time, json, itertools, multiprocessing, argparse
+import numpy as np
+import scipy.stats as st
+import pandas as pd
+import toy_2D_fits as t2d
+import result_store as rs
+import chi2_correction_1D as c2c
+
+# Parameter-scan driver: runs the fake fits of toy_2D_fits.py for every
+# configuration on a grid of event counts, binnings, endpoints and lifetimes,
+# and summarizes each configuration's bias, pull width and p-value
+# uniformity. A grid is a dict mapping any of SCAN_PARAMS to a list of values
+# (or a single value); parameters not in the grid keep their DEFAULTS. E.g.
+#     runscan({'nevents1': [50, 100, 200], 'nEbins': [3, 4, 5]}, 500)
+# or, from the terminal, with the grid in a JSON file:
+#     python scan.py grid.json 500 scan_output.csv --workers 8
+
+SCAN_PARAMS = ['nevents0', 'nevents1', 'nEbins', 'nTbins', 'endpoint0',
+               'endpoint1', 'lifetime0', 'lifetime1']
+DEFAULTS = {'nevents0': 1000, 'nevents1': 100, 'nEbins': 4, 'nTbins': 4,
+            'endpoint0': 12.0, 'endpoint1': 8.0, 'lifetime0': 260,
+            'lifetime1': 170}
+# Fits whose best fits are summarized, and the ones that also report a
+# covariance (so that pulls can be formed).
+FITS = ['1D', '2D', '1DML', '2DML']
+CHI2FITS = ['1D', '2D']
+
+#########################################################################
+# Expand a grid into a list of configurations (dicts over SCAN_PARAMS).
+# Configurations that share PDF shapes and binning are put next to each
+# other, so that a worker running consecutive configurations reuses their
+# templates from the cache in physicsPDFs.
+def expandgrid(grid):
+    unknown = [name for name in grid if name not in SCAN_PARAMS]
+    if unknown:
+        print 'Unknown scan parameters %s (expected some of %s). ' \
+            'Exiting!' % (unknown, SCAN_PARAMS)
+        sys.exit(1)
+    names = sorted(grid)
+    values = [grid[name] if isinstance(grid[name], (list, tuple))
+              else [grid[name]] for name in names]
+    configs = []
+    for combo in itertools.product(*values):
+        config = dict(DEFAULTS)
+        config.update(zip(names, combo))
+        configs.append(config)
+    shapekey = lambda cfg: tuple(cfg[name] for name in
+                                 ['endpoint0', 'endpoint1', 'lifetime0',
+                                  'lifetime1', 'nEbins', 'nTbins'])
+    return sorted(configs, key=shapekey)
+
+#########################################################################
+# Bias, pull width and p-value uniformity of one configuration's results (a
+# buffer from toy_2D_fits.resultbuffer). Biases are mean(fit - true) for
+# both normalizations of every fit; pulls (fit - true)/error are only formed
+# for the chi-square fits, which report a covariance. P-value uniformity is
+# the p-value of a KS test of pval_1D/pval_2D against a uniform distribution;
+# dof_1D/dof_2D are the effective numbers of degrees of freedom of the chi^2
+# values (see chi2_correction_1D.effective_dof), to compare with the nominal
+# nbins - 2.
+def summarize(results, nevents):
+    summary = {'nexpers': len(results)}
+    for fit in FITS:
+        for niso in xrange(2):
+            resid = results['n%s_%s' % (niso, fit)] - nevents[niso]
+            summary['bias_n%s_%s' % (niso, fit)] = np.mean(resid)
+            summary['rms_n%s_%s' % (niso, fit)] = np.std(resid)
+            if fit in CHI2FITS:
+                pull = resid/np.sqrt(results['var%s%s_%s' % (niso, niso,
+                                                             fit)])
+                summary['pullmean_n%s_%s' % (niso, fit)] = np.mean(pull)
+                summary['pullwidth_n%s_%s' % (niso, fit)] = np.std(pull,
+                                                                   ddof=1)
+    for fit in CHI2FITS:
+        summary['ks_pval_%s' % fit] = st.kstest(results['pval_%s' % fit],
+                                                'uniform')[1]
+        summary['dof_%s' % fit], summary['doferr_%s' % fit] = \
+            c2c.effective_dof(results['chi_%s' % fit])
+    return summary
+
+#########################################################################
+# Run 'nexpers' fake experiments for every configuration in 'grid' on a
+# pool of 'nworkers' processes (default: all cores) and return (combined,
+# summary): a data frame of every experiment's outputs keyed by
+# configuration number and experiment number, and a data frame with one row
+# of summarize() output per configuration. Configurations rejected by
+# checkminbins are skipped and listed in the summary with their reason,
+# rather than stopping the scan. If 'outfilename' is given, the combined
+# output is written there (as CSV, or as a result store with
+# outformat='binary') and the summary to outfilename + '.summary.csv'.
+def runscan(grid, nexpers, outfilename='', nworkers=None, seed=19,
+            minevtsperbin=20, PearsonErrs=True, genmode='binned',
+            membudget=2**26, outformat='csv'):
+    starttime = time.time()
+    configs = expandgrid(grid)
+    tasks, summaries = [], []
+    for nconfig, config in enumerate(configs):
+        nevents = (config['nevents0'], config['nevents1'])
+        fracsE, fracsT, fracs2D = t2d.maketemplates(
+            config['endpoint0'], config['endpoint1'], config['lifetime0'],
+            config['lifetime1'], config['nEbins'], config['nTbins'])[2:]
+        problem = t2d.checkminbins(minevtsperbin, nevents, fracsE, fracsT,
+                                   fracs2D, fatal=False)
+        if problem:
+            print 'Skipping configuration %s %s: %s.' % (nconfig, config,
+                                                          problem)
+            summaries.append(dict(config, config=nconfig, status='skipped: '
+                                  + problem))
+            continue
+        runconfig = dict(config, PearsonErrs=PearsonErrs, membudget=membudget,
+                         genmode=genmode, batched=True, unbinned=False,
+                         seed=seed, debug=False)
+        tasks.append((nconfig, runconfig, nexpers))
+
+    if nworkers is None: nworkers = multiprocessing.cpu_count()
+    if nworkers > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(nworkers)
+        try:
+            # Hand out neighbouring configurations (which share templates) in
+            # chunks.
+            chunksize = max(1, len(tasks)//(4*nworkers))
+            outputs = pool.map(_runconfig, tasks, chunksize)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        outputs = [_runconfig(task) for task in tasks]
+
+    pieces = []
+    for (nconfig, runconfig, nexps), results in zip(tasks, outputs):
+        nevents = (runconfig['nevents0'], runconfig['nevents1'])
+        config = dict((name, runconfig[name]) for name in SCAN_PARAMS)
+        summaries.append(dict(config, config=nconfig, status='ok',
+                              **summarize(results, nevents)))
+        piece = pd.DataFrame(results)
+        piece.insert(0, 'experiment', np.arange(nexps))
+        for name in reversed(SCAN_PARAMS): piece.insert(0, name, config[name])
+        piece.insert(0, 'config', nconfig)
+        pieces.append(piece)
+    combined = pd.concat(pieces, ignore_index=True) if pieces else \
+        pd.DataFrame()
+    summary = pd.DataFrame(summaries).sort_values('config')
+    summary = summary.set_index('config')
+
+    if outfilename:
+        if outformat == 'binary':
+            rs.saveresults(outfilename, dict((name, combined[name].values)
+                                             for name in combined.columns),
+                           meta={'grid': grid, 'nexpers': nexpers,
+                                 'seed': seed})
+        else:
+            combined.to_csv(outfilename, index=False)
+        summary.to_csv(outfilename + '.summary.csv')
+    print 'Scan of %s configurations (%s skipped) finished! Elapsed time: ' \
+        '%s' % (len(configs), len(configs) - len(tasks),
+                time.time() - starttime)
+    return combined, summary
+
+# Pool workers can only call module-level functions with a single argument.
+def _runconfig(args):
+    nconfig, runconfig, nexpers = args
+    return t2d.runexperiments(0, nexpers, runconfig)
+
+#########################################################################
+#########################################################################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run fake fits over a grid '
+                                     'of configurations.')
+    parser.add_argument('gridfile', help='JSON file mapping scan parameters '
+                        'to lists of values')
+    parser.add_argument('nexperiments', type=int)
+    parser.add_argument('outfilename', nargs='?', default='')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=19)
+    parser.add_argument('--events', action='store_true',
+                        help='generate every event instead of drawing bin '
+                        'counts')
+    parser.add_argument('--binary', action='store_true',
+                        help='write a binary result store instead of CSV')
+    args = parser.parse_args()
+
+    with open(args.gridfile) as gridfile: grid = json.load(gridfile)
+    combined, summary = runscan(grid, args.nexperiments,
+                                outfilename=args.outfilename,
+                                nworkers=args.workers, seed=args.seed,
+                                genmode='events' if args.events else 'binned',
+                                outformat='binary' if args.binary else 'csv')
+    print summary.to_string()
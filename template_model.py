@@ -0,0 +1,270 @@
+import sys
+import numpy as np
+from scipy.special import gammaln, xlogy
+
+# Generalization of the two-isotope, two-observable fits in toy_2D_fits.py to
+# K components ('isotopes' or backgrounds) and D binned observables. Each
+# component's expected fraction of events in a D-dimensional bin is the outer
+# product of one 1-D fraction vector per axis, e.g. for the existing model
+#     fracs2D[k] = np.outer(fracsE[k], fracsT[k]).
+# With several observables the grid easily has tens of thousands of bins, most
+# of them empty, so histograms are stored sparsely (only occupied bins, see
+# SparseHistograms) and template fractions are only ever evaluated in occupied
+# bins. The extended Poisson likelihood
+#     NLL = sum_k p_k T_k - sum_b d_b log(mu_b) + sum_b log(d_b!),
+# with T_k the total fraction of component k over the grid, only needs the
+# occupied bins, so memory and fit time scale with the number of occupied
+# bins instead of the size of the grid. E.g. for three components in
+# energy x time x a third observable:
+#     model = TemplateModel([[fracsE[k], fracsT[k], fracsX[k]]
+#                            for k in xrange(3)])
+#     hists = model.throw(1000, (1000, 100, 50))
+#     pfit, fncmin = model.fit(hists)
+
+
+#########################################################################
+# Histograms of 'nexps' experiments over a grid of shape 'shape', stored in
+# compressed sparse row form: the occupied bins of experiment i are
+# bins[indptr[i]:indptr[i+1]] (flat indices into the grid, in increasing
+# order) with counts counts[indptr[i]:indptr[i+1]].
+class SparseHistograms(object):
+    def __init__(self, shape, indptr, bins, counts):
+        self.shape = tuple(shape)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.bins = np.asarray(bins, dtype=np.int64)
+        self.counts = np.asarray(counts, dtype=float)
+        self.nexps = len(self.indptr) - 1
+
+    # Experiment number of every stored bin.
+    def rows(self):
+        return np.repeat(np.arange(self.nexps), np.diff(self.indptr))
+
+    # Total number of events in each experiment.
+    def totals(self):
+        return np.bincount(self.rows(), weights=self.counts,
+                           minlength=self.nexps)
+
+    # Dense (nexps,) + shape array of the same histograms. Only sensible for
+    # small grids, e.g. to compare with histogramexperiments.
+    def todense(self):
+        dense = np.zeros((self.nexps, int(np.prod(self.shape))))
+        dense[self.rows(), self.bins] = self.counts
+        return dense.reshape((self.nexps,) + self.shape)
+
+    @classmethod
+    def fromdense(cls, hists):
+        hists = np.asarray(hists)
+        flat = hists.reshape(len(hists), -1)
+        rows, bins = np.nonzero(flat)
+        indptr = np.append(0, np.cumsum(np.bincount(rows,
+                                                    minlength=len(hists))))
+        return cls(hists.shape[1:], indptr, bins, flat[rows, bins])
+
+#########################################################################
+# Sparse histograms of 'nexps' experiments from the flat bin index of each of
+# their events, 'binidx' of shape (nexps, nevents). Counting is done on
+# (experiment, bin) keys, so nothing of the size of the grid is allocated.
+def sparsehistograms(binidx, shape, nexps):
+    nbins = int(np.prod(shape))
+    binidx = np.asarray(binidx, dtype=np.int64).reshape(nexps, -1)
+    keys = binidx + nbins*np.arange(nexps, dtype=np.int64)[:,np.newaxis]
+    keys, counts = np.unique(keys.ravel(), return_counts=True)
+    rows = keys//nbins
+    indptr = np.append(0, np.cumsum(np.bincount(rows, minlength=nexps)))
+    return SparseHistograms(shape, indptr, keys - rows*nbins, counts)
+
+#########################################################################
+# Binned likelihood model with K components and D observables. 'axisfracs' is
+# a list over components of lists over axes of 1-D bin fraction vectors (as
+# returned by BinnedPDF.binfractionvector); every component must use the same
+# binning. 'binranges' is the (low, high) range of each axis, needed only to
+# bin events with histogram().
+class TemplateModel(object):
+    def __init__(self, axisfracs, binranges=None):
+        self.axisfracs = [[np.asarray(fracs, dtype=float) for fracs in comp]
+                          for comp in axisfracs]
+        self.ncomponents = len(self.axisfracs)
+        self.shape = tuple(len(fracs) for fracs in self.axisfracs[0])
+        self.ndims = len(self.shape)
+        if any(tuple(len(fracs) for fracs in comp) != self.shape
+               for comp in self.axisfracs):
+            print 'TemplateModel expects every component to have the same ' \
+                'binning. Exiting!'
+            sys.exit(1)
+        self.nbins = int(np.prod(self.shape))
+        self.binranges = binranges
+        # Total fraction of each component inside the grid (1 up to rounding
+        # when the fraction vectors cover the full PDFs).
+        self.totals = np.array([np.prod([fracs.sum() for fracs in comp])
+                                for comp in self.axisfracs])
+
+    # Template fractions of every component in the flat bins 'bins', as an
+    # array of shape (len(bins), K). Only these bins are evaluated.
+    def fractions(self, bins):
+        idx = np.unravel_index(np.asarray(bins, dtype=np.int64), self.shape)
+        out = np.ones((len(idx[0]), self.ncomponents))
+        for k, comp in enumerate(self.axisfracs):
+            for d, fracs in enumerate(comp):
+                out[:,k] *= fracs[idx[d]]
+        return out
+
+    # Full D-dimensional template of component k (e.g. fracs2D[k] for the
+    # existing model). Only sensible for small grids.
+    def template(self, k):
+        return reduce(np.multiply.outer, self.axisfracs[k])
+
+    #####################################################################
+    # Flat bin index of events whose observables are the equally shaped
+    # arrays data[0], ..., data[D - 1], using equal-width bins over
+    # self.binranges. Values on or above the top edge go into the last bin,
+    # as in toy_2D_fits.histogramexperiments.
+    def binindices(self, data):
+        if self.binranges is None:
+            print 'TemplateModel needs binranges to bin events. Exiting!'
+            sys.exit(1)
+        idx = []
+        for values, nbins, (low, high) in zip(data, self.shape,
+                                              self.binranges):
+            scaled = (np.asarray(values) - low)*(float(nbins)/(high - low))
+            idx.append(np.clip(scaled.astype(np.int64), 0, nbins - 1))
+        return np.ravel_multi_index(idx, self.shape)
+
+    # Sparse histograms of experiments whose events' observables are given as
+    # D arrays of shape (nexps, nevents).
+    def histogram(self, data):
+        binidx = self.binindices(data)
+        return sparsehistograms(binidx, self.shape, len(binidx))
+
+    # Throw 'nexps' experiments with nevents[k] events of component k and
+    # return their sparse histograms. Since the templates factorize, each
+    # event's bin along each axis is drawn independently from that axis'
+    # fraction vector, so the cost scales with the number of events and the
+    # grid is never materialized.
+    def throw(self, nexps, nevents, rng=np.random):
+        binidx = []
+        for comp, nevts in zip(self.axisfracs, nevents):
+            idx = []
+            for fracs in comp:
+                cumfracs = np.cumsum(fracs)/fracs.sum()
+                draws = rng.random_sample((nexps, nevts))
+                idx.append(np.minimum(np.searchsorted(cumfracs, draws,
+                                                      side='right'),
+                                      len(fracs) - 1))
+            binidx.append(np.ravel_multi_index(idx, self.shape))
+        return sparsehistograms(np.hstack(binidx), self.shape, nexps)
+
+    #####################################################################
+    # Extended Poisson negative log-likelihood of every experiment in 'hists'
+    # for normalizations 'params' of shape (nexps, K). This equals
+    # -sum(log(st.poisson.pmf(d, mu))) over the full grid (the convention of
+    # toy_2D_fits.mlfit2D and batch_fits.poissonnll) but only touches the
+    # occupied bins.
+    def nll(self, hists, params):
+        rows, fracs = hists.rows(), self.fractions(hists.bins)
+        pred = (np.asarray(params)[rows]*fracs).sum(axis=-1)
+        terms = gammaln(hists.counts + 1.) - xlogy(hists.counts, pred)
+        return (np.asarray(params)*self.totals).sum(axis=-1) + \
+            np.bincount(rows, weights=terms, minlength=hists.nexps)
+
+    # Maximize the likelihood of every experiment in 'hists' at once. As in
+    # batch_fits.mlfit this is Newton's method with step halving, using
+    #     dNLL/dp_k = T_k - sum_b d_b f_bk/mu_b,
+    #     d^2NLL/dp_k dp_l = sum_b d_b f_bk f_bl/mu_b^2,
+    # where the sums run over occupied bins only, and it starts from the
+    # observed number of events split equally among the components. Per-row
+    # sums are done with bincount over that row's bins in order, so each
+    # experiment's result doesn't depend on the others. Predictions are only
+    # required to be positive in occupied bins. Returns (pfit, fncmin) with
+    # shapes (nexps, K) and (nexps,), plus a diagnostics dict as in
+    # batch_fits.mlfit with full_output=True.
+    def fit(self, hists, maxiter=50, tol=1e-10, maxhalvings=30,
+            full_output=False):
+        nexps, K = hists.nexps, self.ncomponents
+        # Fractions are kept as (K, nbins stored) so that sums over components
+        # run over contiguous rows.
+        rows, data = hists.rows(), hists.counts
+        fracs = self.fractions(hists.bins).T.copy()
+        params = hists.totals()[:,np.newaxis]/(K*self.totals)
+        nll = self._reducednll(rows, data, fracs, params)
+
+        active = np.ones(nexps, dtype=bool)
+        nfev = np.ones(nexps, dtype=int)
+        nactive = nexps
+        subrows, subdata, subfracs = rows, data, fracs
+        for niter in xrange(maxiter):
+            idx = np.nonzero(active)[0]
+            if not len(idx): break
+            # Occupied bins of the experiments still being fitted, and their
+            # row in the arrays of active experiments.
+            if len(idx) < nactive:
+                sel = active[rows]
+                subrows = np.cumsum(active)[rows[sel]] - 1
+                subdata, subfracs = data[sel], fracs[:,sel]
+                nactive = len(idx)
+            pred = (params[idx].T[:,subrows]*subfracs).sum(axis=0)
+            ratio = subdata/pred
+            weight = ratio/pred
+            grad = np.empty((len(idx), K))
+            hess = np.empty((len(idx), K, K))
+            for k in xrange(K):
+                grad[:,k] = self.totals[k] - \
+                    np.bincount(subrows, weights=ratio*subfracs[k],
+                                minlength=len(idx))
+                weightk = weight*subfracs[k]
+                for l in xrange(k + 1):
+                    hess[:,k,l] = hess[:,l,k] = \
+                        np.bincount(subrows, weights=weightk*subfracs[l],
+                                    minlength=len(idx))
+            step = _solvebatch(hess, grad)
+            # Backtrack rows whose full step is unphysical or goes uphill.
+            scale = np.ones(len(idx))
+            for nhalve in xrange(maxhalvings):
+                trial = params[idx] - scale[:,np.newaxis]*step
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    trialnll, trialpred = self._reducednll(
+                        subrows, subdata, subfracs, trial, returnpred=True)
+                    nonpositive = np.bincount(subrows, weights=trialpred <= 0,
+                                              minlength=len(idx)) > 0
+                    bad = nonpositive | ~(trialnll <= nll[idx] + 1e-12*
+                                          (1. + np.abs(nll[idx])))
+                if not bad.any(): break
+                scale[bad] *= 0.5
+            nfev[idx] += nhalve + 1
+            params[idx], nll[idx] = trial, trialnll
+            done = (np.abs(scale[:,np.newaxis]*step) <=
+                    tol*(np.abs(trial) + tol)).all(axis=-1)
+            active[idx[done]] = False
+
+        fncmin = self.nll(hists, params)
+        if full_output:
+            return params, fncmin, {'converged': ~active, 'nfev': nfev}
+        return params, fncmin
+
+    # Data-dependent part of nll (drops the constant gammaln term), from the
+    # stored bins' experiment numbers, counts and (K, nbins stored) fractions.
+    def _reducednll(self, rows, data, fracs, params, returnpred=False):
+        pred = (params.T[:,rows]*fracs).sum(axis=0)
+        nll = (params*self.totals).sum(axis=-1) - \
+            np.bincount(rows, weights=xlogy(data, pred),
+                        minlength=len(params))
+        return (nll, pred) if returnpred else nll
+
+#########################################################################
+# Solve the stacked linear systems hess[i] x = grad[i]. Rows whose matrix is
+# singular (e.g. a component with no template content in any occupied bin)
+# get a least-squares solution instead.
+def _solvebatch(hess, grad):
+    try:
+        return np.linalg.solve(hess, grad[...,np.newaxis])[...,0]
+    except np.linalg.LinAlgError:
+        return np.array([np.linalg.lstsq(h, g, rcond=None)[0]
+                         for h, g in zip(hess, grad)])
+
+#########################################################################
+# Output columns for the fit results of a K-component model, named like
+# toy_2D_fits.RESULT_COLUMNS: n0_<fit>, ..., n<K-1>_<fit> and fncmin_<fit>.
+def resultcolumns(pfit, fncmin, fit):
+    columns = dict(('n%s_%s' % (k, fit), pfit[:,k])
+                   for k in xrange(pfit.shape[1]))
+    columns['fncmin_' + fit] = fncmin
+    return columns
@@ -0,0 +1,22 @@
+import unittest
+import benchmarks
+
+# Import-time budget of the compute path: every module in 
+# benchmarks.CORE_MODULES must import in a fresh interpreter within 
+# benchmarks.IMPORT_BUDGET seconds and without loading any of 
+# benchmarks.HEAVY_MODULES (matplotlib, pandas). Run with
+#     python -m unittest test_imports
+
+class ImportBudgetTest(unittest.TestCase):
+    def test_core_modules(self):
+        results = benchmarks.checkimports()
+        for module in benchmarks.CORE_MODULES:
+            seconds, heavy = results[module]
+            self.assertLessEqual(seconds, benchmarks.IMPORT_BUDGET, 
+                                 '%s takes %.3g s to import (budget %.3g s)' 
+                                 % (module, seconds, benchmarks.IMPORT_BUDGET))
+            self.assertEqual(heavy, [], 'importing %s loads %s' 
+                             % (module, ', '.join(heavy)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,18 @@
 import physicsPDFs as pdfs
-import sys, time, subprocess
+import batch_fits as bf
+import unbinned_fits as ub
+import result_store as rs
+import result_cache as rc
+import instrument
+import ensemble_stats as es
+import sys, time, subprocess, multiprocessing, shutil, json, argparse
 import os.path
 import numpy as np
-import scipy as sp
-import matplotlib.pyplot as plt
+import scipy.optimize
 import scipy.stats as st
-import pandas as pd
+# matplotlib and pandas are only imported inside the functions that plot or 
+# build data frames, so that generating and fitting experiments (e.g. in pool
+# workers or batch jobs) doesn't pay for them or need a display.
 
 
 #
@@ -31,12 +38,375 @@ import pandas as pd
 # This runs the main fake fit loop. If you'd like to see the output of just one
 # fake fit (performing the 1-D and 2-D versions), you can call mainloop from 
 # the terminal like this: t2d.mainloop(1,1000,100,debug=True)
+#
+# By default experiments are drawn from numpy's global random stream (seeded 
+# when physicsPDFs is imported). Passing 'seed' instead gives experiment i its
+# own stream derived from (seed, i); see experimentrng. That is what makes 
+# nworkers > 1 possible: the experiments are split over a pool of 'nworkers'
+# processes and the output is bit-identical for a given seed no matter how 
+# many workers are used.
+#
+# Long runs can be made restartable: with checkpoint=M the results so far (and
+# the state of the global random stream, when no seed is used) are saved to 
+# outfilename + '.ckpt' after every M experiments, and resume=True picks up 
+# from that checkpoint. shard=(k, N) runs only the k-th of N disjoint, 
+# contiguous slices of the experiment indices (this needs a seed); the shard
+# outputs can then be combined with mergeshards into the table a single run 
+# would have produced.
+#
+# Progress (experiments done, rate and estimated time left) is printed at most
+# every 'progress' seconds; progress=None turns it off. With profile='path' 
+# the run is done under cProfile and the statistics are saved to 'path' (see 
+# instrument.profiled).
+#
+# With unbinned=True, events are also fitted by an unbinned extended ML fit 
+# besides the four binned fits (the n0_UML, n1_UML and fncmin_UML columns; 
+# see unbinned_fits.py). It is off by default: it adds about half a 
+# millisecond per experiment of 1,100 events, which roughly triples the run 
+# time with genmode='events'. With genmode='binned' there are no events, and 
+# those columns are NaN.
+#
+# summaryonly=True streams the experiments instead: each block of results 
+# only updates an ensemble_stats.EnsembleSummary (moments of the fitted 
+# normalizations and pulls, pull and p-value histograms), no per-experiment 
+# rows are kept, and memory doesn't grow with nexpers. The summary is what's
+# returned, and what's saved to outfilename (as JSON, see 
+# ensemble_stats.savesummary). Checkpoints, resume and shards work as above;
+# mergeshards combines the summaries of a sharded run.
+#
+# Seeded runs (other than summaryonly ones) go through a result cache (see 
+# result_cache.py): experiments that were already run with the same 
+# settings and code are loaded from disk, and only the rest are computed. 
+# 'cache' is the cache directory or a ResultCache; by default it's the 
+# directory in the TOY2D_CACHE environment variable, and cache='' (or no such
+# variable) turns caching off.
 def mainloop(nexpers, nevents0, nevents1, endpoint0=12.0, endpoint1=8.0, 
              lifetime0=260, lifetime1=170, nEbins=4, nTbins=4, outfilename='',
-             minevtsperbin=20, PearsonErrs=True, debug=False):
-    starttime = time.clock()
+             minevtsperbin=20, PearsonErrs=True, membudget=2**28, 
+             genmode='events', batched=True, nworkers=1, seed=None, 
+             outformat='csv', checkpoint=0, resume=False, shard=None,
+             unbinned=False, summaryonly=False, cache=None, progress=10., 
+             profile='', debug=False):
+    if profile:
+        return instrument.profiled(profile, mainloop, nexpers, nevents0, 
+                                   nevents1, endpoint0=endpoint0, 
+                                   endpoint1=endpoint1, lifetime0=lifetime0,
+                                   lifetime1=lifetime1, nEbins=nEbins, 
+                                   nTbins=nTbins, outfilename=outfilename,
+                                   minevtsperbin=minevtsperbin, 
+                                   PearsonErrs=PearsonErrs, 
+                                   membudget=membudget, genmode=genmode,
+                                   batched=batched, nworkers=nworkers, 
+                                   seed=seed, outformat=outformat, 
+                                   checkpoint=checkpoint, resume=resume, 
+                                   shard=shard, unbinned=unbinned, 
+                                   summaryonly=summaryonly, cache=cache,
+                                   progress=progress, debug=debug)
+    starttime = time.time()
 
     nevents = (nevents0, nevents1)
+    pdfsE, pdfsT, fracsE, fracsT, fracs2D = maketemplates(endpoint0, 
+                                                          endpoint1, 
+                                                          lifetime0, 
+                                                          lifetime1, nEbins,
+                                                          nTbins)
+    # Make sure no bin has fewer than 'minevtsperbin' events.
+    checkminbins(minevtsperbin, nevents, fracsE, fracsT, fracs2D)
+
+    if outfilename and os.path.exists(outfilename):
+        print 'Warning: overwriting %s.' % outfilename
+
+    # Everything a worker needs to rebuild the templates and run experiments.
+    config = {'nevents0': nevents0, 'nevents1': nevents1, 
+              'endpoint0': endpoint0, 'endpoint1': endpoint1,
+              'lifetime0': lifetime0, 'lifetime1': lifetime1,
+              'nEbins': nEbins, 'nTbins': nTbins, 'PearsonErrs': PearsonErrs,
+              'membudget': membudget, 'genmode': genmode, 'batched': batched,
+              'unbinned': unbinned, 'seed': seed, 'debug': debug}
+    if seed is None and (nworkers > 1 or shard is not None):
+        print 'Running with nworkers > 1 or in shards needs a seed, so that ' \
+            'every experiment gets its own random stream. Exiting!'
+        sys.exit(1)
+    if (checkpoint > 0 or resume) and not outfilename:
+        print 'Checkpointing needs an outfilename. Exiting!'
+        sys.exit(1)
+
+    # Experiments firstexp, ..., stopexp - 1 are run here.
+    firstexp, stopexp = 0, nexpers
+    if shard is not None: firstexp, stopexp = shardrange(nexpers, *shard)
+    ckptpath = outfilename + '.ckpt'
+    if summaryonly:
+        summary = streamsummary(config, firstexp, stopexp, nworkers, 
+                                outfilename, checkpoint, resume, progress)
+        print 'Main loop finished! Elapsed time: %s' % \
+            (time.time() - starttime)
+        return summary
+    if cache is None: cache = rc.DEFAULT_DIR
+    if cache and not isinstance(cache, rc.ResultCache): 
+        cache = rc.ResultCache(cache)
+    results = resultbuffer(stopexp - firstexp)
+    done = firstexp
+    if resume:
+        done = loadcheckpoint(ckptpath, config, firstexp, stopexp, results)
+    step = checkpoint if checkpoint > 0 else max(1, stopexp - firstexp)
+    reporter = None
+    if progress is not None:
+        reporter = instrument.ProgressReporter(stopexp - firstexp, 
+                                               ndone=done - firstexp,
+                                               interval=progress)
+    compute = lambda start, stop: runexperiments(start, stop, config, 
+                                                 reporter=reporter)
+    if nworkers > 1:
+        compute = lambda start, stop: runparallel(start, stop, config, 
+                                                  nworkers, reporter=reporter)
+    while done < stopexp:
+        segstop = min(done + step, stopexp)
+        out = results[done - firstexp:segstop - firstexp]
+        if cache and seed is not None:
+            ncached = cache.fetch(config, done, segstop, out, compute)
+            if reporter and ncached: reporter.advance(ncached)
+        else:
+            out[:] = compute(done, segstop)
+        done = segstop
+        if checkpoint > 0:
+            savecheckpoint(ckptpath, results[:done - firstexp], config, 
+                           firstexp, stopexp)
+    import pandas as pd
+    data = pd.DataFrame(results, index=np.arange(firstexp, stopexp))
+        
+    # outformat='binary' writes a directory of per-column .npy files (see 
+    # result_store.py) instead of a CSV file. A CSV file gets the same run 
+    # metadata in a sidecar file, so that mergeshards can check it.
+    meta = {'config': config, 'firstexp': firstexp, 'stopexp': stopexp}
+    if outfilename and outformat == 'binary':
+        rs.saveresults(outfilename, results, meta=meta)
+    elif outfilename: 
+        data.to_csv(outfilename)
+        savecsvmeta(outfilename, meta)
+    # The finished output supersedes the checkpoint.
+    if outfilename and os.path.isdir(ckptpath): shutil.rmtree(ckptpath)
+    if cache and seed is not None: print cache.report()
+    print 'Main loop finished! Elapsed time: %s' % (time.time() - starttime)
+    return data
+
+#########################################################################
+# The run metadata of a CSV output ('config', 'firstexp', 'stopexp'; what a
+# result store keeps in its meta.json) lives next to it in 
+# path + CSV_META_SUFFIX.
+CSV_META_SUFFIX = '.meta.json'
+
+def savecsvmeta(path, meta):
+    with open(path + CSV_META_SUFFIX, 'w') as metafile:
+        json.dump(meta, metafile, indent=1, sort_keys=True)
+
+def loadcsvmeta(path):
+    if not os.path.isfile(path + CSV_META_SUFFIX):
+        print 'CSV shard %s has no %s file with its settings, so it cannot ' \
+            'be checked against the other shards. Exiting!' % (
+            path, path + CSV_META_SUFFIX)
+        sys.exit(1)
+    with open(path + CSV_META_SUFFIX) as metafile:
+        return json.load(metafile)
+
+#########################################################################
+# Experiment indices (start, stop) of shard k (counting from 0) when 
+# 'nexpers' experiments are split into 'nshards' contiguous, disjoint slices.
+def shardrange(nexpers, k, nshards):
+    if not 0 <= k < nshards:
+        print 'Shard %s/%s does not exist (expected 0 <= k < N). ' \
+            'Exiting!' % (k, nshards)
+        sys.exit(1)
+    return k*nexpers//nshards, (k + 1)*nexpers//nshards
+
+#########################################################################
+# Save the finished rows 'results' of a run covering experiments firstexp, 
+# ..., stopexp - 1 as a result store at 'path'. Without a seed, the state of
+# numpy's global random stream is saved too, so that a resumed run continues
+# the same stream. The store is written next to 'path' and then moved into 
+# place, so an interruption while saving leaves the previous checkpoint.
+def savecheckpoint(path, results, config, firstexp, stopexp):
+    meta = {'config': config, 'firstexp': firstexp, 'stopexp': stopexp,
+            'completed': firstexp + len(results)}
+    if config['seed'] is None: meta['rngstate'] = getrngstate()
+    tmppath = path + '.tmp'
+    if os.path.isdir(tmppath): shutil.rmtree(tmppath)
+    rs.saveresults(tmppath, results, meta=meta)
+    if os.path.isdir(path): shutil.rmtree(path)
+    os.rename(tmppath, path)
+
+#########################################################################
+# Copy the rows finished in the checkpoint at 'path' into 'results', restore
+# the global random stream if it was saved, and return the index of the next
+# experiment to run. If there is no checkpoint this starts from 'firstexp'; a
+# checkpoint from a run with different settings is an error.
+def loadcheckpoint(path, config, firstexp, stopexp, results):
+    if not rs.isstore(path):
+        print 'No checkpoint found at %s; starting from scratch.' % path
+        return firstexp
+    meta = rs.readmeta(path)['meta']
+    # Round-trip through JSON so e.g. tuples compare equal to lists.
+    if meta['config'] != json.loads(json.dumps(config)) or \
+            (meta['firstexp'], meta['stopexp']) != (firstexp, stopexp):
+        print 'Checkpoint at %s is from a run with different settings. ' \
+            'Exiting!' % path
+        sys.exit(1)
+    ndone = meta['completed'] - firstexp
+    columns = rs.loadcolumns(path, mmap=False)
+    for name in columns: results[name][:ndone] = columns[name]
+    if 'rngstate' in meta: setrngstate(meta['rngstate'])
+    print 'Resuming from experiment %s.' % meta['completed']
+    return meta['completed']
+
+# The state of numpy's global random stream as a JSON-able list, and back.
+def getrngstate():
+    name, keys, pos, hasgauss, cachedgauss = np.random.get_state()
+    return [name, keys.tolist(), pos, hasgauss, cachedgauss]
+
+def setrngstate(state):
+    name, keys, pos, hasgauss, cachedgauss = state
+    np.random.set_state((str(name), np.array(keys, dtype=np.uint32), pos,
+                         hasgauss, cachedgauss))
+
+#########################################################################
+# Experiments per segment of a summaryonly run. Segments end on multiples of
+# STREAM_BLOCK, so the summary doesn't depend on nworkers or membudget.
+STREAM_BLOCK = 2**15
+
+# The summaryonly loop of mainloop: run experiments firstexp, ..., 
+# stopexp - 1 of 'config' a segment at a time, fold each segment's results 
+# into an EnsembleSummary and drop them. With checkpoint=M the summary is 
+# saved to outfilename + '.ckpt' at the first segment boundary after every M
+# experiments, and resume=True continues from there. Returns the summary and,
+# if 'outfilename' is given, saves it there with the run's settings.
+def streamsummary(config, firstexp, stopexp, nworkers=1, outfilename='', 
+                  checkpoint=0, resume=False, progress=10.):
+    nevents = (config['nevents0'], config['nevents1'])
+    fits = list(es.FITS)
+    if not (config['unbinned'] and config['genmode'] == 'events'): 
+        fits.remove('UML')
+    summary = es.EnsembleSummary(nevents, fits)
+    meta = {'config': config, 'firstexp': firstexp, 'stopexp': stopexp}
+    ckptpath = outfilename + '.ckpt'
+    done = firstexp
+    if resume and os.path.isfile(ckptpath):
+        summary, ckptmeta = es.loadsummary(ckptpath)
+        done = ckptmeta.pop('completed')
+        rngstate = ckptmeta.pop('rngstate', None)
+        if ckptmeta != json.loads(json.dumps(meta)):
+            print 'Checkpoint at %s is from a run with different ' \
+                'settings. Exiting!' % ckptpath
+            sys.exit(1)
+        if rngstate is not None: setrngstate(rngstate)
+        print 'Resuming from experiment %s.' % done
+    elif resume:
+        print 'No checkpoint found at %s; starting from scratch.' % ckptpath
+    reporter = None
+    if progress is not None:
+        reporter = instrument.ProgressReporter(stopexp - firstexp, 
+                                               ndone=done - firstexp,
+                                               interval=progress)
+    nextckpt = done + checkpoint
+    while done < stopexp:
+        segstop = min((done//STREAM_BLOCK + 1)*STREAM_BLOCK, stopexp)
+        if nworkers > 1: 
+            segment = runparallel(done, segstop, config, nworkers, 
+                                  reporter=reporter)
+        else:
+            segment = runexperiments(done, segstop, config, 
+                                     reporter=reporter)
+        summary.update(segment)
+        done = segstop
+        if checkpoint > 0 and (done >= nextckpt or done == stopexp):
+            ckptmeta = dict(meta, completed=done)
+            if config['seed'] is None: ckptmeta['rngstate'] = getrngstate()
+            es.savesummary(ckptpath, summary, ckptmeta)
+            nextckpt = done + checkpoint
+    if outfilename: es.savesummary(outfilename, summary, meta)
+    if outfilename and os.path.isfile(ckptpath): os.remove(ckptpath)
+    return summary
+
+#########################################################################
+# Combine the outputs of a sharded run (CSV files or result stores written by
+# mainloop with shard=(k, N)) into 'outfilename', in the same format and with
+# the same contents a single unsharded run would have written. The shards 
+# may be given in any order, but together they must cover experiments 0, 
+# ..., nexpers - 1 exactly once, and come from runs with the same settings 
+# (CSV shards are checked through their CSV_META_SUFFIX files). Shards of a
+# summaryonly run are merged into one summary file instead (whatever 
+# 'outformat'), and that summary is returned.
+def mergeshards(shardpaths, outfilename, outformat='csv'):
+    if shardpaths and all(es.issummary(path) for path in shardpaths):
+        return mergesummaries(shardpaths, outfilename)
+    import pandas as pd
+    pieces, configs = [], []
+    for path in shardpaths:
+        if rs.isstore(path):
+            meta = rs.readmeta(path)['meta']
+            data = rs.loadresults(path)
+            data.index = np.arange(meta['firstexp'], meta['stopexp'])
+            configs.append(meta['config'])
+        else:
+            data = pd.read_csv(path, index_col=0, 
+                               float_precision='round_trip')
+            configs.append(loadcsvmeta(path)['config'])
+        if len(data): pieces.append(data)
+    if any(cfg != configs[0] for cfg in configs):
+        print 'Shards come from runs with different settings. Exiting!'
+        sys.exit(1)
+    pieces.sort(key=lambda data: data.index[0])
+    nexpers = 0
+    for data in pieces:
+        if data.index[0] != nexpers:
+            print 'Shards do not cover experiment %s exactly once. ' \
+                'Exiting!' % nexpers
+            sys.exit(1)
+        nexpers += len(data)
+    merged = pd.concat(pieces)
+    meta = {'config': configs[0] if configs else {}, 'firstexp': 0, 
+            'stopexp': nexpers}
+    if outformat == 'binary':
+        rs.saveresults(outfilename, 
+                       dict((name, merged[name].values) 
+                            for name in merged.columns), meta=meta)
+    else:
+        merged.to_csv(outfilename)
+        savecsvmeta(outfilename, meta)
+    return merged
+
+# mergeshards for the summary files of a summaryonly run.
+def mergesummaries(shardpaths, outfilename):
+    shards = sorted((es.loadsummary(path) for path in shardpaths),
+                    key=lambda shard: shard[1]['firstexp'])
+    if any(meta['config'] != shards[0][1]['config'] for _, meta in shards):
+        print 'Shards come from runs with different settings. Exiting!'
+        sys.exit(1)
+    merged = es.EnsembleSummary(shards[0][0].nevents, shards[0][0].fits)
+    nexpers = 0
+    for summary, meta in shards:
+        if meta['firstexp'] != nexpers:
+            print 'Shards do not cover experiment %s exactly once. ' \
+                'Exiting!' % nexpers
+            sys.exit(1)
+        merged.merge(summary)
+        nexpers = meta['stopexp']
+    es.savesummary(outfilename, merged, {'config': shards[0][1]['config'], 
+                                         'firstexp': 0, 'stopexp': nexpers})
+    return merged
+
+#########################################################################
+# Build the energy and time PDFs for our two 'isotopes' and their vectors of 
+# expected fractional bin content. Returns (pdfsE, pdfsT, fracsE, fracsT, 
+# fracs2D). Everything here comes from the shared template cache in 
+# physicsPDFs, so repeated calls with the same shapes and binning (e.g. in 
+# parameter scans or in every worker process) don't redo any of the work.
+def maketemplates(endpoint0, endpoint1, lifetime0, lifetime1, nEbins, nTbins):
+    key = ('maketemplates', float(endpoint0), float(endpoint1), 
+           float(lifetime0), float(lifetime1), int(nEbins), int(nTbins))
+    return pdfs.cachedtemplate(key, lambda: _buildtemplates(
+            endpoint0, endpoint1, lifetime0, lifetime1, nEbins, nTbins))
+
+def _buildtemplates(endpoint0, endpoint1, lifetime0, lifetime1, nEbins, 
+                    nTbins):
     maxT = max(lifetime0, lifetime1)
     maxE = max(endpoint0, endpoint1)
     # Get energy and time PDFs for our two 'isotopes.'
@@ -44,148 +414,406 @@ def mainloop(nexpers, nevents0, nevents1, endpoint0=12.0, endpoint1=8.0,
     pdfsT = [pdfs.TruncatedExponentialPDF(lifetime0, maxT),
                pdfs.TruncatedExponentialPDF(lifetime1, maxT)]
     # Get vectors of expected fractional bin content.
-    fracsE = [pdfsE[0].binfractionvector(nEbins, (0,maxE)),
-              pdfsE[1].binfractionvector(nEbins, (0,maxE))]
-    fracsT = [pdfsT[0].binfractionvector(nTbins, (0,maxT)),
-                 pdfsT[1].binfractionvector(nTbins, (0,maxT))]
+    fracsE = [pdfs.binfractions(pdfs.ParabolicPDF, (endpoint,), nEbins, 
+                                (0,maxE)) 
+              for endpoint in (endpoint0, endpoint1)]
+    fracsT = [pdfs.binfractions(pdfs.TruncatedExponentialPDF, (lifetime, maxT),
+                                nTbins, (0,maxT)) 
+              for lifetime in (lifetime0, lifetime1)]
     # Take outer product of vectors to get 2-D array. Rows are energy bins,
     # columns are time bins, meaning all events in the same column occurred in
     # the same deltaT window. 
     fracs2D = [np.outer(fracsE[0],fracsT[0]), np.outer(fracsE[1],fracsT[1])]
-    # Make sure no bin has fewer than 'minevtsperbin' events.
-    checkminbins(minevtsperbin, nevents, fracsE, fracsT, fracs2D)
+    for frac in fracs2D: frac.flags.writeable = False
+    return pdfsE, pdfsT, fracsE, fracsT, fracs2D
 
-    if outfilename and os.path.exists(outfilename):
-        print 'Warning: overwriting %s.' % outfilename
+#########################################################################
+# Generate and fit experiments start, ..., stop - 1 for the settings in 
+# 'config' (see mainloop), returning their outputs in a buffer made by 
+# 'resultbuffer()'. 'reporter' (an instrument.ProgressReporter) is advanced as
+# experiments finish, and the time of each stage is passed to the hooks in 
+# instrument.HOOKS.
+def runexperiments(start, stop, config, reporter=None):
+    nevents = (config['nevents0'], config['nevents1'])
+    nEbins, nTbins = config['nEbins'], config['nTbins']
+    PearsonErrs, batched = config['PearsonErrs'], config['batched']
+    unbinned, debug = config['unbinned'], config['debug']
+    maxT = max(config['lifetime0'], config['lifetime1'])
+    maxE = max(config['endpoint0'], config['endpoint1'])
+    pdfsE, pdfsT, fracsE, fracsT, fracs2D = \
+        maketemplates(config['endpoint0'], config['endpoint1'], 
+                      config['lifetime0'], config['lifetime1'], nEbins, nTbins)
 
-    data = pd.DataFrame(outdict(nexpers))
-    # Loop over fake experiments
-    for i in xrange(nexpers):
-        print 'Experiment number %s' % i
-        # Create arrays of fake events
-        dataE, dataT = throwexperiment(nevents, pdfsE, pdfsT)
-        # Bin events
-        histE = np.histogram(dataE, bins=nEbins, range=(0,maxE))
-        histT = np.histogram(dataT, bins=nTbins, range=(0,maxT))
-        # Bin 2-D data and match pattern of fracs2D by having time vary by 
-        # column and energy by row.
-        hist2D = np.histogram2d(dataE, dataT, bins=(nEbins,nTbins),
-                                range=((0., maxE), (0., maxT)))        
-        # Chi-square min. fit of two 1-D histograms        
-        nfit1D, cov1D, chi1D, pval1D = fit1D(histE[0], histT[0], fracsE, 
-                                             fracsT, nevents, 
-                                             PearsonErrs=PearsonErrs,
-                                             debug=debug)
-        # Max. likelihood fit of two 1-D histograms
-        nfit1Dml, fncmin1D = mlfit1D(histE[0], histT[0], fracsE, fracsT, 
-                                     nevents, debug=debug)
-        # Chi-square min. fit of one 2-d histogram
-        nfit2D, cov2D, chi2D, pval2D = fit2D(hist2D[0],fracs2D, nevents,
-                                             PearsonErrs=PearsonErrs,
-                                             debug=debug)
-        # Max. likelihood fit of one 2-D histogram
-        nfit2Dml, fncmin2D = mlfit2D(hist2D[0],fracs2D, nevents, debug=debug)
-        # Fill outputs into dataframe
-        adddata(data, i, nfit1D, cov1D, chi1D, pval1D, nfit2D, cov2D, chi2D,
-                pval2D, nfit1Dml, fncmin1D, nfit2Dml, fncmin2D)
-        
-    if outfilename: data.to_csv(outfilename)
-    print 'Main loop finished! Elapsed time: %s' % (time.clock() - starttime)
-
-#########################################################################
-# This fills a dataframe built from the output of 'outdict()' with a given fake
-# experiment's outputs.
-def adddata(df, i, nfit1D, cov1D, chi1D, pval1D, nfit2D, cov2D, chi2D, pval2D,
-            nfit1DML, fncmin1D, nfit2DML, fncmin2D): 
-    # 1-D chi square outputs
-    df['n0_1D'][i], df['n1_1D'][i] = nfit1D[0], nfit1D[1]
-    df['var00_1D'][i], df['var01_1D'][i], df['var11_1D'][i] = cov1D[0][0],\
-                                                              cov1D[0][1],\
-                                                              cov1D[1][1]
-    df['chi_1D'][i], df['pval_1D'][i] = chi1D, pval1D
-    # 2-D chi square outputs
-    df['n0_2D'][i], df['n1_2D'][i] = nfit2D[0], nfit2D[1]
-    df['var00_2D'][i], df['var01_2D'][i], df['var11_2D'][i] = cov2D[0][0],\
-                                                              cov2D[0][1],\
-                                                              cov2D[1][1]
-    df['chi_2D'][i], df['pval_2D'][i] = chi2D, pval2D
-    # Max. likelihood outputs
-    df['n0_1DML'][i], df['n1_1DML'][i] = nfit1DML[0], nfit1DML[1]
-    df['n0_2DML'][i], df['n1_2DML'][i] = nfit2DML[0], nfit2DML[1]
-    df['fncmin_1DML'][i], df['fncmin_2DML'][i] = fncmin1D, fncmin2D
-
-#########################################################################
-# This creates a dict for outputting the data. Each value in the dict is an 
-# array of length 'nexps.'
-def outdict(nexps):
-    return {'n0_1D': np.zeros(nexps), 'n1_1D': np.zeros(nexps),
-            'var00_1D': np.zeros(nexps), 'var01_1D': np.zeros(nexps),
-            'var11_1D': np.zeros(nexps), 'chi_1D': np.zeros(nexps),
-            'pval_1D': np.zeros(nexps), 'n0_2D': np.zeros(nexps),
-            'n1_2D': np.zeros(nexps), 'var00_2D': np.zeros(nexps),
-            'var01_2D': np.zeros(nexps), 'var11_2D': np.zeros(nexps),
-            'chi_2D': np.zeros(nexps), 'pval_2D': np.zeros(nexps),
-            'n0_1DML': np.zeros(nexps), 'n1_1DML': np.zeros(nexps),
-            'fncmin_1DML': np.zeros(nexps), 'n0_2DML': np.zeros(nexps),
-            'n1_2DML': np.zeros(nexps), 'fncmin_2DML': np.zeros(nexps)}
+    results = resultbuffer(stop - start)
+    # Loop over blocks of fake experiments. Each block's events are generated
+    # and binned with whole-block array operations; 'membudget' (in bytes) 
+    # sets how many experiments go into a block. With genmode='binned' the 
+    # histograms are drawn directly from fracs2D instead of from events. With
+    # unbinned=True the events are also fitted unbinned (see unbinned_fits.py)
+    # from their matrix of per-event component densities.
+    bytesperevent = BYTES_PER_EVENT + (BYTES_PER_EVENT_UML if unbinned else 0)
+    blocks = experimentblocks(stop - start, nevents, pdfsE, pdfsT, nEbins, 
+                              nTbins, maxE, maxT, 
+                              membudget=config['membudget'], 
+                              genmode=config['genmode'], fracs2D=fracs2D,
+                              seed=config['seed'], firstexp=start,
+                              bytesperevent=bytesperevent)
+    tic = time.time()
+    for blockstart, blockstop, hists2D, events in blocks:
+        if not unbinned: events = None
+        instrument.runhooks('generate', blockstart, blockstop, 
+                            time.time() - tic)
+        # With batched=True all fits of the whole block are done at once (see
+        # batch_fits.py) rather than by leastsq/fmin_bfgs per experiment, and
+        # their outputs are written into the buffer in bulk. Each fit's time
+        # is then shared equally among the experiments of the block.
+        if batched:
+            histsE, histsT = hists2D.sum(axis=2), hists2D.sum(axis=1)
+            fits, diagnostics = {}, {}
+            for fit, stage, fitter, args in [
+                    ('1D', 'fit1D', bf.batchfit1D, 
+                     (histsE, histsT, fracsE, fracsT, PearsonErrs)),
+                    ('2D', 'fit2D', bf.batchfit2D, 
+                     (hists2D, fracs2D, PearsonErrs)),
+                    ('1DML', 'mlfit1D', bf.batchmlfit1D, 
+                     (histsE, histsT, fracsE, fracsT)),
+                    ('2DML', 'mlfit2D', bf.batchmlfit2D, (hists2D, fracs2D)),
+                    ('UML', 'umlfit', ub.fitevents, 
+                     (pdfsE, pdfsT) + (events or ()))]:
+                if fit == 'UML' and events is None: continue
+                tic = time.time()
+                out = fitter(*args, full_output=True)
+                seconds = time.time() - tic
+                instrument.runhooks(stage, blockstart, blockstop, seconds)
+                fits[fit], info = out[:-1], out[-1]
+                diagnostics[fit] = (info['converged'], info['nfev'], 
+                                    seconds/(blockstop - blockstart))
+            tic = time.time()
+            addblock(results[blockstart - start:blockstop - start],
+                     fits['1D'], fits['2D'], fits['1DML'], fits['2DML'],
+                     umlfits=fits.get('UML'), diagnostics=diagnostics)
+            instrument.runhooks('fill', blockstart, blockstop, 
+                                time.time() - tic)
+            if reporter: reporter.advance(blockstop - blockstart)
+            tic = time.time()
+            continue
+        stagetimes = dict.fromkeys(['fit1D', 'fit2D', 'mlfit1D', 'mlfit2D',
+                                    'umlfit', 'fill'], 0.)
+        for i in xrange(blockstart, blockstop):
+            if debug: print 'Experiment number %s' % i
+            # Rows of hist2D are energy bins and columns are time bins, 
+            # matching the pattern of fracs2D. The 1-D histograms are its 
+            # projections.
+            hist2D = hists2D[i - blockstart]
+            histE, histT = hist2D.sum(axis=1), hist2D.sum(axis=0)
+            # Chi-square min. fit of two 1-D histograms        
+            tic = time.time()
+            nfit1D, cov1D, chi1D, pval1D, info1D = \
+                fit1D(histE, histT, fracsE, fracsT, nevents, 
+                      PearsonErrs=PearsonErrs, debug=debug, full_output=True)
+            time1D = time.time() - tic
+            # Max. likelihood fit of two 1-D histograms
+            tic = time.time()
+            nfit1Dml, fncmin1D, info1Dml = \
+                mlfit1D(histE, histT, fracsE, fracsT, nevents, debug=debug, 
+                        full_output=True)
+            time1Dml = time.time() - tic
+            # Chi-square min. fit of one 2-d histogram
+            tic = time.time()
+            nfit2D, cov2D, chi2D, pval2D, info2D = \
+                fit2D(hist2D, fracs2D, nevents, PearsonErrs=PearsonErrs, 
+                      debug=debug, full_output=True)
+            time2D = time.time() - tic
+            # Max. likelihood fit of one 2-D histogram
+            tic = time.time()
+            nfit2Dml, fncmin2D, info2Dml = \
+                mlfit2D(hist2D, fracs2D, nevents, debug=debug, 
+                        full_output=True)
+            time2Dml = time.time() - tic
+            diagnostics = {'1D': (info1D['converged'], info1D['nfev'], 
+                                  time1D),
+                           '2D': (info2D['converged'], info2D['nfev'], 
+                                  time2D),
+                           '1DML': (info1Dml['converged'], info1Dml['nfev'],
+                                    time1Dml),
+                           '2DML': (info2Dml['converged'], info2Dml['nfev'],
+                                    time2Dml)}
+            # Unbinned extended max. likelihood fit of the events
+            nfitUml, fncminUml, timeUml = None, np.nan, 0.
+            if events is not None:
+                tic = time.time()
+                nfitUml, fncminUml, infoUml = \
+                    ub.fitevents(pdfsE, pdfsT, *[[data[i - blockstart:
+                                                       i - blockstart + 1]
+                                                  for data in datalist]
+                                                 for datalist in events],
+                                 full_output=True)
+                nfitUml, fncminUml = nfitUml[0], fncminUml[0]
+                timeUml = time.time() - tic
+                diagnostics['UML'] = (infoUml['converged'][0], 
+                                      infoUml['nfev'][0], timeUml)
+            # Fill outputs
+            tic = time.time()
+            adddata(results, i - start, nfit1D, cov1D, chi1D, pval1D, nfit2D,
+                    cov2D, chi2D, pval2D, nfit1Dml, fncmin1D, nfit2Dml, 
+                    fncmin2D, nfitUML=nfitUml, fncminUML=fncminUml,
+                    diagnostics=diagnostics)
+            for stage, seconds in [('fit1D', time1D), ('fit2D', time2D),
+                                   ('mlfit1D', time1Dml), 
+                                   ('mlfit2D', time2Dml), 
+                                   ('umlfit', timeUml),
+                                   ('fill', time.time() - tic)]:
+                stagetimes[stage] += seconds
+            if reporter: reporter.advance(1)
+        for stage in ['fit1D', 'fit2D', 'mlfit1D', 'mlfit2D', 'umlfit', 
+                      'fill']:
+            instrument.runhooks(stage, blockstart, blockstop, 
+                                stagetimes[stage])
+        tic = time.time()
+    return results
+
+#########################################################################
+# Run experiments start, ..., stop - 1 of 'config' on a pool of 'nworkers' 
+# processes. The experiments are split into contiguous chunks (a few per 
+# worker, to balance the load) and the chunks' outputs are concatenated back 
+# in order. Since every experiment has its own random stream and the batched
+# fits treat each experiment independently, the result doesn't depend on how
+# the experiments were split up. A 'reporter' (see instrument.py) is advanced
+# as chunks come back.
+def runparallel(start, stop, config, nworkers, reporter=None):
+    nchunks = max(1, min(stop - start, 4*nworkers))
+    edges = np.linspace(start, stop, nchunks + 1).astype(int)
+    pool = multiprocessing.Pool(nworkers)
+    try:
+        chunks = []
+        for chunk in pool.imap(_runchunk, [(edges[k], edges[k+1], config) 
+                                           for k in xrange(nchunks)]):
+            chunks.append(chunk)
+            if reporter: reporter.advance(len(chunk))
+    finally:
+        pool.close()
+        pool.join()
+    return np.concatenate(chunks)
+
+# Pool workers can only call module-level functions with a single argument.
+def _runchunk(args):
+    return runexperiments(*args)
+
+#########################################################################
+# Rerun experiment 'i' of a seeded mainloop run on its own, e.g. to look at
+# one failed or odd fit out of millions. Experiment i only depends on its own
+# stream experimentrng(seed, i), so it comes back exactly as in the original
+# run, however many experiments, workers or shards that run had, as long as
+# the other settings match it. This prints the experiment's 2-D histogram,
+# the debug output of fit1D, fit2D, mlfit1D and mlfit2D, and the result row
+# of those per-experiment fitters next to that of the batched fits (what a
+# run with batched=True stored for it). Returns the two rows as a
+# resultbuffer of length 2 (per-experiment first, then batched).
+def replay(i, seed, nevents0, nevents1, endpoint0=12.0, endpoint1=8.0,
+           lifetime0=260, lifetime1=170, nEbins=4, nTbins=4,
+           PearsonErrs=True, genmode='events', unbinned=False):
+    config = {'nevents0': nevents0, 'nevents1': nevents1,
+              'endpoint0': endpoint0, 'endpoint1': endpoint1,
+              'lifetime0': lifetime0, 'lifetime1': lifetime1,
+              'nEbins': nEbins, 'nTbins': nTbins, 'PearsonErrs': PearsonErrs,
+              'membudget': 2**28, 'genmode': genmode, 'batched': False,
+              'unbinned': unbinned, 'seed': seed, 'debug': True}
+    fracs2D = maketemplates(endpoint0, endpoint1, lifetime0, lifetime1,
+                            nEbins, nTbins)[4]
+    hist2D = experimentblocks(1, (nevents0, nevents1), *maketemplates(
+            endpoint0, endpoint1, lifetime0, lifetime1, nEbins, nTbins)[:2] +
+                              (nEbins, nTbins, max(endpoint0, endpoint1),
+                               max(lifetime0, lifetime1)), genmode=genmode,
+                              fracs2D=fracs2D, seed=seed,
+                              firstexp=i).next()[2][0]
+    print 'Replaying experiment %s of seed %s (%s mode).' % (i, seed, genmode)
+    print '2-D histogram (rows: energy bins, columns: time bins):'
+    print hist2D
+    rows = resultbuffer(2)
+    rows[0] = runexperiments(i, i + 1, config)[0]
+    rows[1] = runexperiments(i, i + 1, dict(config, batched=True,
+                                            debug=False))[0]
+    print '%14s %18s %18s' % ('column', 'per-experiment', 'batched')
+    for name in RESULT_COLUMNS + UNBINNED_COLUMNS + DIAGNOSTIC_COLUMNS:
+        if name.startswith('time_'): continue
+        print '%14s %18.10g %18.10g' % (name, rows[0][name], rows[1][name])
+    return rows
+
+#########################################################################
+# Names of the per-experiment output columns, in the order they're stored.
+RESULT_COLUMNS = ['chi_1D', 'chi_2D', 'fncmin_1DML', 'fncmin_2DML', 'n0_1D',
+                  'n0_1DML', 'n0_2D', 'n0_2DML', 'n1_1D', 'n1_1DML', 'n1_2D',
+                  'n1_2DML', 'pval_1D', 'pval_2D', 'var00_1D', 'var00_2D', 
+                  'var01_1D', 'var01_2D', 'var11_1D', 'var11_2D']
+# Outputs of the unbinned extended ML fit (see unbinned_fits.py), stored 
+# after them. They are NaN when there are no events to fit, i.e. with 
+# genmode='binned' or unbinned=False.
+UNBINNED_COLUMNS = ['fncmin_UML', 'n0_UML', 'n1_UML']
+# Names of the per-fit diagnostic columns stored last: whether the fit
+# converged (1 or 0), how many times it evaluated its objective (nfev) and its
+# wall time in seconds, or NaN for fits that weren't run. Batched fits share 
+# each block's time equally among its experiments. The times are the only 
+# outputs that differ between otherwise identical runs.
+FITS = ['1D', '2D', '1DML', '2DML', 'UML']
+DIAGNOSTIC_COLUMNS = ['%s_%s' % (name, fit) for name in ['converged', 'nfev',
+                                                          'time']
+                      for fit in FITS]
+
+#########################################################################
+# This creates the output buffer: a structured array of length 'nexps' with 
+# one float64 field per name in RESULT_COLUMNS, UNBINNED_COLUMNS and 
+# DIAGNOSTIC_COLUMNS, i.e. one compact record per experiment. It can be 
+# handed straight to pd.DataFrame or to result_store.saveresults. The 
+# unbinned and diagnostic columns start out as NaN.
+def resultbuffer(nexps):
+    buf = np.zeros(nexps, dtype=[(name, 'f8') for name in RESULT_COLUMNS + 
+                                 UNBINNED_COLUMNS + DIAGNOSTIC_COLUMNS])
+    for name in UNBINNED_COLUMNS + DIAGNOSTIC_COLUMNS: buf[name] = np.nan
+    return buf
+
+#########################################################################
+# This fills row 'i' of a buffer made by 'resultbuffer()' with a given fake
+# experiment's outputs. The unbinned fit's outputs (nfitUML, fncminUML) are
+# optional. 'diagnostics' maps each fit in FITS that was run to a tuple 
+# (converged, nfev, seconds); the diagnostic columns of the others are NaN.
+def adddata(buf, i, nfit1D, cov1D, chi1D, pval1D, nfit2D, cov2D, chi2D, pval2D,
+            nfit1DML, fncmin1D, nfit2DML, fncmin2D, nfitUML=None, 
+            fncminUML=np.nan, diagnostics=None): 
+    if nfitUML is None: nfitUML = (np.nan, np.nan)
+    diagnostics = diagnostics or {}
+    diag = tuple(diagnostics[fit][k] if fit in diagnostics else np.nan
+                 for k in xrange(3) for fit in FITS)
+    buf[i] = (chi1D, chi2D, fncmin1D, fncmin2D, nfit1D[0], nfit1DML[0], 
+              nfit2D[0], nfit2DML[0], nfit1D[1], nfit1DML[1], nfit2D[1],
+              nfit2DML[1], pval1D, pval2D, cov1D[0][0], cov2D[0][0], 
+              cov1D[0][1], cov2D[0][1], cov1D[1][1], cov2D[1][1], 
+              fncminUML, nfitUML[0], nfitUML[1]) + diag
+
+#########################################################################
+# Bulk version of adddata: fill a slice of a 'resultbuffer()' with the 
+# outputs of the batched fits (see batch_fits.py) of a block of experiments.
+# 'umlfits' is the (pfit, fncmin) of unbinned_fits.umlfit, if it was run, and
+# 'diagnostics' is as for adddata, with arrays (or scalars) in the tuples.
+def addblock(buf, fits1D, fits2D, mlfits1D, mlfits2D, umlfits=None,
+             diagnostics=None):
+    for dim, (nfit, cov, chi, pval) in [('1D', fits1D), ('2D', fits2D)]:
+        buf['n0_' + dim], buf['n1_' + dim] = nfit[:,0], nfit[:,1]
+        buf['var00_' + dim] = cov[:,0,0]
+        buf['var01_' + dim] = cov[:,0,1]
+        buf['var11_' + dim] = cov[:,1,1]
+        buf['chi_' + dim], buf['pval_' + dim] = chi, pval
+    mlfits = [('1DML', mlfits1D), ('2DML', mlfits2D)]
+    if umlfits is not None: mlfits.append(('UML', umlfits))
+    for dim, (nfit, fncmin) in mlfits:
+        buf['n0_' + dim], buf['n1_' + dim] = nfit[:,0], nfit[:,1]
+        buf['fncmin_' + dim] = fncmin
+    for fit, (converged, nfev, seconds) in (diagnostics or {}).items():
+        buf['converged_' + fit] = converged
+        buf['nfev_' + fit] = nfev
+        buf['time_' + fit] = seconds
 
 #########################################################################
 # Find best fit 'isotope' rates for the energy and time variables binned
 # separately by maximizing likelihood.
-def mlfit1D(binnedE, binnedT, fracsE, fracsT, nevents, debug=False):
+#
+# All four fitters below pass the optimizer the analytic derivatives of the 
+# linear model (see poissongrad and chi2jacobian) and start it from the 
+# closed-form chi^2 estimate (chi2estimate) rather than from the true 
+# 'nevents'. analytic=False restores finite differences started from 
+# 'nevents', e.g. to compare function-evaluation counts (see 
+# comparederivatives). With full_output=True the diagnostics dict has 'nfev',
+# the number of objective evaluations (including any spent on finite 
+# differences), and 'njev', the number of analytic derivative evaluations.
+def mlfit1D(binnedE, binnedT, fracsE, fracsT, nevents, debug=False, 
+            full_output=False, analytic=True):
     # Concatenate data and prediction vectors
     datavec = np.append(binnedE,binnedT)
     fracvec = [np.append(fracsE[0],fracsT[0]), np.append(fracsE[1],fracsT[1])]
     fnc = lambda p: -np.sum(np.log(st.poisson.pmf(datavec, fracvec[0]*p[0]
                                                   + fracvec[1]*p[1])))
-    pfit, fncmin, mingrad, invhess, ncalls, ngradcalls, wflag = \
-        sp.optimize.fmin_bfgs(fnc, nevents, full_output=1, disp=True)
+    if analytic:
+        pfit, fncmin, mingrad, invhess, ncalls, ngradcalls, wflag = \
+            scipy.optimize.fmin_bfgs(fnc, chi2estimate(datavec, fracvec), 
+                                     fprime=poissongrad(datavec, fracvec),
+                                     full_output=1, disp=True)
+    else:
+        pfit, fncmin, mingrad, invhess, ncalls, ngradcalls, wflag = \
+            scipy.optimize.fmin_bfgs(fnc, nevents, full_output=1, disp=True)
+        ngradcalls = 0
     #pfit, fncmin, direc, niter, ncalls, wflag = \
-    #    sp.optimize.fmin_powell(fnc, nevents, full_output=True, disp=True)
+    #    scipy.optimize.fmin_powell(fnc, nevents, full_output=True, disp=True)
     if debug:
         print '---------------------- 1-D ML Fit -----------------------------'
         print 'Best fits: %s' % pfit
         print 'Min. fnc. val: %s' % fncmin
         print 'Num. fnc. calls: %s' % ncalls
+        print 'Num. grad. calls: %s' % ngradcalls
         print '---------------------------------------------------------------'
+    if full_output:
+        return pfit, fncmin, {'converged': wflag == 0, 'nfev': ncalls,
+                              'njev': ngradcalls}
     return pfit, fncmin
 
 #########################################################################
 # Find best fit 'isotope' rates when time and energy variables of fake data are
 # binned together in 2-D histogram
-def mlfit2D(binneddata, fracs2D, nevents, debug=False):
+def mlfit2D(binneddata, fracs2D, nevents, debug=False, full_output=False,
+            analytic=True):
     # Concatenate data and prediction vectors
     datavec = binneddata.flatten()
     predfunc = lambda p: p[0]*fracs2D[0].flatten() + p[1]*fracs2D[1].flatten()
+    predvec = [fracs2D[0].flatten(), fracs2D[1].flatten()]
 
     fnc = lambda p: -np.sum(np.log(st.poisson.pmf(datavec, predfunc(p))))
-    pfit, fncmin, mingrad, invhess, ncalls, ngradcalls, wflag = \
-        sp.optimize.fmin_bfgs(fnc, nevents, full_output=1, disp=True)
+    if analytic:
+        pfit, fncmin, mingrad, invhess, ncalls, ngradcalls, wflag = \
+            scipy.optimize.fmin_bfgs(fnc, chi2estimate(datavec, predvec), 
+                                     fprime=poissongrad(datavec, predvec),
+                                     full_output=1, disp=True)
+    else:
+        pfit, fncmin, mingrad, invhess, ncalls, ngradcalls, wflag = \
+            scipy.optimize.fmin_bfgs(fnc, nevents, full_output=1, disp=True)
+        ngradcalls = 0
     #pfit, fncmin, direc, niter, ncalls, wflag = \
-    #    sp.optimize.fmin_powell(fnc, nevents, full_output=True, disp=True)
+    #    scipy.optimize.fmin_powell(fnc, nevents, full_output=True, disp=True)
     if debug:
         print '---------------------- 2-D ML Fit -----------------------------'
         print 'Best fits: %s' % pfit
         print 'Min. fnc. val: %s' % fncmin
         print 'Num. fnc. calls: %s' % ncalls
+        print 'Num. grad. calls: %s' % ngradcalls
         print '---------------------------------------------------------------'
+    if full_output:
+        return pfit, fncmin, {'converged': wflag == 0, 'nfev': ncalls,
+                              'njev': ngradcalls}
     return pfit, fncmin
 
 #########################################################################
 # Find best fit 'isotope' rates by minimizing a chi-square (treats Poisson 
 # errors as Gaussian) when time and energy variables of fake data are binned 
 # together in 2-D histogram 
-def fit2D(binneddata, fracs2D, nevents, PearsonErrs=True, debug=False):
+def fit2D(binneddata, fracs2D, nevents, PearsonErrs=True, debug=False,
+          full_output=False, analytic=True):
     datavec = binneddata.flatten()
     predfunc = lambda p: p[0]*fracs2D[0].flatten() + p[1]*fracs2D[1].flatten()
+    predvec = [fracs2D[0].flatten(), fracs2D[1].flatten()]
     func = lambda : 1
     if PearsonErrs: func = lambda p: (datavec - predfunc(p))/np.sqrt(predfunc(p))
-    else: func = lambda p: (datavec - predfunc(p))/np.sqrt(datavec)
-    pfit, pcov, infodict, errmsg, success = sp.optimize.leastsq(func, nevents,
-                                                                full_output=1)
+    else: func = lambda p: (datavec - predfunc(p))/np.sqrt(np.maximum(datavec,
+                                                                     1.))
+    if analytic:
+        pfit, pcov, infodict, errmsg, success = \
+            scipy.optimize.leastsq(func, chi2estimate(datavec, predvec), 
+                                   Dfun=chi2jacobian(datavec, predvec, 
+                                                     PearsonErrs), 
+                                   full_output=1)
+    else:
+        pfit, pcov, infodict, errmsg, success = \
+            scipy.optimize.leastsq(func, nevents, full_output=1)
+        infodict['njev'] = 0
     chi2 = sum([elem**2 for elem in infodict['fvec']])
     dof = binneddata.size - 2
-    pval = st.chisqprob(chi2, dof)
+    pval = st.chi2.sf(chi2, dof)
     if debug:
         print '---------------------- 2-D Fit --------------------------------'
         print 'Best fits: %s' % pfit
@@ -193,14 +821,21 @@ def fit2D(binneddata, fracs2D, nevents, PearsonErrs=True, debug=False):
         print 'Chi^2: %s' % chi2
         print 'd.o.f.: %s' % dof
         print 'P-value: %s' % pval
+        print 'Num. fnc. calls: %s' % infodict['nfev']
+        print 'Num. Jacobian calls: %s' % infodict['njev']
         print '---------------------------------------------------------------'
+    # leastsq signals a solution with success = 1, 2, 3 or 4.
+    if full_output:
+        return pfit, pcov, chi2, pval, {'converged': success in (1, 2, 3, 4),
+                                        'nfev': infodict['nfev'],
+                                        'njev': infodict['njev']}
     return pfit, pcov, chi2, pval
 
 #########################################################################
 # Find best fit 'isotope' rates for the energy and time variables binned
 # separately by minimizing a chi-square (treats Poisson errors as Gaussian).
 def fit1D(binnedE, binnedT, fracsE, fracsT, nevents, PearsonErrs=True,
-          debug=False):
+          debug=False, full_output=False, analytic=True):
     # Concatenate data and prediction vectors
     datavec = np.append(binnedE,binnedT)
     predvec = [np.append(fracsE[0],fracsT[0]), np.append(fracsE[1],fracsT[1])]
@@ -208,14 +843,23 @@ def fit1D(binnedE, binnedT, fracsE, fracsT, nevents, PearsonErrs=True,
     predfunc = lambda p: p[0]*predvec[0] + p[1]*predvec[1]
     func = lambda : 1
     if PearsonErrs: func = lambda p: (datavec - predfunc(p))/np.sqrt(predfunc(p))
-    else: func = lambda p: (datavec - predfunc(p))/np.sqrt(datavec)
+    else: func = lambda p: (datavec - predfunc(p))/np.sqrt(np.maximum(datavec,
+                                                                     1.))
 
-    pfit, pcov, infodict, errmsg, success = sp.optimize.leastsq(func, nevents,
-                                                                full_output=1)
+    if analytic:
+        pfit, pcov, infodict, errmsg, success = \
+            scipy.optimize.leastsq(func, chi2estimate(datavec, predvec), 
+                                   Dfun=chi2jacobian(datavec, predvec, 
+                                                     PearsonErrs), 
+                                   full_output=1)
+    else:
+        pfit, pcov, infodict, errmsg, success = \
+            scipy.optimize.leastsq(func, nevents, full_output=1)
+        infodict['njev'] = 0
     chi2 = sum([elem**2 for elem in infodict['fvec']]) 
     #mychi2 = sum([(datavec[i] - predfunc(pfit)[i])**2./predfunc(pfit)[i] for i in xrange(len(datavec))])  ### This just equals 'chi2' calculated above
     dof = datavec.size - 2
-    pval = st.chisqprob(chi2, dof)
+    pval = st.chi2.sf(chi2, dof)
     if debug:
         print '---------------------- 1-D Fit --------------------------------'
         print 'Best fits: %s' % pfit
@@ -223,34 +867,305 @@ def fit1D(binnedE, binnedT, fracsE, fracsT, nevents, PearsonErrs=True,
         print 'Chi^2: %s' % chi2
         print 'd.o.f.: %s' % dof
         print 'P-value: %s' % pval
+        print 'Num. fnc. calls: %s' % infodict['nfev']
+        print 'Num. Jacobian calls: %s' % infodict['njev']
         print '---------------------------------------------------------------'
+    # leastsq signals a solution with success = 1, 2, 3 or 4.
+    if full_output:
+        return pfit, pcov, chi2, pval, {'converged': success in (1, 2, 3, 4),
+                                        'nfev': infodict['nfev'],
+                                        'njev': infodict['njev']}
     return pfit, pcov, chi2, pval
 
+#########################################################################
+# Derivatives and starting point for the fitters above. The model is linear,
+# mu = p[0]*predvec[0] + p[1]*predvec[1], so all of them are closed-form in
+# the template fractions.
+#
+# Closed-form minimum of the Neyman chi^2 sum (d - mu)^2/d, i.e. the weighted
+# least-squares solution (as in batch_fits.chi2fit; empty bins get weight 1).
+def chi2estimate(datavec, predvec):
+    weights = 1./np.maximum(datavec, 1.)
+    F = np.column_stack(predvec)
+    return np.linalg.solve(np.dot(F.T*weights, F), 
+                           np.dot(F.T*weights, datavec))
+
+# Dfun for leastsq: the (nbins x 2) Jacobian of the residuals 
+# (d - mu)/sqrt(mu) (Pearson), whose derivative is -f_k (d + mu)/(2 mu^3/2),
+# or (d - mu)/sqrt(d) (Neyman; empty bins get unit error), whose derivative
+# is -f_k/sqrt(d).
+def chi2jacobian(datavec, predvec, PearsonErrs=True):
+    F = np.column_stack(predvec)
+    if not PearsonErrs: 
+        return lambda p: -F/np.sqrt(np.maximum(datavec, 1.))[:,np.newaxis]
+    def jacobian(p):
+        mu = np.dot(F, p)
+        return -F*((datavec + mu)/(2.*mu**1.5))[:,np.newaxis]
+    return jacobian
+
+# fprime for fmin_bfgs: the gradient of the Poisson NLL, 
+# dNLL/dp_k = sum_i f_ik (1 - d_i/mu_i).
+def poissongrad(datavec, predvec):
+    F = np.column_stack(predvec)
+    return lambda p: np.dot(F.T, 1. - datavec/np.dot(F, p))
+
 #########################################################################
 # Create arrays of energy and deltaT points drawn from the energy and time PDFs
 # of our two 'isotopes'.
 def throwexperiment(nevents, pdfsE, pdfsT):
-    energyarr = np.array([])
-    timearr = np.array([])
+    energyarr = np.empty(sum(nevents))
+    timearr = np.empty(sum(nevents))
+    start = 0
     for niso in xrange(len(nevents)):
-        energyarr = np.append(energyarr,pdfsE[niso].rvs(size=nevents[niso]))
-        timearr = np.append(timearr,pdfsT[niso].rvs(size=nevents[niso]))
+        stop = start + nevents[niso]
+        energyarr[start:stop] = pdfsE[niso].rvs(size=nevents[niso])
+        timearr[start:stop] = pdfsT[niso].rvs(size=nevents[niso])
+        start = stop
     return energyarr, timearr
 
+#########################################################################
+# Random stream of experiment number 'i' for a given base 'seed'. Each 
+# experiment's stream depends only on (seed, i), so any experiment can be 
+# regenerated on its own and experiments can be spread over workers in any 
+# way without changing the results.
+def experimentrng(seed, i):
+    return np.random.RandomState([seed, i])
+
+#########################################################################
+# Same as throwexperiment, but for 'nexps' experiments at once. This returns 
+# lists (one entry per 'isotope') of energy and deltaT matrices with shape 
+# (nexps, nevents[niso]), each filled by a single vectorized draw. If 'rngs' 
+# (one random stream per experiment, see experimentrng) is given, each 
+# experiment's uniform draws come from its own stream instead of 'rng'; they 
+# are still pushed through the inverse cdfs as whole matrices.
+def throwexperiments(nexps, nevents, pdfsE, pdfsT, rng=np.random, rngs=None):
+    dataE, dataT = [], []
+    if rngs is None:
+        for niso in xrange(len(nevents)):
+            energymat, timemat = pdfs.sampleevents(pdfsE[niso], pdfsT[niso],
+                                                   (nexps, nevents[niso]), rng)
+            dataE.append(energymat)
+            dataT.append(timemat)
+        return dataE, dataT
+    uniforms = [np.empty((2, nexps, nevts)) for nevts in nevents]
+    for j in xrange(nexps):
+        for niso in xrange(len(nevents)):
+            uniforms[niso][:,j] = rngs[j].random_sample((2, nevents[niso]))
+    for niso in xrange(len(nevents)):
+        dataE.append(pdfsE[niso]._ppf(uniforms[niso][0]))
+        dataT.append(pdfsT[niso]._ppf(uniforms[niso][1]))
+    return dataE, dataT
+
+#########################################################################
+# Bin the output of throwexperiments into one 2-D (energy x deltaT) histogram
+# per experiment, returned as an array of shape (nexps, nEbins, nTbins). 
+# Rather than calling np.histogram2d once per experiment, every event gets a 
+# flat index (experiment, energy bin, time bin) and the whole block is counted
+# by a single np.bincount. As in np.histogram, values equal to the upper edge 
+# of the range land in the last bin.
+def histogramexperiments(dataE, dataT, nEbins, nTbins, maxE, maxT):
+    nexps = dataE[0].shape[0]
+    nbins2D = nEbins*nTbins
+    counts = np.zeros(nexps*nbins2D)
+    for energymat, timemat in zip(dataE, dataT):
+        ibinE = np.minimum((energymat*(float(nEbins)/maxE)).astype(np.int64),
+                           nEbins - 1)
+        ibinT = np.minimum((timemat*(float(nTbins)/maxT)).astype(np.int64),
+                           nTbins - 1)
+        flatidx = ibinE*nTbins + ibinT
+        flatidx += nbins2D*np.arange(nexps, dtype=np.int64)[:,np.newaxis]
+        counts += np.bincount(flatidx.ravel(), minlength=nexps*nbins2D)
+    return counts.reshape(nexps, nEbins, nTbins)
+
+#########################################################################
+# Draw the 2-D histograms of 'nexps' experiments directly from the expected 
+# bin fractions, skipping per-event generation entirely. Each 'isotope' adds a
+# multinomial draw of nevents[niso] events over the cells of fracs2D[niso], so
+# the cost scales with the number of bins rather than the number of events. 
+# The output has the same (nexps, nEbins, nTbins) layout as 
+# histogramexperiments. 'rngs' works as in throwexperiments.
+def throwbinned(nexps, nevents, fracs2D, rng=np.random, rngs=None):
+    counts = np.zeros((nexps,) + fracs2D[0].shape)
+    for niso in xrange(len(nevents)):
+        # Renormalize so round-off can't push sum(pvals) past 1.
+        pvals = fracs2D[niso].ravel()/fracs2D[niso].sum()
+        if rngs is None:
+            counts += rng.multinomial(nevents[niso], pvals, 
+                                      size=nexps).reshape(counts.shape)
+            continue
+        for j in xrange(nexps):
+            counts[j] += rngs[j].multinomial(nevents[niso], 
+                                             pvals).reshape(counts.shape[1:])
+    return counts
+
+#########################################################################
+# Scratch memory used per generated event while a block is thrown and binned:
+# float64 uniform draws, energies and deltaTs, plus int64 bin indices.
+BYTES_PER_EVENT = 40
+# Extra memory per event kept for the unbinned fit (two densities plus the 
+# per-chunk scratch of unbinned_fits.extendednll).
+BYTES_PER_EVENT_UML = 48
+# Scratch memory used per 2-D bin and 'isotope' by throwbinned.
+BYTES_PER_BIN = 16
+
+# Number of experiments whose events fit in 'membudget' bytes (at least 1).
+def blocksize(nevents, membudget, bytesperevent=BYTES_PER_EVENT):
+    return max(1, int(membudget // (bytesperevent*sum(nevents))))
+
+#########################################################################
+# Generate and bin 'nexpers' experiments in blocks sized by 'membudget' (in 
+# bytes), so arbitrarily large ensembles stream through without ever holding
+# all of their events. The experiments are numbered firstexp, ..., 
+# firstexp + nexpers - 1, and this yields (start, stop, hists2D, events) where
+# hists2D holds the 2-D histograms of experiments start, ..., stop - 1 and 
+# 'events' is the (dataE, dataT) they were made from (None when binned). 
+# 'bytesperevent' is the memory per event that 'membudget' has to cover.
+#
+# genmode='events' draws every event (the cross-check path), while 
+# genmode='binned' draws the bin counts straight from fracs2D (see 
+# throwbinned), which is what you want for large event counts. If 'seed' is 
+# given, experiment i is drawn from experimentrng(seed, i) rather than 'rng'.
+def experimentblocks(nexpers, nevents, pdfsE, pdfsT, nEbins, nTbins, maxE, 
+                     maxT, membudget=2**28, rng=np.random, genmode='events',
+                     fracs2D=None, seed=None, firstexp=0, 
+                     bytesperevent=BYTES_PER_EVENT):
+    if genmode == 'events':
+        nblock = blocksize(nevents, membudget, bytesperevent)
+    elif genmode == 'binned':
+        nblock = max(1, int(membudget // (BYTES_PER_BIN*nEbins*nTbins*
+                                           len(nevents))))
+    else:
+        print 'Unknown genmode %s (expected "events" or "binned"). ' \
+            'Exiting!' % genmode
+        sys.exit(1)
+    for start in xrange(firstexp, firstexp + nexpers, nblock):
+        stop = min(start + nblock, firstexp + nexpers)
+        rngs = None
+        if seed is not None:
+            rngs = [experimentrng(seed, i) for i in xrange(start, stop)]
+        if genmode == 'binned':
+            yield start, stop, throwbinned(stop - start, nevents, fracs2D, 
+                                           rng, rngs), None
+            continue
+        dataE, dataT = throwexperiments(stop - start, nevents, pdfsE, pdfsT,
+                                        rng, rngs)
+        yield start, stop, histogramexperiments(dataE, dataT, nEbins, nTbins,
+                                                maxE, maxT), (dataE, dataT)
+
+#########################################################################
+# Fit the same 'nexpers' binned fake experiments with both the per-experiment
+# fitters (fit1D, fit2D, mlfit1D, mlfit2D) and their batched equivalents in 
+# batch_fits.py, and return the largest relative difference seen in each of
+# their outputs (best fits, covariances, chi^2s, p-values and fncmins).
+def crosscheck_batchfits(nexpers=100, nevents0=1000, nevents1=100, 
+                         endpoint0=12.0, endpoint1=8.0, lifetime0=260, 
+                         lifetime1=170, nEbins=4, nTbins=4, PearsonErrs=True):
+    nevents = (nevents0, nevents1)
+    pdfsE, pdfsT, fracsE, fracsT, fracs2D = maketemplates(endpoint0, 
+                                                          endpoint1, 
+                                                          lifetime0, 
+                                                          lifetime1, nEbins,
+                                                          nTbins)
+    hists2D = throwbinned(nexpers, nevents, fracs2D)
+    histsE, histsT = hists2D.sum(axis=2), hists2D.sum(axis=1)
+
+    batched = {'1D': bf.batchfit1D(histsE, histsT, fracsE, fracsT, 
+                                   PearsonErrs=PearsonErrs),
+               '2D': bf.batchfit2D(hists2D, fracs2D, PearsonErrs=PearsonErrs),
+               '1DML': bf.batchmlfit1D(histsE, histsT, fracsE, fracsT),
+               '2DML': bf.batchmlfit2D(hists2D, fracs2D)}
+    single = {'1D': [fit1D(histsE[i], histsT[i], fracsE, fracsT, nevents, 
+                           PearsonErrs=PearsonErrs) for i in xrange(nexpers)],
+              '2D': [fit2D(hists2D[i], fracs2D, nevents, 
+                           PearsonErrs=PearsonErrs) for i in xrange(nexpers)],
+              '1DML': [mlfit1D(histsE[i], histsT[i], fracsE, fracsT, nevents)
+                       for i in xrange(nexpers)],
+              '2DML': [mlfit2D(hists2D[i], fracs2D, nevents) 
+                       for i in xrange(nexpers)]}
+    outnames = {'1D': ['pfit', 'pcov', 'chi2', 'pval'], 
+                '2D': ['pfit', 'pcov', 'chi2', 'pval'],
+                '1DML': ['pfit', 'fncmin'], '2DML': ['pfit', 'fncmin']}
+    maxreldiff = {}
+    for fit in ['1D', '2D', '1DML', '2DML']:
+        for nout, name in enumerate(outnames[fit]):
+            ref = np.array([out[nout] for out in single[fit]])
+            reldiff = np.abs(batched[fit][nout] - ref)/np.abs(ref)
+            maxreldiff['%s_%s' % (name, fit)] = np.max(reldiff)
+    return maxreldiff
+
+#########################################################################
+# Fit the same 'nexpers' binned fake experiments with each per-experiment
+# fitter twice, with finite differences started from the true 'nevents'
+# (analytic=False) and with analytic derivatives started from chi2estimate
+# (analytic=True). Returns a dict mapping each fit to a dict with the mean
+# numbers of objective and derivative evaluations per experiment of both
+# ('nfev_before', 'nfev_after', 'njev_after'), the seconds per experiment of
+# both ('time_before', 'time_after') and the largest relative difference
+# between their best fits ('maxreldiff').
+def comparederivatives(nexpers=200, nevents0=1000, nevents1=100,
+                       endpoint0=12.0, endpoint1=8.0, lifetime0=260,
+                       lifetime1=170, nEbins=4, nTbins=4, PearsonErrs=True):
+    nevents = (nevents0, nevents1)
+    fracsE, fracsT, fracs2D = maketemplates(endpoint0, endpoint1, lifetime0,
+                                            lifetime1, nEbins, nTbins)[2:]
+    hists2D = throwbinned(nexpers, nevents, fracs2D)
+    histsE, histsT = hists2D.sum(axis=2), hists2D.sum(axis=1)
+    fitters = {'1D': lambda i, analytic:
+                   fit1D(histsE[i], histsT[i], fracsE, fracsT, nevents,
+                         PearsonErrs=PearsonErrs, full_output=True,
+                         analytic=analytic),
+               '2D': lambda i, analytic:
+                   fit2D(hists2D[i], fracs2D, nevents,
+                         PearsonErrs=PearsonErrs, full_output=True,
+                         analytic=analytic),
+               '1DML': lambda i, analytic:
+                   mlfit1D(histsE[i], histsT[i], fracsE, fracsT, nevents,
+                           full_output=True, analytic=analytic),
+               '2DML': lambda i, analytic:
+                   mlfit2D(hists2D[i], fracs2D, nevents, full_output=True,
+                           analytic=analytic)}
+    comparison = {}
+    for fit in ['1D', '2D', '1DML', '2DML']:
+        outs, seconds = {}, {}
+        for analytic in [False, True]:
+            tic = time.time()
+            outs[analytic] = [fitters[fit](i, analytic)
+                              for i in xrange(nexpers)]
+            seconds[analytic] = (time.time() - tic)/nexpers
+        pfits = dict((analytic, np.array([out[0] for out in outs[analytic]]))
+                     for analytic in outs)
+        comparison[fit] = {
+            'nfev_before': np.mean([out[-1]['nfev'] for out in outs[False]]),
+            'nfev_after': np.mean([out[-1]['nfev'] for out in outs[True]]),
+            'njev_after': np.mean([out[-1]['njev'] for out in outs[True]]),
+            'time_before': seconds[False], 'time_after': seconds[True],
+            'maxreldiff': np.max(np.abs(pfits[True] - pfits[False])/
+                                 np.abs(pfits[False]))}
+    return comparison
+
 #########################################################################
 # This finds the bins with the fewest expected events in both the 1-D and 2-D 
-# cases.
-def checkminbins(minevtsperbin, nevents, fracsE, fracsT, twoDfracs):
+# cases. If one has 'minevtsperbin' or fewer, this prints a warning and exits,
+# or with fatal=False returns the warning instead (it returns None if all 
+# bins are fine).
+def checkminbins(minevtsperbin, nevents, fracsE, fracsT, twoDfracs, 
+                 fatal=True):
     min1Dbin = min(np.min(nevents[0]*fracsE[0] + nevents[1]*fracsE[1]),
                    np.min(nevents[0]*fracsT[0] + nevents[1]*fracsT[1]))    
     min2Dbin = np.min(nevents[0]*twoDfracs[0] + nevents[1]*twoDfracs[1]) 
 
+    problem = None
     if min1Dbin <= minevtsperbin:
-        print 'Warning: there is a bin in the 1-D fit with %s expected events. Either increase event rate or make binning coarser. Exiting.' % min1Dbin
-        sys.exit(1)
-    if min2Dbin <= minevtsperbin:
-        print 'Warning: there is a bin in the 2-D fit with %s expected events. Either increase event rate or make binning coarser. Exiting.' % min2Dbin
+        problem = 'there is a bin in the 1-D fit with %s expected events' % \
+            min1Dbin
+    elif min2Dbin <= minevtsperbin:
+        problem = 'there is a bin in the 2-D fit with %s expected events' % \
+            min2Dbin
+    if problem and fatal:
+        print 'Warning: %s. Either increase event rate or make binning ' \
+            'coarser. Exiting.' % problem
         sys.exit(1)
+    return problem
 
 #########################################################################
 # This allows you to make easy calls to the terminal.
@@ -267,8 +1182,9 @@ def sh(arg):
 #########################################################################
 # Make histogram of p-vals for 1-D and 2-D chi^2 fits.
 def pval_distributions(filepath = 'toy_fits_1000exp_1000n0_100n1.txt'):
+    import matplotlib.pyplot as plt
 
-    data = pd.read_csv(filepath)
+    data = rs.loadresults(filepath, columns=['pval_1D', 'pval_2D'])
     plt.hist(data.pval_1D, alpha=0.9, hatch='o', 
              label='1-dimensional (d.o.f. = 6)')
     plt.hist(data.pval_2D, alpha=0.5, hatch='/', 
@@ -283,18 +1199,75 @@ def pval_distributions(filepath = 'toy_fits_1000exp_1000n0_100n1.txt'):
 #########################################################################
 #########################################################################
 if __name__ == '__main__':
-    if len(sys.argv) < 3:
-        print 'This requires number of fake experiments, true number of isotope 0 events, and true number of isotope 1 events. Optionally you can pass a filename to save output. Exiting!'
-        sys.exit(1)
+    # 'merge' combines the outputs of a sharded run; anything else runs fake
+    # experiments.
+    if len(sys.argv) > 1 and sys.argv[1] == 'merge':
+        parser = argparse.ArgumentParser(prog='toy_2D_fits.py merge',
+                                         description='Combine shard outputs.')
+        parser.add_argument('outfilename')
+        parser.add_argument('shards', nargs='+')
+        parser.add_argument('--binary', action='store_true', 
+                            help='write a binary result store')
+        args = parser.parse_args(sys.argv[2:])
+        mergeshards(args.shards, args.outfilename, 
+                    outformat='binary' if args.binary else 'csv')
+        sys.exit(0)
 
-    nexperiments = int(sys.argv[1])
-    nevents0 = int(sys.argv[2])
-    nevents1 = int(sys.argv[3])
+    parser = argparse.ArgumentParser(description='This requires number of '
+        'fake experiments, true number of isotope 0 events, and true number '
+        'of isotope 1 events. Optionally you can pass a filename to save '
+        'output.')
+    parser.add_argument('nexperiments', type=int)
+    parser.add_argument('nevents0', type=int)
+    parser.add_argument('nevents1', type=int)
+    parser.add_argument('outfilename', nargs='?', default='')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='base seed of the per-experiment random streams')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes (needs --seed)')
+    parser.add_argument('--shard', default=None, metavar='k/N',
+                        help='run only the k-th of N slices (needs --seed)')
+    parser.add_argument('--checkpoint', type=int, default=0, metavar='M',
+                        help='save a checkpoint every M experiments')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue from the last checkpoint')
+    parser.add_argument('--binary', action='store_true', 
+                        help='write a binary result store instead of CSV')
+    parser.add_argument('--summary', action='store_true',
+                        help='keep only running summaries (no per-experiment'
+                        ' rows) and write them as JSON')
+    parser.add_argument('--cache', default=None, metavar='DIR',
+                        help='result cache directory (default: $TOY2D_CACHE;'
+                        ' "" turns caching off)')
+    parser.add_argument('--progress', type=float, default=10., metavar='SEC',
+                        help='print progress every SEC seconds')
+    parser.add_argument('--profile', default='', metavar='PATH',
+                        help='run under cProfile and save the stats to PATH')
+    parser.add_argument('--replay', type=int, default=None, metavar='I',
+                        help='rerun only experiment I of the seeded run, '
+                        'with debug output from every fit')
+    parser.add_argument('--unbinned', action='store_true',
+                        help='also run the (slower) unbinned ML fit')
+    args = parser.parse_args()
 
-    outfilename = ''
-    if len(sys.argv) == 5: outfilename = sys.argv[4]
-    
-    starttime = time.clock()
-    mainloop(nexperiments, nevents0, nevents1, outfilename=outfilename, 
-             debug=True)
-    print 'elapsed time: %s' % (time.clock() - starttime)
+    if args.replay is not None:
+        if args.seed is None or not 0 <= args.replay < args.nexperiments:
+            print '--replay I needs --seed and 0 <= I < nexperiments. Exiting!'
+            sys.exit(1)
+        replay(args.replay, args.seed, args.nevents0, args.nevents1,
+               unbinned=args.unbinned)
+        sys.exit(0)
+
+    shard = None
+    if args.shard is not None: 
+        shard = tuple(int(part) for part in args.shard.split('/'))
+
+    starttime = time.time()
+    mainloop(args.nexperiments, args.nevents0, args.nevents1, 
+             outfilename=args.outfilename, nworkers=args.workers, 
+             seed=args.seed, shard=shard, checkpoint=args.checkpoint, 
+             resume=args.resume, summaryonly=args.summary, 
+             cache=args.cache, progress=args.progress, profile=args.profile,
+             unbinned=args.unbinned,
+             outformat='binary' if args.binary else 'csv', debug=True)
+    print 'elapsed time: %s' % (time.time() - starttime)
@@ -0,0 +1,123 @@
+import numpy as np
+
+# Unbinned extended maximum-likelihood fit of the 'isotope' normalizations.
+# Instead of binning, every event contributes the analytic densities of the
+# components' energy and deltaT PDFs at its own (E, T), so none of the shape
+# information within a bin is thrown away. With f_k(E, T) = pdfE_k(E) pdfT_k(T)
+# (each normalized to 1) and expected numbers of events p_k, the extended
+# negative log-likelihood of an experiment is
+#     NLL = sum_k p_k - sum_i log(sum_k p_k f_k(E_i, T_i)).
+# The densities are evaluated once per experiment into a (K, nexps, nevents)
+# matrix by densitymatrix(), and umlfit() then minimizes using nothing but
+# that matrix. All sums over events are done in chunks of 'chunksize' events,
+# so the scratch memory of a fit stays bounded even for 10^7 events per
+# experiment.
+
+# Events per chunk in the likelihood sums.
+CHUNKSIZE = 2**16
+
+#########################################################################
+# Densities of the K components (energy PDF times deltaT PDF) at every event
+# of the experiments thrown by toy_2D_fits.throwexperiments, i.e. dataE and
+# dataT are lists over isotopes of (nexps, nevents[niso]) arrays. Returns an
+# array of shape (K, nexps, sum(nevents)). A component's density is 0 outside
+# its PDFs' support (e.g. above a lower energy endpoint).
+def densitymatrix(pdfsE, pdfsT, dataE, dataT):
+    energies, times = np.hstack(dataE), np.hstack(dataT)
+    dens = np.empty((len(pdfsE),) + energies.shape)
+    for k, (pdfE, pdfT) in enumerate(zip(pdfsE, pdfsT)):
+        dens[k] = _support(pdfE, energies)*_support(pdfT, times)
+    return dens
+
+# A BinnedPDF's _pdf at x, set to 0 outside [pdf.a, pdf.b].
+def _support(pdf, x):
+    return np.where((x >= pdf.a) & (x <= pdf.b), pdf._pdf(x), 0.)
+
+#########################################################################
+# Extended NLL of the experiments 'idx' (default: all) of a density matrix
+# for normalizations 'params' of shape (len(idx), K), summed over events in
+# chunks. Returns (nll, minpred), where minpred is the smallest predicted
+# density sum_k p_k f_k of each experiment (the NLL is only defined where it
+# is positive). With derivs=True this also returns the gradient and Hessian
+#     dNLL/dp_k = 1 - sum_i f_ik/mu_i,
+#     d^2NLL/dp_k dp_l = sum_i f_ik f_il/mu_i^2,
+# with shapes (len(idx), K) and (len(idx), K, K).
+def extendednll(dens, params, idx=None, chunksize=CHUNKSIZE, derivs=False):
+    K, nexps, nevents = dens.shape
+    if idx is None: idx = np.arange(nexps)
+    loglike = np.zeros(len(idx))
+    minpred = np.empty(len(idx))
+    minpred.fill(np.inf)
+    if derivs:
+        grad = np.ones((len(idx), K))
+        hess = np.zeros((len(idx), K, K))
+    for first in xrange(0, nevents, chunksize):
+        chunk = dens[:,idx,first:first + chunksize]
+        pred = (params.T[:,:,np.newaxis]*chunk).sum(axis=0)
+        minpred = np.minimum(minpred, pred.min(axis=-1))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            loglike += np.log(pred).sum(axis=-1)
+        if not derivs: continue
+        invpred = 1./pred
+        for k in xrange(K):
+            ratiok = chunk[k]*invpred
+            grad[:,k] -= ratiok.sum(axis=-1)
+            for l in xrange(k + 1):
+                hess[:,k,l] += (ratiok*chunk[l]*invpred).sum(axis=-1)
+    nll = params.sum(axis=-1) - loglike
+    if not derivs: return nll, minpred
+    for k in xrange(K):
+        for l in xrange(k):
+            hess[:,l,k] = hess[:,k,l]
+    return nll, minpred, grad, hess
+
+#########################################################################
+# Minimize the extended NLL of every experiment in the density matrix 'dens'
+# at once, by Newton's method with step halving as in batch_fits.mlfit,
+# starting from the observed number of events split equally among the
+# components. Only rows that haven't converged are updated and the chunks
+# don't depend on which rows are being fitted, so each experiment's result
+# depends only on its own events. Returns (pfit, fncmin) with shapes
+# (nexps, K) and (nexps,), plus a diagnostics dict as in batch_fits.mlfit
+# with full_output=True.
+def umlfit(dens, maxiter=50, tol=1e-10, maxhalvings=30, chunksize=CHUNKSIZE,
+           full_output=False):
+    K, nexps, nevents = dens.shape
+    params = np.empty((nexps, K))
+    params.fill(float(nevents)/K)
+    nll = extendednll(dens, params, chunksize=chunksize)[0]
+
+    active = np.ones(nexps, dtype=bool)
+    nfev = np.ones(nexps, dtype=int)
+    for niter in xrange(maxiter):
+        idx = np.nonzero(active)[0]
+        if not len(idx): break
+        grad, hess = extendednll(dens, params[idx], idx, chunksize,
+                                 derivs=True)[2:]
+        step = np.linalg.solve(hess, grad[...,np.newaxis])[...,0]
+        # Backtrack rows whose full step is unphysical or goes uphill.
+        scale = np.ones(len(idx))
+        for nhalve in xrange(maxhalvings):
+            trial = params[idx] - scale[:,np.newaxis]*step
+            trialnll, minpred = extendednll(dens, trial, idx, chunksize)
+            with np.errstate(invalid='ignore'):
+                bad = (minpred <= 0) | \
+                    ~(trialnll <= nll[idx] + 1e-12*(1. + np.abs(nll[idx])))
+            if not bad.any(): break
+            scale[bad] *= 0.5
+        nfev[idx] += nhalve + 1
+        params[idx], nll[idx] = trial, trialnll
+        done = (np.abs(scale[:,np.newaxis]*step) <=
+                tol*(np.abs(trial) + tol)).all(axis=-1)
+        active[idx[done]] = False
+
+    if full_output:
+        return params, nll, {'converged': ~active, 'nfev': nfev}
+    return params, nll
+
+#########################################################################
+# Unbinned fit of experiments thrown by toy_2D_fits.throwexperiments: builds
+# their density matrix and passes it to umlfit along with any keyword
+# arguments.
+def fitevents(pdfsE, pdfsT, dataE, dataT, **kwargs):
+    return umlfit(densitymatrix(pdfsE, pdfsT, dataE, dataT), **kwargs)